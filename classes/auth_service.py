@@ -1,10 +1,14 @@
-import sys
 import datetime
 import threading
 
 import requests
 import requests.exceptions
 
+from classes import resilience
+from classes import log
+
+logger = log.get_logger('auth')
+
 
 class AuthService:
     def __init__(self, config: dict):
@@ -13,9 +17,10 @@ class AuthService:
         self._valid_until = datetime.datetime.utcnow()
         #
         self._oAuthScope = 'https://graph.microsoft.com/.default'
-        self._oAuthUrl = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
+        self._oAuthUrl = config['OAUTH_URL']
         #
         self._lock = threading.Lock()
+        self._dependency = resilience.get_dependency('oauth')
         #
         self.token = ''
 
@@ -39,18 +44,17 @@ class AuthService:
         if self._app_id == '11111111-2222-3333-4444-666666666666':
             # this is a default value from default config
             # ignore it
-            sys.stderr.write('AuthService: I cannot refresh token with '
-                             'incorrect default app_id!\n')
+            logger.error('Cannot refresh token with incorrect default app_id')
             self.token = ''
             return
         #
         dt_unow = datetime.datetime.utcnow()
         if self._valid_until <= dt_unow:
             # time to refresh!
-            print('AuthService: Time to refresh token!')
+            logger.info('Time to refresh token')
             self.do_refresh_token()
         else:
-            print('AuthService: Token is still valid...')
+            logger.debug('Token is still valid', valid_until=self._valid_until)
 
     def do_refresh_token(self):
         try:
@@ -61,7 +65,9 @@ class AuthService:
                 'grant_type': 'client_credentials',
                 'scope': self._oAuthScope
             }
-            r = sess.post(self._oAuthUrl, data=postdata)
+            r = self._dependency.call(sess.post, self._oAuthUrl, data=postdata,
+                                      timeout=self._dependency.timeout,
+                                      result_check=resilience.check_http_status)
             if r.status_code == 200:
                 # save token response as json
                 with open('_cache/token_response.json', mode='wt', encoding='utf-8') as f:
@@ -69,17 +75,19 @@ class AuthService:
                 r_json = r.json()
                 self.token = r_json['access_token']
                 #
-                print('AuthService: Got access token: ' + self.get_token_short())
-                #
                 expires_in = int(r_json['expires_in'])  # usually server gives 3600 seconds
                 tdelta = datetime.timedelta(seconds=expires_in)
                 self._valid_until = datetime.datetime.utcnow() + tdelta
                 #
-                print('AuthService:     Expires in: ' + str(expires_in))
-                print('AuthService:     Valid until: ' + str(self._valid_until))
+                logger.info('Got access token', token=self.get_token_short(),
+                            expires_in=expires_in, valid_until=self._valid_until)
                 #
                 return True
+            logger.error('Token refresh failed', status=r.status_code)
+            return False
+        except requests.exceptions.RequestException as rex:
+            logger.error('Error happened during refreshing token', error=rex)
             return False
-        except requests.exceptions.RequestException:
-            sys.stderr.write('AuthService: Error happened during refreshing token!\n')
+        except resilience.DependencyError as de:
+            logger.error('Cannot refresh token', error=de)
             return False
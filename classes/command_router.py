@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+
+from classes import log
+
+logger = log.get_logger('commands')
+
+
+class Command:
+    """
+    Registered chat command.
+    Handler is called as handler(ctx: CommandContext) and returns reply text
+    (or None if it has nothing to reply, or has replied itself).
+    """
+
+    def __init__(self, name: str, handler, scope: int, description: str = '',
+                 args_mode: str = 'none', cost: int = 1, cache_ttl: float = 0.0,
+                 exact: bool = False):
+        self.name = name
+        self.handler = handler
+        self.scope = scope
+        self.description = description
+        # 'none' - command takes no arguments; 'rest' - everything after command name
+        # is one argument; 'split' - arguments are split by whitespace
+        self.args_mode = args_mode
+        # relative cost of a single invocation, 1 is cheap, bigger is more expensive
+        self.cost = cost
+        # if > 0, identical replies are served from cache for that many seconds
+        self.cache_ttl = cache_ttl
+        # if True, message must be exactly the command name, without any text after it
+        self.exact = exact
+        # statistics
+        self.num_calls = 0
+        self.num_cache_hits = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+
+class CommandContext:
+    def __init__(self, command: Command, scope: int, from_id: str, conversation_id: str,
+                 reply_to: str, args):
+        self.command = command
+        self.scope = scope
+        self.from_id = from_id                  # full skype ID of sender
+        self.conversation_id = conversation_id  # full skype ID of conversation or DM peer
+        self.reply_to = reply_to
+        self.args = args  # str for args_mode='rest', list for 'split', None for 'none'
+
+
+class CommandRouter:
+    """
+    Dispatches chat messages to registered commands.
+    Command name is the first word of the message, so lookup is a single dict access.
+    """
+
+    SCOPE_DM = 1
+    SCOPE_GROUP = 2
+    SCOPE_ANY = SCOPE_DM | SCOPE_GROUP
+
+    def __init__(self):
+        self._commands = {}  # name => Command
+        self._lock = threading.Lock()
+        self._reply_cache = {}  # (name, scope, args) => (expires_at, reply)
+
+    def register(self, name: str, handler, scope: int = SCOPE_ANY, **kwargs) -> Command:
+        cmd = Command(name, handler, scope, **kwargs)
+        self._commands[name] = cmd
+        return cmd
+
+    def get_commands(self, scope: int = SCOPE_ANY) -> list:
+        return [cmd for cmd in self._commands.values() if (cmd.scope & scope) != 0]
+
+    def resolve(self, message: str, scope: int):
+        """
+        Finds command for message
+        :param message: chat message text
+        :param scope: SCOPE_DM or SCOPE_GROUP
+        :return: tuple (Command, args) or (None, None) if it is not a command
+        """
+        if (len(message) < 2) or (message[0] != '!'):
+            return None, None
+        parts = message.split(maxsplit=1)
+        cmd = self._commands.get(parts[0])
+        if (cmd is None) or ((cmd.scope & scope) == 0):
+            return None, None
+        rest = ''
+        if len(parts) > 1:
+            rest = parts[1].strip()
+        if cmd.exact and (message != cmd.name):
+            return None, None
+        if cmd.args_mode == 'rest':
+            if rest == '':
+                return None, None
+            return cmd, rest
+        if cmd.args_mode == 'split':
+            return cmd, rest.split()
+        return cmd, None
+
+    def invoke(self, ctx: CommandContext):
+        """
+        Runs command handler, or takes its reply from cache
+        :param ctx: command context
+        :return: reply text or None
+        """
+        cmd = ctx.command
+        t0 = time.perf_counter()
+        reply = None
+        cache_key = None
+        if cmd.cache_ttl > 0:
+            args_key = ctx.args
+            if type(args_key) == list:
+                args_key = tuple(args_key)
+            # reply may depend on scope: !help lists only commands of that scope
+            cache_key = (cmd.name, ctx.scope, args_key)
+            with self._lock:
+                cached = self._reply_cache.get(cache_key)
+            if (cached is not None) and (cached[0] > time.monotonic()):
+                reply = cached[1]
+                cmd.num_cache_hits += 1
+        if (reply is None) or (cache_key is None):
+            try:
+                reply = cmd.handler(ctx)
+            except Exception as e:
+                logger.error('Command failed', command=cmd.name, error=e)
+                reply = None
+            if (cache_key is not None) and (reply is not None):
+                now = time.monotonic()
+                with self._lock:
+                    if len(self._reply_cache) >= 256:
+                        # drop expired replies, so that cache does not grow forever
+                        for key in [k for k, v in self._reply_cache.items() if v[0] <= now]:
+                            del self._reply_cache[key]
+                    self._reply_cache[cache_key] = (now + cmd.cache_ttl, reply)
+        dt = time.perf_counter() - t0
+        cmd.num_calls += 1
+        cmd.total_time += dt
+        if dt > cmd.max_time:
+            cmd.max_time = dt
+        return reply
+
+    def get_cache_size(self) -> int:
+        with self._lock:
+            return len(self._reply_cache)
+
+    def invalidate(self, name: str):
+        with self._lock:
+            for key in [k for k in self._reply_cache if k[0] == name]:
+                del self._reply_cache[key]
+
+    def get_stats(self) -> list:
+        """
+        :return: list of dicts with per-command counters
+        """
+        ret = []
+        for cmd in self._commands.values():
+            avg_ms = 0.0
+            if cmd.num_calls > 0:
+                avg_ms = cmd.total_time * 1000.0 / cmd.num_calls
+            ret.append({
+                'name': cmd.name,
+                'calls': cmd.num_calls,
+                'cache_hits': cmd.num_cache_hits,
+                'avg_ms': avg_ms,
+                'max_ms': cmd.max_time * 1000.0
+            })
+        return ret
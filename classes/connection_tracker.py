@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import time
+import socket
+import threading
+
+from classes import log
+
+logger = log.get_logger('connections')
+
+
+class ConnectionTracker:
+    """
+    Keeps track of client connections served by request handler threads:
+    - limits number of concurrent connections from one IP address;
+    - enforces deadlines for connection phases (waiting for next request
+      on kept-alive connection, reading request headers, reading request body).
+      Socket timeouts alone are not enough, they are per recv() call, and
+      a client sending one byte every few seconds would never hit them.
+      So a watchdog thread shuts down sockets whose phase deadline has passed;
+    - counts connections closed by each rule.
+    """
+
+    # names of rules, that can close a connection
+    RULE_HEADER_TIMEOUT = 'header_timeout'
+    RULE_BODY_TIMEOUT = 'body_timeout'
+    RULE_IDLE_TIMEOUT = 'idle_timeout'
+    RULE_MAX_REQUESTS = 'max_requests'
+    RULE_PER_IP_LIMIT = 'per_ip_limit'
+
+    def __init__(self, config: dict):
+        self.header_timeout = config['HEADER_TIMEOUT']
+        self.body_timeout = config['BODY_TIMEOUT']
+        self.keepalive_timeout = config['KEEPALIVE_TIMEOUT']
+        self.max_requests = config['MAX_REQUESTS_PER_CONNECTION']
+        self.max_per_ip = config['MAX_CONNECTIONS_PER_IP']
+        #
+        self._lock = threading.Lock()
+        self._per_ip = {}      # ip => number of open connections
+        self._deadlines = {}   # handler => (deadline, rule)
+        self._expired = set()  # handlers, closed by watchdog or by timeout
+        self.num_active = 0
+        self.closed_by_rule = {
+            self.RULE_HEADER_TIMEOUT: 0,
+            self.RULE_BODY_TIMEOUT: 0,
+            self.RULE_IDLE_TIMEOUT: 0,
+            self.RULE_MAX_REQUESTS: 0,
+            self.RULE_PER_IP_LIMIT: 0
+        }
+        #
+        self._watchdog = threading.Thread(target=self._watchdog_loop,
+                                          name='ConnectionWatchdog', daemon=True)
+        self._watchdog.start()
+
+    def acquire(self, ip: str) -> bool:
+        """
+        Called on accept(), before request handler thread is started
+        :param ip: client IP address
+        :return: False if this IP has too many connections open already
+        """
+        with self._lock:
+            num = self._per_ip.get(ip, 0)
+            if (self.max_per_ip > 0) and (num >= self.max_per_ip):
+                self.closed_by_rule[self.RULE_PER_IP_LIMIT] += 1
+                return False
+            self._per_ip[ip] = num + 1
+            self.num_active += 1
+        return True
+
+    def release(self, ip: str):
+        with self._lock:
+            num = self._per_ip.get(ip, 0) - 1
+            if num > 0:
+                self._per_ip[ip] = num
+            elif ip in self._per_ip:
+                del self._per_ip[ip]
+            self.num_active -= 1
+
+    def count_closed(self, rule: str):
+        with self._lock:
+            self.closed_by_rule[rule] += 1
+
+    def set_deadline(self, handler, rule: str):
+        """
+        Starts connection phase, that must complete in time, given by rule
+        :param handler: request handler object, owning the connection
+        :param rule: one of RULE_*_TIMEOUT
+        :return: None
+        """
+        timeout = self.get_timeout(rule)
+        handler.connection.settimeout(timeout)
+        with self._lock:
+            self._deadlines[handler] = (time.monotonic() + timeout, rule)
+
+    def clear_deadline(self, handler):
+        with self._lock:
+            self._deadlines.pop(handler, None)
+
+    def forget(self, handler):
+        with self._lock:
+            self._deadlines.pop(handler, None)
+            self._expired.discard(handler)
+
+    def expire(self, handler, rule: str) -> bool:
+        """
+        Marks handler's connection as closed by rule, counts it only once.
+        :return: True, if it was not expired before
+        """
+        with self._lock:
+            self._deadlines.pop(handler, None)
+            if handler in self._expired:
+                return False
+            self._expired.add(handler)
+            self.closed_by_rule[rule] += 1
+        return True
+
+    def is_expired(self, handler) -> bool:
+        with self._lock:
+            return handler in self._expired
+
+    def get_current_rule(self, handler) -> str:
+        with self._lock:
+            if handler in self._deadlines:
+                return self._deadlines[handler][1]
+        return ''
+
+    def get_sizes(self) -> dict:
+        with self._lock:
+            return {
+                'connections_per_ip': len(self._per_ip),
+                'connections_deadlines': len(self._deadlines),
+                'connections_expired': len(self._expired)
+            }
+
+    def get_timeout(self, rule: str) -> float:
+        if rule == self.RULE_IDLE_TIMEOUT:
+            return self.keepalive_timeout
+        if rule == self.RULE_BODY_TIMEOUT:
+            return self.body_timeout
+        return self.header_timeout
+
+    def close_idle(self):
+        """
+        Closes kept-alive connections, that are waiting for the next request.
+        Used on graceful shutdown, so that idle clients do not delay it.
+        """
+        with self._lock:
+            idle = [handler for handler, (deadline, rule) in self._deadlines.items()
+                    if rule == self.RULE_IDLE_TIMEOUT]
+        for handler in idle:
+            try:
+                handler.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _watchdog_loop(self):
+        while True:
+            time.sleep(0.5)
+            now = time.monotonic()
+            with self._lock:
+                overdue = [(handler, rule) for handler, (deadline, rule)
+                           in self._deadlines.items() if deadline <= now]
+            for handler, rule in overdue:
+                if not self.expire(handler, rule):
+                    continue
+                # blocked read in handler thread returns immediately after that
+                try:
+                    handler.connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                logger.info('Closing connection', client=handler.client_address[0], rule=rule)
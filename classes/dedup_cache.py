@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Remembers recently processed webhook deliveries, so that redelivered
+# events (Skype platform retries when our 201 reply is slow) are dropped
+import time
+import sqlite3
+import threading
+import collections
+
+from classes import log
+
+logger = log.get_logger('dedup')
+
+
+def get_delivery_key(event_dict: dict) -> str:
+    """
+    Idempotency key of webhook event: activity id, or from/to/time if there is no id
+    :param event_dict: webhook JSON object
+    :return: key string, or '' if event has nothing to identify it
+    """
+    if event_dict.get('id'):
+        return 'id:{0}'.format(event_dict['id'])
+    if ('from' in event_dict) or ('time' in event_dict):
+        return 'ft:{0}|{1}|{2}|{3}'.format(event_dict.get('from', ''), event_dict.get('to', ''),
+                                           event_dict.get('time', ''), event_dict.get('activity', ''))
+    return ''
+
+
+class DeliveryDedupCache:
+    """
+    In-memory set of seen keys with expiration.
+    Every key lives the same ttl, so insertion order is also expiration order:
+    OrderedDict gives O(1) lookup, and expired keys are always at its front.
+    At most max_entries keys are kept, oldest are forgotten first.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._seen = collections.OrderedDict()  # key => expires_at
+        # statistics
+        self.num_new = 0
+        self.num_duplicates = 0
+
+    def check_and_add(self, key: str) -> bool:
+        """
+        :param key: delivery key
+        :return: True if key was not seen during last ttl seconds (and remembers it),
+                 False if this is a duplicate delivery
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            if key in self._seen:
+                self.num_duplicates += 1
+                return False
+            self._seen[key] = now + self.ttl
+            if len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            self.num_new += 1
+        return True
+
+    def _purge(self, now: float):
+        while len(self._seen) > 0:
+            key, expires_at = next(iter(self._seen.items()))
+            if expires_at > now:
+                break
+            del self._seen[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._seen)
+
+
+class SqliteDedupCache:
+    """
+    Seen keys in sqlite database file, can be shared by several
+    bot processes on one host. INSERT OR IGNORE on primary key is atomic,
+    so only one process gets to handle each delivery.
+    Uses wall clock time, because monotonic clocks of different processes
+    are not comparable.
+    """
+
+    def __init__(self, filename: str, ttl: float, max_entries: int):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()  # sqlite connection per thread
+        self._lock = threading.Lock()
+        self._num_inserts = 0
+        # statistics
+        self.num_new = 0
+        self.num_duplicates = 0
+        db = self._get_db()
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS deliveries ('
+                       'key TEXT PRIMARY KEY, expires_at REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS deliveries_expires ON deliveries (expires_at)')
+
+    def _get_db(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.filename, timeout=5.0)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    def check_and_add(self, key: str) -> bool:
+        now = time.time()
+        try:
+            db = self._get_db()
+            with db:
+                db.execute('DELETE FROM deliveries WHERE key = ? AND expires_at <= ?', (key, now))
+                cur = db.execute('INSERT OR IGNORE INTO deliveries (key, expires_at) VALUES (?, ?)',
+                                 (key, now + self.ttl))
+                is_new = cur.rowcount == 1
+            with self._lock:
+                if is_new:
+                    self.num_new += 1
+                    self._num_inserts += 1
+                    need_purge = self._num_inserts % 100 == 0
+                else:
+                    self.num_duplicates += 1
+                    need_purge = False
+            if need_purge:
+                self._purge(db, now)
+        except sqlite3.Error as e:
+            # better process a delivery twice than lose it
+            logger.error('Dedup database error', error=e)
+            return True
+        return is_new
+
+    def _purge(self, db: sqlite3.Connection, now: float):
+        with db:
+            db.execute('DELETE FROM deliveries WHERE expires_at <= ?', (now,))
+            db.execute('DELETE FROM deliveries WHERE key IN (SELECT key FROM deliveries '
+                       'ORDER BY expires_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def __len__(self):
+        try:
+            return self._get_db().execute('SELECT COUNT(*) FROM deliveries').fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+
+def create_dedup_cache(config: dict):
+    """
+    :return: dedup cache selected in config, or None if deduplication is disabled
+    """
+    backend = config['DEDUP_BACKEND']
+    if backend == 'memory':
+        return DeliveryDedupCache(config['DEDUP_TTL'], config['DEDUP_MAX_ENTRIES'])
+    if backend == 'sqlite':
+        return SqliteDedupCache(config['DEDUP_SQLITE_FILE'], config['DEDUP_TTL'],
+                                config['DEDUP_MAX_ENTRIES'])
+    if backend != 'none':
+        logger.error('Unknown webhook dedup backend', backend=backend)
+    return None
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Display names of users, who are not bot's contacts: learned from webhook
+# events and from member lists of conversations, fetched in background
+import time
+import threading
+import collections
+
+from classes import log
+
+logger = log.get_logger('names')
+
+
+class DisplayNameCache:
+    """
+    LRU cache with expiration: OrderedDict of skype ID => (name, expires_at),
+    most recently used at the end. At most max_entries names are kept,
+    least recently used are forgotten first.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._names = collections.OrderedDict()
+
+    def get(self, skypeid: str):
+        """
+        :return: name, or None if not known or expired
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._names.get(skypeid)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self._names[skypeid]
+                return None
+            self._names.move_to_end(skypeid)
+            return entry[0]
+
+    def put(self, skypeid: str, name: str):
+        with self._lock:
+            self._names[skypeid] = (name, time.monotonic() + self.ttl)
+            self._names.move_to_end(skypeid)
+            while len(self._names) > self.max_entries:
+                self._names.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._names)
+
+
+class DisplayNameResolver:
+    """
+    Names are resolved from cache only, so message handlers never wait.
+    A cache miss in a group chat queues a lookup of that conversation's
+    members; a background thread waits batch_delay for more misses to
+    arrive, then fetches each queued conversation once, which resolves
+    all of its members with one API call.
+    A conversation is looked up at most once per room_interval seconds,
+    so users, whose names the API does not return, cost no more lookups.
+    """
+
+    def __init__(self, fetch_members, max_entries: int, ttl: float, batch_delay: float = 1.0,
+                 room_interval: float = 600.0, max_pending_rooms: int = 100):
+        """
+        :param fetch_members: function(conversation) => dict of skype ID => name, None on failure
+        """
+        self._fetch_members = fetch_members
+        self.cache = DisplayNameCache(max_entries, ttl)
+        self.batch_delay = batch_delay
+        self.room_interval = room_interval
+        self.max_pending_rooms = max_pending_rooms
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()  # conversations waiting for lookup
+        self._last_lookup = collections.OrderedDict()  # conversation => monotonic time, oldest first
+        self._stopped = False
+        # statistics
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_lookups = 0
+        self.num_failed_lookups = 0
+        self.num_dropped = 0
+        self._thread = threading.Thread(target=self._lookup_loop, name='NameResolver', daemon=True)
+        self._thread.start()
+
+    def learn(self, skypeid: str, name: str):
+        if (name is not None) and (name != ''):
+            self.cache.put(skypeid, name)
+
+    def resolve(self, skypeid: str, conversation: str = None):
+        """
+        Never blocks on API calls
+        :param skypeid: stripped skype ID
+        :param conversation: group chat, whose members are looked up on a miss
+        :return: cached name, or None
+        """
+        name = self.cache.get(skypeid)
+        with self._cond:
+            if name is not None:
+                self.num_hits += 1
+                return name
+            self.num_misses += 1
+            if conversation is not None:
+                self._queue_lookup(conversation)
+        return None
+
+    def _queue_lookup(self, conversation: str):
+        # must be called with self._cond held
+        if conversation in self._pending:
+            return
+        now = time.monotonic()
+        while len(self._last_lookup) > 0:
+            room, looked_up_at = next(iter(self._last_lookup.items()))
+            if now - looked_up_at < self.room_interval:
+                break
+            del self._last_lookup[room]
+        if conversation in self._last_lookup:
+            return
+        if len(self._pending) >= self.max_pending_rooms:
+            self.num_dropped += 1
+            return
+        self._pending[conversation] = None
+        self._cond.notify()
+
+    def _lookup_loop(self):
+        while True:
+            with self._cond:
+                while (not self._stopped) and (len(self._pending) == 0):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            # let misses of the same burst join this batch
+            time.sleep(self.batch_delay)
+            with self._cond:
+                batch = list(self._pending.keys())
+                self._pending.clear()
+                now = time.monotonic()
+                for conversation in batch:
+                    self._last_lookup[conversation] = now
+                    self._last_lookup.move_to_end(conversation)
+            for conversation in batch:
+                if self._stopped:
+                    return
+                self._lookup(conversation)
+
+    def _lookup(self, conversation: str):
+        members = None
+        try:
+            members = self._fetch_members(conversation)
+        except Exception as e:
+            logger.error('Member lookup failed', conversation=conversation, error=e)
+        with self._cond:
+            self.num_lookups += 1
+            if members is None:
+                self.num_failed_lookups += 1
+                return
+        for skypeid, name in members.items():
+            self.learn(skypeid, name)
+        logger.debug('Looked up conversation members', conversation=conversation, num_members=len(members))
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            return {
+                'cached': len(self.cache),
+                'hits': self.num_hits,
+                'misses': self.num_misses,
+                'pending_rooms': len(self._pending),
+                'lookups': self.num_lookups,
+                'failed_lookups': self.num_failed_lookups,
+                'dropped': self.num_dropped
+            }
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import contextlib
+
+from classes import log
+
+logger = log.get_logger('flusher')
+
+
+class DebouncedFlusher:
+    """
+    Coalesces many state changes into one save.
+    Changes only mark state dirty; flush_fn is called:
+    - when the outermost batch() of the changing thread ends, if delay is 0;
+    - otherwise from a background thread, after no changes for delay seconds,
+      but not later than max_delay seconds after the first unsaved change.
+    So number of saves depends on number of webhook deliveries (or on time),
+    not on number of events in them.
+    """
+
+    def __init__(self, flush_fn, delay: float, max_delay: float, name: str = 'Flusher'):
+        self._flush_fn = flush_fn
+        self.delay = delay
+        self.max_delay = max(delay, max_delay)
+        self.name = name
+        self._cond = threading.Condition()
+        self._dirty_since = None  # monotonic time of first unsaved change
+        self._last_change = 0.0
+        # batches nest per thread: with overlapping requests a shared depth
+        # could stay above 0 for good, and state would never be saved
+        self._local = threading.local()
+        self._stopped = False
+        # statistics
+        self.num_changes = 0
+        self.num_flushes = 0
+        self._thread = None
+        if self.delay > 0:
+            self._thread = threading.Thread(target=self._flush_loop, name=name, daemon=True)
+            self._thread.start()
+
+    def mark_dirty(self):
+        flush = False
+        with self._cond:
+            now = time.monotonic()
+            self.num_changes += 1
+            self._last_change = now
+            if self._dirty_since is None:
+                self._dirty_since = now
+            if self._thread is None:
+                flush = self._get_depth() == 0
+            else:
+                self._cond.notify()
+        if flush:
+            self.flush_now()
+
+    def _get_depth(self) -> int:
+        return getattr(self._local, 'depth', 0)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Changes made inside batch are saved once, after it ends
+        """
+        self._local.depth = self._get_depth() + 1
+        try:
+            yield
+        finally:
+            self._local.depth -= 1
+            with self._cond:
+                flush = (self._local.depth == 0) and (self._thread is None) and \
+                        (self._dirty_since is not None)
+            if flush:
+                self.flush_now()
+
+    def is_dirty(self) -> bool:
+        with self._cond:
+            return self._dirty_since is not None
+
+    def flush_now(self):
+        with self._cond:
+            if self._dirty_since is None:
+                return
+            # changes made while flush_fn runs will make state dirty again
+            self._dirty_since = None
+            self.num_flushes += 1
+        try:
+            self._flush_fn()
+        except Exception as e:
+            logger.error('Flush failed', flusher=self.name, error=e)
+
+    def stop(self):
+        """
+        Saves pending changes and stops background thread
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self.flush_now()
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._dirty_since is None:
+                        self._cond.wait()
+                        continue
+                    due = min(self._last_change + self.delay, self._dirty_since + self.max_delay)
+                    now = time.monotonic()
+                    if now >= due:
+                        break
+                    self._cond.wait(due - now)
+                if self._stopped:
+                    return
+            self.flush_now()
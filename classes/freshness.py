@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# How quickly a new video tweet reaches chatrooms: lag of each stage
+# (tweet created => detected by poll => queued to outbox => delivered to chatroom)
+import bisect
+import threading
+import collections
+
+# upper bounds of histogram buckets, seconds
+LAG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 900, 1200, 1800, 3600, 7200, 21600)
+
+
+class LagHistogram:
+    """
+    Cumulative histogram with fixed buckets (as exported to Prometheus),
+    plus last samples for a recent-lag summary.
+    """
+
+    def __init__(self, buckets: tuple = LAG_BUCKETS, num_recent: int = 200):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.recent = collections.deque(maxlen=num_recent)
+
+    def observe(self, value: float):
+        value = max(0.0, value)
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def get_cumulative(self) -> list:
+        """
+        :return: list of (upper bound string, cumulative count), ending with '+Inf'
+        """
+        ret = []
+        total = 0
+        for i, bound in enumerate(self.buckets):
+            total += self.counts[i]
+            ret.append((str(bound), total))
+        ret.append(('+Inf', total + self.counts[-1]))
+        return ret
+
+    def get_summary(self) -> dict:
+        values = sorted(self.recent)
+        if len(values) == 0:
+            return {'count': self.count, 'recent': 0, 'p50': 0.0, 'p90': 0.0, 'max': 0.0}
+        return {
+            'count': self.count,
+            'recent': len(values),
+            'p50': values[int(0.5 * (len(values) - 1))],
+            'p90': values[int(0.9 * (len(values) - 1))],
+            'max': values[-1]
+        }
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class FreshnessTracker:
+    """
+    Stages:
+    - detect: tweet created_at => poll found it (bounded by twitter check interval);
+    - queue: found => broadcast stored in outbox (metadata lookups);
+    - delivery: stored in outbox => chatroom accepted the message (retries, backlog);
+    - end_to_end: tweet created_at => chatroom accepted the message, also per chatroom.
+    Timestamps of queued broadcasts are kept in memory only, so deliveries
+    of broadcasts queued before a restart are not measured.
+    """
+
+    STAGES = ('detect', 'queue', 'delivery', 'end_to_end')
+
+    def __init__(self, max_pending_batches: int = 1000):
+        self._lock = threading.Lock()
+        self._stages = {stage: LagHistogram() for stage in self.STAGES}
+        self._rooms = {}  # chatroom => LagHistogram of end_to_end lag
+        # batch id => (queued_at, {chatroom: [created_at of its tweets]})
+        self._pending = collections.OrderedDict()
+        self._max_pending = max_pending_batches
+        # outbox worker can deliver messages and complete the batch before
+        # broadcast_queued() is called: batch id => list of (chatroom, delivered_at),
+        # (None, None) marks completed batch
+        self._early = collections.OrderedDict()
+
+    def video_detected(self, video: dict, detected_at: float):
+        video['detected_at'] = detected_at
+        if video.get('created_at'):
+            with self._lock:
+                self._stages['detect'].observe(detected_at - video['created_at'])
+
+    def broadcast_queued(self, batch_id: int, videos: list, videos_per_room: dict, queued_at: float):
+        """
+        :param videos: all videos of the broadcast
+        :param videos_per_room: chatroom => list of videos sent to it
+        """
+        created = {room: [v['created_at'] for v in room_videos if v.get('created_at')]
+                   for room, room_videos in videos_per_room.items()}
+        with self._lock:
+            for v in videos:
+                if 'detected_at' in v:
+                    self._stages['queue'].observe(queued_at - v['detected_at'])
+            self._pending[batch_id] = (queued_at, created)
+            while len(self._pending) > self._max_pending:
+                self._pending.popitem(last=False)
+            for room, delivered_at in self._early.pop(batch_id, []):
+                if room is None:
+                    del self._pending[batch_id]
+                    break
+                self._observe_delivery(batch_id, room, delivered_at)
+
+    def message_delivered(self, batch_id: int, room: str, delivered_at: float):
+        with self._lock:
+            if batch_id not in self._pending:
+                self._early.setdefault(batch_id, []).append((room, delivered_at))
+                while len(self._early) > self._max_pending:
+                    self._early.popitem(last=False)
+                return
+            self._observe_delivery(batch_id, room, delivered_at)
+
+    def _observe_delivery(self, batch_id: int, room: str, delivered_at: float):
+        queued_at, created = self._pending[batch_id]
+        self._stages['delivery'].observe(delivered_at - queued_at)
+        room_hist = self._rooms.get(room)
+        if room_hist is None:
+            room_hist = LagHistogram(num_recent=20)
+            self._rooms[room] = room_hist
+        for created_at in created.pop(room, []):
+            self._stages['end_to_end'].observe(delivered_at - created_at)
+            room_hist.observe(delivered_at - created_at)
+
+    def batch_done(self, batch_id: int):
+        with self._lock:
+            if batch_id in self._pending:
+                del self._pending[batch_id]
+            else:
+                self._early.setdefault(batch_id, []).append((None, None))
+                while len(self._early) > self._max_pending:
+                    self._early.popitem(last=False)
+
+    def forget_room(self, room: str):
+        with self._lock:
+            self._rooms.pop(room, None)
+
+    def get_summary(self) -> list:
+        """
+        :return: list of dicts with recent lag of each stage, for status page
+        """
+        with self._lock:
+            ret = []
+            for stage in self.STAGES:
+                item = self._stages[stage].get_summary()
+                item['stage'] = stage
+                ret.append(item)
+            return ret
+
+    def get_slowest_rooms(self, limit: int = 5) -> list:
+        """
+        :return: list of (chatroom, recent p90 end_to_end lag), slowest first
+        """
+        with self._lock:
+            rooms = [(room, hist.get_summary()['p90']) for room, hist in self._rooms.items()]
+        rooms.sort(key=lambda item: item[1], reverse=True)
+        return rooms[:limit]
+
+    def get_pending_size(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def format_metrics(self) -> str:
+        """
+        :return: histograms in Prometheus text exposition format
+        """
+        lines = ['# HELP moviebot_freshness_seconds Lag of new video tweets by stage.',
+                 '# TYPE moviebot_freshness_seconds histogram']
+        with self._lock:
+            for stage in self.STAGES:
+                self._format_histogram(lines, 'moviebot_freshness_seconds',
+                                       'stage="{0}"'.format(stage), self._stages[stage])
+            lines.append('# HELP moviebot_room_freshness_seconds Lag from tweet to chatroom, by chatroom.')
+            lines.append('# TYPE moviebot_room_freshness_seconds histogram')
+            for room in sorted(self._rooms):
+                self._format_histogram(lines, 'moviebot_room_freshness_seconds',
+                                       'room="{0}"'.format(_escape_label(room)), self._rooms[room])
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _format_histogram(lines: list, name: str, labels: str, hist: LagHistogram):
+        for bound, count in hist.get_cumulative():
+            lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(name, labels, bound, count))
+        lines.append('{0}_sum{{{1}}} {2}'.format(name, labels, hist.sum))
+        lines.append('{0}_count{{{1}}} {2}'.format(name, labels, hist.count))
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Liveness, readiness and machine-readable status for probes and load balancers
+import json
+import time
+import datetime
+import threading
+
+from classes import log
+
+logger = log.get_logger('health')
+
+
+class HealthReporter:
+    """
+    Probes are answered with bytes, that a background thread prepares every
+    refresh_interval seconds, so that a probe costs an attribute read, not a
+    template render, SQL query or locks of bot's structures.
+    - /healthz: process is alive: background thread runs and the snapshot
+      is fresh (a stuck reporter means something is deadlocked);
+    - /readyz: the bot can do its work: listener is not shutting down,
+      warmup is done (state loaded, OAuth token fetched), OAuth token is
+      valid, queues are below thresholds;
+    - /status.json: the whole snapshot.
+    Reporter also refreshes expired OAuth token, otherwise token of a bot
+    that sends nothing expires, and the bot would become not ready.
+    """
+
+    def __init__(self, server, config: dict):
+        self._server = server
+        self.refresh_interval = config['HEALTH_REFRESH_INTERVAL']
+        self.max_outbox_pending = config['HEALTH_MAX_OUTBOX_PENDING']
+        self.max_send_queue = config['HEALTH_MAX_SEND_QUEUE']
+        # stale snapshot fails liveness; token refresh may take a dependency timeout
+        self.max_age = max(3 * self.refresh_interval, 60.0)
+        self._started_at = time.time()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._last_token_attempt = 0.0
+        # each is (HTTP status, body bytes), replaced as a whole, read without locks
+        self.healthz = (503, b'starting\n')
+        self.readyz = (503, b'not ready: starting\n')
+        self.status_json = (503, b'{"ready": false}\n')
+        self._refreshed_at = time.monotonic()
+        # statistics
+        self.num_refreshes = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._refresh_loop, name='HealthReporter', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def get_healthz(self) -> tuple:
+        if time.monotonic() - self._refreshed_at > self.max_age:
+            return 503, b'stale: status not refreshed\n'
+        return self.healthz
+
+    def get_readyz(self) -> tuple:
+        # probes on kept-alive connections must see shutdown at once, not on next refresh
+        if self._server.is_shutting_down():
+            return 503, b'not ready: listener\n'
+        return self.readyz
+
+    def _refresh_loop(self):
+        while not self._stopped.is_set():
+            try:
+                self._maybe_refresh_token()
+                self.refresh()
+            except Exception as e:
+                logger.error('Status refresh failed', error=e)
+            self._stopped.wait(self.refresh_interval)
+
+    def _maybe_refresh_token(self):
+        server = self._server
+        if not server.warmup_done or server.is_shutting_down():
+            return
+        authservice = server.skype.authservice
+        if authservice.get_valid_until() > datetime.datetime.utcnow():
+            return
+        # do not retry failed refresh on every pass
+        now = time.monotonic()
+        if now - self._last_token_attempt < 60.0:
+            return
+        self._last_token_attempt = now
+        server.skype.refresh_token()
+
+    def refresh(self):
+        """
+        Builds snapshot and prepares probe responses
+        """
+        snapshot = self.build_snapshot()
+        failed = [check for check, ok in snapshot['checks'].items() if not ok]
+        if snapshot['alive']:
+            self.healthz = (200, b'ok\n')
+        else:
+            self.healthz = (503, b'background thread is not running\n')
+        if len(failed) == 0:
+            self.readyz = (200, b'ready\n')
+        else:
+            self.readyz = (503, 'not ready: {0}\n'.format(', '.join(sorted(failed))).encode('utf-8'))
+        self.status_json = (200 if snapshot['ready'] else 503,
+                            json.dumps(snapshot, sort_keys=True, indent=4).encode('utf-8'))
+        self._refreshed_at = time.monotonic()
+        self.num_refreshes += 1
+
+    def build_snapshot(self) -> dict:
+        server = self._server
+        now = time.time()
+        authservice = server.skype.authservice
+        token_expires_in = (authservice.get_valid_until() - datetime.datetime.utcnow()).total_seconds()
+        outbox_stats = server.get_outbox_stats()
+        shed_stats = server.load_shedder.get_stats()
+        queues = {
+            'skype_send_queue': len(server._skype_send_queue),
+            'outbox_pending': outbox_stats['pending'],
+            'outbox_failed': outbox_stats['failed'],
+            'requests_in_progress': shed_stats['active'],
+            'accept_queue': shed_stats['accept_queue'],
+            'active_connections': server.connections.num_active
+        }
+        checks = {
+            'listener': not (server.is_shutting_down() or server.user_shutdown_request),
+            'warmup_done': server.warmup_done,
+            'token_valid': (authservice.token != '') and (token_expires_in > 0),
+            'outbox_pending': queues['outbox_pending'] < self.max_outbox_pending,
+            'send_queue': queues['skype_send_queue'] < self.max_send_queue
+        }
+        ready = all(checks.values())
+        return {
+            'generated_at': now,
+            'uptime': now - self._started_at,
+            'version': server.server_version,
+            'alive': server.is_alive(),
+            'ready': ready,
+            'checks': checks,
+            'token': {
+                'valid': checks['token_valid'],
+                'valid_until': authservice.get_valid_until().isoformat() + 'Z',
+                'expires_in': max(0.0, token_expires_in)
+            },
+            'twitter_poller': {
+                'leader': server.is_leader(),
+                'interval': server.config['TWITTER_CHECK_INTERVAL'],
+                'last_run': server.twitter_last_check,
+                'next_run': server.twitter_next_check
+            },
+            'leader': server.get_leader_stats(),
+            'queues': queues,
+            'sizes': server.get_memory_sizes(),
+            'dependencies': {dep['name']: dep for dep in server.get_dependencies_stats()},
+            'shed_requests': shed_stats['shed']
+        }
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# Validation of bearer tokens (RS256 JWT), that the bot platform sends
+# with every webhook request. Signing keys are fetched from OpenID metadata
+# and cached, so validating a token needs no network calls.
+import json
+import time
+import base64
+import hashlib
+import threading
+
+import requests
+import requests.exceptions
+
+from classes import resilience
+from classes import log
+
+logger = log.get_logger('jwt')
+
+
+class JwtError(Exception):
+    pass
+
+
+def b64url_decode(s: str) -> bytes:
+    s += '=' * (-len(s) % 4)
+    return base64.urlsafe_b64decode(s.encode('ascii'))
+
+
+class RsaPublicKey:
+    """
+    RSA public key from JWK, verifies RSASSA-PKCS1-v1_5 SHA-256 signatures (RS256).
+    Verification only needs modular exponentiation with the public exponent,
+    so no crypto library is needed for it.
+    """
+
+    # DER prefix of DigestInfo for SHA-256, RFC 8017 section 9.2
+    SHA256_DIGEST_INFO = bytes.fromhex('3031300d060960864801650304020105000420')
+
+    def __init__(self, n: int, e: int):
+        self.n = n
+        self.e = e
+        self.size = (n.bit_length() + 7) // 8
+
+    @classmethod
+    def from_jwk(cls, jwk: dict):
+        return cls(int.from_bytes(b64url_decode(jwk['n']), 'big'),
+                   int.from_bytes(b64url_decode(jwk['e']), 'big'))
+
+    def verify_rs256(self, message: bytes, signature: bytes) -> bool:
+        if len(signature) != self.size:
+            return False
+        s = int.from_bytes(signature, 'big')
+        if s >= self.n:
+            return False
+        em = pow(s, self.e, self.n).to_bytes(self.size, 'big')
+        t = self.SHA256_DIGEST_INFO + hashlib.sha256(message).digest()
+        if self.size < len(t) + 11:
+            return False
+        expected = b'\x00\x01' + b'\xff' * (self.size - len(t) - 3) + b'\x00' + t
+        return em == expected
+
+
+class KeySetCache:
+    """
+    Signing keys from OpenID metadata (metadata => jwks_uri => keys), kept in memory.
+    Keys are refreshed every refresh_interval seconds, and when a token
+    is signed with an unknown key id (keys are rotated), but not more often
+    than min_refresh_interval, so forged tokens with random key ids
+    cannot make the bot hammer the metadata server.
+    If a refresh fails, previously fetched keys stay in use.
+    """
+
+    def __init__(self, metadata_url: str, refresh_interval: float, min_refresh_interval: float):
+        self.metadata_url = metadata_url
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self._keys = {}  # kid => RsaPublicKey, replaced as a whole on refresh
+        self._refreshed_at = None  # monotonic time of last successful refresh
+        self._attempted_at = None  # monotonic time of last refresh attempt
+        self._refresh_lock = threading.Lock()
+        self._dependency = resilience.get_dependency('openid')
+        # statistics
+        self.num_refreshes = 0
+        self.num_refresh_failures = 0
+
+    def prefetch(self):
+        """
+        Fetches keys at startup, so that the first webhook request does not wait for it
+        """
+        self._maybe_refresh(time.monotonic(), wait=True)
+
+    def get_key(self, kid: str):
+        """
+        :return: RsaPublicKey or None, if there is no such key
+        """
+        now = time.monotonic()
+        if (self._refreshed_at is None) or (now - self._refreshed_at >= self.refresh_interval):
+            # if we have keys, do not wait while another thread refreshes them
+            self._maybe_refresh(now, wait=len(self._keys) == 0)
+        key = self._keys.get(kid)
+        if key is None:
+            self._maybe_refresh(now, wait=True)
+            key = self._keys.get(kid)
+        return key
+
+    def _maybe_refresh(self, now: float, wait: bool):
+        if not self._refresh_lock.acquire(blocking=wait):
+            return
+        try:
+            # other thread could have just refreshed keys, while we waited for the lock
+            if (self._attempted_at is not None) and (now - self._attempted_at < self.min_refresh_interval):
+                return
+            self._attempted_at = time.monotonic()
+            try:
+                self._keys = self._fetch_keys()
+                self._refreshed_at = time.monotonic()
+                self.num_refreshes += 1
+                logger.info('Token signing keys refreshed', num_keys=len(self._keys))
+            except (requests.exceptions.RequestException, resilience.DependencyError,
+                    ValueError, KeyError, TypeError) as e:
+                self.num_refresh_failures += 1
+                logger.error('Failed to refresh token signing keys', error=e, num_keys=len(self._keys))
+        finally:
+            self._refresh_lock.release()
+
+    def _fetch_keys(self) -> dict:
+        metadata = self._get_json(self.metadata_url)
+        jwks = self._get_json(metadata['jwks_uri'])
+        keys = {}
+        for jwk in jwks['keys']:
+            if (jwk.get('kty') != 'RSA') or ('kid' not in jwk):
+                continue
+            if jwk.get('use', 'sig') != 'sig':
+                continue
+            keys[jwk['kid']] = RsaPublicKey.from_jwk(jwk)
+        return keys
+
+    def _get_json(self, url: str):
+        r = self._dependency.call(requests.get, url, timeout=self._dependency.timeout,
+                                  result_check=resilience.check_http_status)
+        if r.status_code != 200:
+            raise ValueError('HTTP status {0} from {1}'.format(r.status_code, url))
+        return r.json()
+
+    def get_num_keys(self) -> int:
+        return len(self._keys)
+
+
+class JwtValidator:
+    """
+    Checks "Authorization: Bearer <JWT>" header: RS256 signature with a cached
+    key, issuer, audience (bot's app id) and expiration times.
+    """
+
+    def __init__(self, key_cache: KeySetCache, issuer: str, audience: str, leeway: float):
+        self.key_cache = key_cache
+        self.issuer = issuer
+        self.audience = audience
+        self.leeway = leeway
+        # statistics
+        self.num_valid = 0
+        self.num_invalid = 0
+
+    def validate_header(self, authorization: str) -> dict:
+        """
+        :param authorization: value of Authorization header
+        :return: token claims
+        :raises JwtError: token is missing or invalid
+        """
+        try:
+            if not authorization.startswith('Bearer '):
+                raise JwtError('no bearer token')
+            claims = self.validate(authorization[7:].strip())
+        except JwtError:
+            self.num_invalid += 1
+            raise
+        self.num_valid += 1
+        return claims
+
+    def validate(self, token: str) -> dict:
+        parts = token.split('.')
+        if len(parts) != 3:
+            raise JwtError('malformed token')
+        try:
+            header = json.loads(b64url_decode(parts[0]).decode('utf-8'))
+            claims = json.loads(b64url_decode(parts[1]).decode('utf-8'))
+            signature = b64url_decode(parts[2])
+        except (ValueError, UnicodeDecodeError):
+            raise JwtError('malformed token')
+        if (type(header) != dict) or (type(claims) != dict):
+            raise JwtError('malformed token')
+        if header.get('alg') != 'RS256':
+            raise JwtError('unsupported alg: {0}'.format(header.get('alg')))
+        key = self.key_cache.get_key(str(header.get('kid', '')))
+        if key is None:
+            raise JwtError('unknown signing key: {0}'.format(header.get('kid', '')))
+        if not key.verify_rs256((parts[0] + '.' + parts[1]).encode('ascii'), signature):
+            raise JwtError('bad signature')
+        if claims.get('iss') != self.issuer:
+            raise JwtError('wrong issuer: {0}'.format(claims.get('iss')))
+        aud = claims.get('aud')
+        if (aud != self.audience) and not ((type(aud) == list) and (self.audience in aud)):
+            raise JwtError('wrong audience: {0}'.format(aud))
+        now = time.time()
+        try:
+            if now > float(claims['exp']) + self.leeway:
+                raise JwtError('token expired')
+            if ('nbf' in claims) and (now < float(claims['nbf']) - self.leeway):
+                raise JwtError('token not valid yet')
+        except (KeyError, ValueError, TypeError):
+            raise JwtError('bad or missing exp/nbf')
+        return claims
+
+
+def create_jwt_validator(config: dict):
+    """
+    :return: JwtValidator, or None if webhook token validation is disabled
+    """
+    if not config['WEBHOOK_AUTH_ENABLED']:
+        return None
+    key_cache = KeySetCache(config['WEBHOOK_AUTH_OPENID_METADATA_URL'],
+                            config['WEBHOOK_AUTH_KEYS_REFRESH_INTERVAL'],
+                            config['WEBHOOK_AUTH_MIN_KEYS_REFRESH_INTERVAL'])
+    return JwtValidator(key_cache, config['WEBHOOK_AUTH_ISSUER'], config['APP_ID'],
+                        config['WEBHOOK_AUTH_CLOCK_LEEWAY'])
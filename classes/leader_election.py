@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+# Leader election between bot instances sharing one _cache directory,
+# so that only one of them polls Twitter and broadcasts new videos
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+from classes import log
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # not a unix
+
+logger = log.get_logger('leader')
+
+
+class FileLockElection:
+    """
+    Leader is the process holding an exclusive flock() on lock file.
+    Kernel releases the lock when the process dies, however it dies,
+    so a standby takes over at its next attempt. Lock does not expire
+    while held. Works for processes on one host (not over NFS).
+    """
+
+    lease_ttl = None  # lock never expires while held
+
+    def __init__(self, filename: str, instance_id: str):
+        self.filename = filename
+        self.instance_id = instance_id
+        self._fd = None
+        # a lock file, that cannot be opened, would leave the only instance
+        # a standby forever: fail at startup instead (raises OSError)
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        os.close(os.open(filename, os.O_RDWR | os.O_CREAT, 0o644))
+
+    def try_acquire(self) -> bool:
+        """
+        :return: True if this instance holds the lock
+        """
+        if self._fd is not None:
+            return True
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        # for diagnostics only: who is the leader
+        os.ftruncate(fd, 0)
+        os.write(fd, self.instance_id.encode('utf-8'))
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fd = self._fd
+            self._fd = None
+            os.close(fd)  # closing the last descriptor releases flock
+
+    def get_holder(self) -> str:
+        try:
+            with open(self.filename, mode='rt', encoding='utf-8') as f:
+                return f.read().strip()
+        except OSError:
+            return ''
+
+
+class SqliteLeaseElection:
+    """
+    Leader is the holder of a lease row in sqlite database, that it renews
+    on every heartbeat. If the leader stops renewing (died, hung), lease
+    expires after lease_ttl seconds and a standby takes it over, with an
+    incremented term. Uses wall clock to compare with expiration time
+    written by other processes, so hosts sharing the file must have synced clocks.
+    """
+
+    LEASE_NAME = 'twitter_poller'
+
+    def __init__(self, filename: str, instance_id: str, lease_ttl: float):
+        self.filename = filename
+        self.instance_id = instance_id
+        self.lease_ttl = lease_ttl
+        self.term = 0
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        db = self._connect()
+        try:
+            db.execute('CREATE TABLE IF NOT EXISTS leases ('
+                       'name TEXT PRIMARY KEY, holder TEXT NOT NULL, '
+                       'expires_at REAL NOT NULL, term INTEGER NOT NULL)')
+        finally:
+            db.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: transactions are controlled explicitly by BEGIN IMMEDIATE
+        return sqlite3.connect(self.filename, timeout=5.0, isolation_level=None)
+
+    def try_acquire(self) -> bool:
+        """
+        Acquires free or expired lease, or renews own lease
+        :return: True if this instance holds the lease
+        """
+        now = time.time()
+        db = self._connect()
+        try:
+            # takes write lock right away, so two standbys cannot both take an expired lease
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT holder, expires_at, term FROM leases WHERE name = ?',
+                             (self.LEASE_NAME,)).fetchone()
+            if (row is not None) and (row[0] != self.instance_id) and (row[1] > now):
+                db.execute('ROLLBACK')
+                return False
+            term = 1
+            if row is not None:
+                term = row[2] if row[0] == self.instance_id else row[2] + 1
+            db.execute('INSERT OR REPLACE INTO leases (name, holder, expires_at, term) VALUES (?, ?, ?, ?)',
+                       (self.LEASE_NAME, self.instance_id, now + self.lease_ttl, term))
+            db.execute('COMMIT')
+            self.term = term
+            return True
+        finally:
+            db.close()
+
+    def release(self):
+        """
+        Expires own lease, so that a standby does not have to wait lease_ttl
+        """
+        db = self._connect()
+        try:
+            db.execute('UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ?',
+                       (self.LEASE_NAME, self.instance_id))
+        finally:
+            db.close()
+
+    def get_holder(self) -> str:
+        db = self._connect()
+        try:
+            row = db.execute('SELECT holder, expires_at FROM leases WHERE name = ?',
+                             (self.LEASE_NAME,)).fetchone()
+        finally:
+            db.close()
+        if (row is None) or (row[1] <= time.time()):
+            return ''
+        return row[0]
+
+
+class LeaderElector:
+    """
+    Runs election attempts every heartbeat seconds in a background thread.
+    is_leader() is cheap and safe to call before every leader-only action:
+    leadership with an expiring lease is counted from the start of the
+    last successful renewal, so this instance stops considering itself
+    leader before any standby can take the lease over, even if renewals
+    fail or the database is unreachable.
+    """
+
+    def __init__(self, election, heartbeat: float):
+        self.election = election
+        self.heartbeat = heartbeat
+        self._lock = threading.Lock()
+        self._leader = False
+        self._valid_until = 0.0  # monotonic
+        self._stopped = threading.Event()
+        self._thread = None
+        # statistics
+        self.num_elected = 0
+        self.num_demoted = 0
+        self.num_errors = 0
+        self.elected_at = None  # wall clock time of the last election win
+
+    def start(self):
+        self._attempt()
+        self._thread = threading.Thread(target=self._heartbeat_loop, name='LeaderElector', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops heartbeats and gives leadership away, so a standby can take over right now
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(self.heartbeat + 5.0)
+        with self._lock:
+            was_leader = self._leader
+            self._leader = False
+        if was_leader:
+            try:
+                self.election.release()
+                logger.info('Leadership released', instance=self.election.instance_id)
+            except (OSError, sqlite3.Error) as e:
+                logger.error('Failed to release leadership', error=e)
+
+    def is_leader(self) -> bool:
+        with self._lock:
+            return self._leader and (time.monotonic() < self._valid_until)
+
+    def get_stats(self) -> dict:
+        try:
+            holder = self.election.get_holder()
+        except (OSError, sqlite3.Error):
+            holder = '?'
+        return {
+            'backend': type(self.election).__name__,
+            'instance': self.election.instance_id,
+            'is_leader': self.is_leader(),
+            'holder': holder,
+            'elected': self.num_elected,
+            'demoted': self.num_demoted,
+            'errors': self.num_errors
+        }
+
+    def _heartbeat_loop(self):
+        while not self._stopped.wait(self.heartbeat):
+            self._attempt()
+
+    def _attempt(self):
+        started = time.monotonic()
+        try:
+            acquired = self.election.try_acquire()
+        except (OSError, sqlite3.Error) as e:
+            # keep current leadership until it expires by itself
+            self.num_errors += 1
+            logger.error('Leader election attempt failed', error=e)
+            return
+        with self._lock:
+            was_leader = self._leader
+            self._leader = acquired
+            if acquired:
+                if self.election.lease_ttl is None:
+                    self._valid_until = float('inf')
+                else:
+                    self._valid_until = started + self.election.lease_ttl
+        if acquired and not was_leader:
+            self.num_elected += 1
+            self.elected_at = time.time()
+            fields = {'instance': self.election.instance_id}
+            if hasattr(self.election, 'term'):
+                fields['term'] = self.election.term
+            logger.info('Elected leader', **fields)
+        elif was_leader and not acquired:
+            self.num_demoted += 1
+            logger.warning('Lost leadership', instance=self.election.instance_id)
+
+
+def create_leader_elector(config: dict):
+    """
+    :return: LeaderElector for backend selected in config, or None if election
+             is disabled (this instance is always the leader)
+    :raises OSError, sqlite3.Error: lock file or lease database cannot be used
+    """
+    backend = config['LEADER_BACKEND']
+    instance_id = config['LEADER_INSTANCE_ID']
+    if instance_id == '':
+        instance_id = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+    if (backend == 'flock') and (fcntl is None):
+        logger.error('flock leader election is not available on this platform')
+        return None
+    try:
+        if backend == 'flock':
+            election = FileLockElection(config['LEADER_LOCK_FILE'], instance_id)
+        elif backend == 'sqlite':
+            if config['LEADER_HEARTBEAT'] * 2 > config['LEADER_LEASE_TTL']:
+                logger.warning('Leader heartbeat should be at most half of lease ttl',
+                               heartbeat=config['LEADER_HEARTBEAT'], lease_ttl=config['LEADER_LEASE_TTL'])
+            election = SqliteLeaseElection(config['LEADER_SQLITE_FILE'], instance_id, config['LEADER_LEASE_TTL'])
+        else:
+            if backend != 'none':
+                logger.error('Unknown leader election backend', backend=backend)
+            return None
+    except (OSError, sqlite3.Error) as e:
+        logger.error('Leader election cannot start', backend=backend, error=e)
+        raise
+    return LeaderElector(election, config['LEADER_HEARTBEAT'])
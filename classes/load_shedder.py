@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+
+from classes import log
+
+logger = log.get_logger('shedder')
+
+# route priorities: webhook deliveries have a 5 second deadline and are never shed
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class LoadShedder:
+    """
+    Decides, whether a request may be handled, before its handler runs.
+    Saturation signals:
+    - requests in progress (each takes a handler thread and the GIL);
+    - scheduling lag: how late a monitor thread wakes up from a short sleep.
+      With ThreadingMixIn there is no event loop, but when threads fight
+      for CPU and GIL, every thread, webhook handlers included, runs late;
+    - accept queue: connections waiting in the listen backlog for the
+      serve_forever() thread, sampled by the monitor thread.
+    Low priority requests are shed when a signal is past low_share of its
+    threshold, normal priority ones when it is past the threshold, and high
+    priority ones never. Shed requests are counted per route.
+    """
+
+    def __init__(self, config: dict, get_accept_queue=None):
+        """
+        :param get_accept_queue: callable returning accept queue length, -1 if not known
+        """
+        self.enabled = config['SHED_ENABLED']
+        self.max_active = config['SHED_MAX_ACTIVE_REQUESTS']
+        self.max_lag = config['SHED_MAX_LAG']
+        self.max_queue = config['SHED_MAX_ACCEPT_QUEUE'] if get_accept_queue is not None else 0
+        self.low_share = config['SHED_LOW_PRIORITY_SHARE']
+        self._get_accept_queue = get_accept_queue
+        self._lock = threading.Lock()
+        self._lag = 0.0  # peak of recent lags, decays
+        self._queue = 0.0  # peak of recent accept queue lengths, decays
+        self._stopped = threading.Event()
+        self._monitor = None
+        # statistics
+        self.num_active = 0
+        self.max_active_seen = 0
+        self.max_lag_seen = 0.0
+        self.max_queue_seen = 0
+        self.num_admitted = {PRIORITY_HIGH: 0, PRIORITY_NORMAL: 0, PRIORITY_LOW: 0}
+        self.shed_by_route = {}  # route => number of shed requests
+        if self.enabled and ((self.max_lag > 0) or (self.max_queue > 0)):
+            self._monitor = threading.Thread(target=self._monitor_loop, name='LoadMonitor', daemon=True)
+            self._monitor.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _monitor_loop(self, interval: float = 0.05):
+        while not self._stopped.is_set():
+            t0 = time.monotonic()
+            self._stopped.wait(interval)
+            lag = max(0.0, time.monotonic() - t0 - interval)
+            # peak hold with decay: one late wakeup keeps shedding for a few hundred ms
+            self._lag = max(lag, self._lag * 0.9)
+            if lag > self.max_lag_seen:
+                self.max_lag_seen = lag
+            if self.max_queue > 0:
+                queue = self._get_accept_queue()
+                if queue < 0:
+                    self.max_queue = 0  # not supported on this platform
+                    continue
+                self._queue = max(queue, self._queue * 0.9)
+                if queue > self.max_queue_seen:
+                    self.max_queue_seen = queue
+
+    def get_lag(self) -> float:
+        return self._lag
+
+    def try_begin(self, route: str, priority: int) -> bool:
+        """
+        Called before handling a request; if True is returned, end() must be called after it
+        :param route: route name for statistics, from a fixed set (not raw path)
+        :return: False if request should be shed
+        """
+        with self._lock:
+            if self.enabled and (priority != PRIORITY_HIGH):
+                share = self.low_share if priority == PRIORITY_LOW else 1.0
+                if ((self.max_active > 0) and (self.num_active >= self.max_active * share)) or \
+                        ((self.max_lag > 0) and (self._lag >= self.max_lag * share)) or \
+                        ((self.max_queue > 0) and (self._queue >= self.max_queue * share)):
+                    self.shed_by_route[route] = self.shed_by_route.get(route, 0) + 1
+                    return False
+            self.num_active += 1
+            if self.num_active > self.max_active_seen:
+                self.max_active_seen = self.num_active
+            self.num_admitted[priority] += 1
+        return True
+
+    def end(self):
+        with self._lock:
+            self.num_active -= 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'active': self.num_active,
+                'max_active': self.max_active_seen,
+                'lag_ms': self._lag * 1000.0,
+                'max_lag_ms': self.max_lag_seen * 1000.0,
+                'accept_queue': int(self._queue),
+                'max_accept_queue': self.max_queue_seen,
+                'admitted_high': self.num_admitted[PRIORITY_HIGH],
+                'admitted_normal': self.num_admitted[PRIORITY_NORMAL],
+                'admitted_low': self.num_admitted[PRIORITY_LOW],
+                'shed': dict(self.shed_by_route)
+            }
+
+    def format_metrics(self) -> str:
+        """
+        :return: shed requests counters in Prometheus text exposition format
+        """
+        lines = ['# HELP moviebot_shed_requests_total Requests refused with 503 under overload, by route.',
+                 '# TYPE moviebot_shed_requests_total counter']
+        with self._lock:
+            for route in sorted(self.shed_by_route):
+                lines.append('moviebot_shed_requests_total{{route="{0}"}} {1}'.format(
+                    route, self.shed_by_route[route]))
+        return '\n'.join(lines) + '\n'
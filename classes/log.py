@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+# Logging for the whole bot. Records are put into a queue by the calling
+# thread, and written to stderr by a background QueueListener thread,
+# so a slow log consumer (journald) never blocks request threads.
+#
+# Usage:
+#     from classes import log
+#     logger = log.get_logger('skype')
+#     logger.info('Message sent', to=conversation_id, status=201)
+# outputs:
+#     2016-04-14 04:34:37,672 INFO    moviebot.skype: Message sent to=19:...@thread.skype status=201
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import threading
+import collections
+import logging.handlers
+
+
+LOGGER_NAME = 'moviebot'
+
+_LEVEL_NAMES = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL
+}
+
+
+def parse_level(s: str) -> int:
+    """
+    :param s: level name, like 'info' or 'WARNING'
+    :return: logging level number
+    :raises ValueError: unknown level name
+    """
+    name = s.strip().lower()
+    if name not in _LEVEL_NAMES:
+        raise ValueError('Unknown log level: {0}'.format(s))
+    return _LEVEL_NAMES[name]
+
+
+def parse_levels(s: str) -> dict:
+    """
+    'auth:warning, skype:debug' => {'auth': 'warning', 'skype': 'debug'}
+    """
+    ret = {}
+    for item in s.split(','):
+        if item.strip() == '':
+            continue
+        name, sep, level = item.partition(':')
+        parse_level(level)
+        ret[name.strip()] = level.strip().lower()
+    return ret
+
+
+def format_value(value) -> str:
+    s = str(value)
+    if (s == '') or any((c in s) for c in ' ="\n'):
+        s = json.dumps(s, ensure_ascii=False)
+    return s
+
+
+class KeyValueFormatter(logging.Formatter):
+    """
+    Appends structured fields as key=value pairs after the message
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        s = super(KeyValueFormatter, self).format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            s += ' ' + ' '.join('{0}={1}'.format(k, format_value(v)) for k, v in fields.items())
+        return s
+
+
+class KeyValueLogger(logging.LoggerAdapter):
+    """
+    Logger, that takes structured fields as keyword arguments:
+    logger.info('Token refreshed', expires_in=3600)
+    Fields are not formatted at all, if level is disabled.
+    """
+
+    _LOGGING_KWARGS = ('exc_info', 'stack_info', 'stacklevel', 'extra')
+
+    def process(self, msg, kwargs):
+        fields = {}
+        for key in list(kwargs.keys()):
+            if key not in self._LOGGING_KWARGS:
+                fields[key] = kwargs.pop(key)
+        if len(fields) > 0:
+            extra = dict(kwargs.get('extra') or {})
+            extra['fields'] = fields
+            kwargs['extra'] = extra
+        return msg, kwargs
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most burst records with the same logger, level and message
+    template in each interval seconds. Number of suppressed records is added
+    as field 'suppressed' to the first record let through in the next interval.
+    """
+
+    def __init__(self, interval: float, burst: int, max_keys: int = 1000):
+        super(RateLimitFilter, self).__init__()
+        self.interval = interval
+        self.burst = burst
+        self._max_keys = max_keys
+        self._lock = threading.Lock()
+        self._windows = collections.OrderedDict()  # key => [window start, count, suppressed]
+        self.num_suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.interval <= 0:
+            return True
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if (window is None) or (now - window[0] >= self.interval):
+                suppressed = 0
+                if window is not None:
+                    suppressed = window[2]
+                self._windows[key] = [now, 1, 0]
+                self._windows.move_to_end(key)
+                if len(self._windows) > self._max_keys:
+                    self._windows.popitem(last=False)
+                if suppressed > 0:
+                    fields = dict(getattr(record, 'fields', None) or {})
+                    fields['suppressed'] = suppressed
+                    record.fields = fields
+                return True
+            window[1] += 1
+            if window[1] <= self.burst:
+                return True
+            window[2] += 1
+            self.num_suppressed += 1
+        return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler with a bounded queue: if log writer thread cannot keep up,
+    records are dropped (and counted) instead of blocking the caller
+    """
+
+    def __init__(self, q: queue.Queue):
+        super(DroppingQueueHandler, self).__init__(q)
+        self.num_dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.num_dropped += 1
+
+
+_lock = threading.Lock()
+_handler = None
+_listener = None
+_rate_filter = None
+_levels = {}  # component name => level name, set by configure()
+_traffic_logger = None
+_traffic_listener = None
+
+
+def setup(queue_size: int = 10000):
+    """
+    Starts log writer thread. Called once at startup, before anything is logged.
+    """
+    global _handler, _listener, _rate_filter
+    with _lock:
+        if _handler is not None:
+            return
+        fmt = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+        if os.environ.get('JOURNAL_STREAM', '') != '':
+            # running under systemd, journald adds its own timestamps
+            fmt = '%(levelname)-7s %(name)s: %(message)s'
+        output = logging.StreamHandler(sys.stderr)
+        output.setFormatter(KeyValueFormatter(fmt))
+        q = queue.Queue(maxsize=queue_size)
+        _rate_filter = RateLimitFilter(10.0, 5)
+        _handler = DroppingQueueHandler(q)
+        _handler.addFilter(_rate_filter)
+        root = logging.getLogger(LOGGER_NAME)
+        root.addHandler(_handler)
+        root.setLevel(logging.INFO)
+        root.propagate = False
+        _listener = logging.handlers.QueueListener(q, output)
+        _listener.start()
+
+
+def setup_traffic_log(filename: str, queue_size: int = 1000):
+    """
+    Starts writer thread for captured webhook traffic file (_cache/log_webhook.txt).
+    Separate from diagnostics log: no levels, no rate limits, entries are written as is.
+    """
+    global _traffic_logger, _traffic_listener
+    with _lock:
+        if _traffic_logger is not None:
+            return
+        output = logging.FileHandler(filename, mode='at', encoding='utf-8', delay=True)
+        output.terminator = ''
+        q = queue.Queue(maxsize=queue_size)
+        _traffic_logger = logging.getLogger(LOGGER_NAME + '_traffic')
+        _traffic_logger.addHandler(DroppingQueueHandler(q))
+        _traffic_logger.setLevel(logging.INFO)
+        _traffic_logger.propagate = False
+        _traffic_listener = logging.handlers.QueueListener(q, output)
+        _traffic_listener.start()
+
+
+def write_traffic(entry: str):
+    if _traffic_logger is not None:
+        _traffic_logger.info('%s', entry)
+
+
+def configure(config: dict):
+    """
+    Applies levels and rate limits from config. Can be called again at
+    runtime (on SIGHUP), components not mentioned in LOG_LEVELS anymore
+    return to the default level.
+    """
+    global _levels
+    with _lock:
+        logging.getLogger(LOGGER_NAME).setLevel(parse_level(config['LOG_LEVEL']))
+        for name in _levels:
+            if name not in config['LOG_LEVELS']:
+                logging.getLogger(LOGGER_NAME + '.' + name).setLevel(logging.NOTSET)
+        for name, level in config['LOG_LEVELS'].items():
+            logging.getLogger(LOGGER_NAME + '.' + name).setLevel(parse_level(level))
+        _levels = dict(config['LOG_LEVELS'])
+        if _rate_filter is not None:
+            _rate_filter.interval = config['LOG_RATE_LIMIT_INTERVAL']
+            _rate_filter.burst = config['LOG_RATE_LIMIT_BURST']
+
+
+def shutdown():
+    """
+    Writes out queued records and stops log writer thread
+    """
+    global _listener, _traffic_listener
+    with _lock:
+        if _traffic_listener is not None:
+            _traffic_listener.stop()
+            _traffic_listener = None
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def get_logger(name: str) -> KeyValueLogger:
+    return KeyValueLogger(logging.getLogger(LOGGER_NAME + '.' + name), {})
+
+
+def get_stats() -> dict:
+    return {
+        'level': logging.getLevelName(logging.getLogger(LOGGER_NAME).level).lower(),
+        'levels': dict(_levels),
+        'dropped': _handler.num_dropped if _handler is not None else 0,
+        'suppressed': _rate_filter.num_suppressed if _rate_filter is not None else 0
+    }
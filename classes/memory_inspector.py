@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Memory instrumentation for finding leaks in a running bot,
+# controlled from /admin/memory endpoint
+import gc
+import threading
+import tracemalloc
+import collections
+
+
+class MemoryInspector:
+    """
+    Starts/stops tracemalloc, keeps a few named snapshots and
+    reports top allocation sites and differences between snapshots.
+    tracemalloc slows down every allocation, so it is off by default
+    and is meant to be started only while hunting a leak.
+    """
+
+    MAX_SNAPSHOTS = 8
+    KEY_TYPES = ['lineno', 'filename', 'traceback']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshots = collections.OrderedDict()  # name => tracemalloc.Snapshot
+        self._num_snapshots = 0
+
+    def start(self, nframes: int = 1) -> bool:
+        """
+        :param nframes: number of stack frames to record for each allocation
+        :return: False if tracing was already started
+        """
+        if tracemalloc.is_tracing():
+            return False
+        tracemalloc.start(max(1, min(nframes, 50)))
+        return True
+
+    def stop(self) -> bool:
+        """
+        Stops tracing, taken snapshots are kept
+        """
+        if not tracemalloc.is_tracing():
+            return False
+        tracemalloc.stop()
+        return True
+
+    def get_status(self) -> dict:
+        ret = {
+            'tracing': tracemalloc.is_tracing(),
+            'traced_current': 0,
+            'traced_peak': 0,
+            'tracemalloc_overhead': tracemalloc.get_tracemalloc_memory(),
+            'rss': get_rss_bytes(),
+            'threads': threading.active_count(),
+            'gc_counts': list(gc.get_count())
+        }
+        if ret['tracing']:
+            ret['traced_current'], ret['traced_peak'] = tracemalloc.get_traced_memory()
+        with self._lock:
+            ret['snapshots'] = list(self._snapshots.keys())
+        return ret
+
+    def take_snapshot(self, name: str = '') -> str:
+        """
+        :param name: snapshot name, generated if empty
+        :return: name of taken snapshot
+        :raises ValueError: tracing is not started
+        """
+        snapshot = self._take_filtered_snapshot()
+        with self._lock:
+            self._num_snapshots += 1
+            if name == '':
+                name = 's{0}'.format(self._num_snapshots)
+            self._snapshots.pop(name, None)
+            self._snapshots[name] = snapshot
+            while len(self._snapshots) > self.MAX_SNAPSHOTS:
+                self._snapshots.popitem(last=False)
+        return name
+
+    def top(self, name: str = '', key_type: str = 'lineno', limit: int = 20) -> list:
+        """
+        Top allocation sites
+        :param name: snapshot name, or '' to take a fresh snapshot
+        :return: list of dicts
+        """
+        self._check_key_type(key_type)
+        snapshot = self._get_snapshot(name) if name != '' else self._take_filtered_snapshot()
+        return [self._format_stat(stat) for stat in snapshot.statistics(key_type)[:limit]]
+
+    def diff(self, name1: str, name2: str = '', key_type: str = 'lineno', limit: int = 20) -> list:
+        """
+        Allocation sites that grew most between two snapshots
+        :param name1: older snapshot name
+        :param name2: newer snapshot name, or '' to compare with a fresh snapshot
+        :return: list of dicts
+        """
+        self._check_key_type(key_type)
+        old = self._get_snapshot(name1)
+        new = self._get_snapshot(name2) if name2 != '' else self._take_filtered_snapshot()
+        stats = new.compare_to(old, key_type)
+        ret = []
+        for stat in stats[:limit]:
+            item = self._format_stat(stat)
+            item['size_diff'] = stat.size_diff
+            item['count_diff'] = stat.count_diff
+            ret.append(item)
+        return ret
+
+    @staticmethod
+    def get_type_counts(limit: int = 30) -> list:
+        """
+        Numbers of live objects tracked by gc, by type. Walks all objects, slow.
+        """
+        counter = collections.Counter(type(obj).__name__ for obj in gc.get_objects())
+        return [{'type': type_name, 'count': count} for type_name, count in counter.most_common(limit)]
+
+    def _check_key_type(self, key_type: str):
+        if key_type not in self.KEY_TYPES:
+            raise ValueError('key must be one of: {0}'.format(', '.join(self.KEY_TYPES)))
+
+    def _get_snapshot(self, name: str) -> tracemalloc.Snapshot:
+        with self._lock:
+            if name not in self._snapshots:
+                raise ValueError('No such snapshot: {0}'.format(name))
+            return self._snapshots[name]
+
+    @staticmethod
+    def _take_filtered_snapshot() -> tracemalloc.Snapshot:
+        if not tracemalloc.is_tracing():
+            raise ValueError('tracemalloc is not started')
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+            tracemalloc.Filter(False, '<unknown>')
+        ])
+
+    @staticmethod
+    def _format_stat(stat) -> dict:
+        return {
+            'size': stat.size,
+            'count': stat.count,
+            'traceback': ['{0}:{1}'.format(frame.filename, frame.lineno) for frame in stat.traceback]
+        }
+
+
+def get_rss_bytes() -> int:
+    """
+    :return: resident set size of this process, or 0 if unknown (not Linux)
+    """
+    try:
+        with open('/proc/self/status', mode='rt') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+# Durable outbox for broadcasts: every (chatroom, message) pair is a row
+# in sqlite database, delivered by a background worker with retries,
+# so Skype outages and bot restarts do not lose videos
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from classes import log
+
+logger = log.get_logger('outbox')
+
+
+class Outbox:
+    """
+    Broadcast of videos found in one twitter poll is a batch: a row in
+    batches table with tweet ids, and a row in messages table for each chatroom.
+    Message rows are 'pending' until Skype API accepts them ('sent'),
+    or until they fail permanently ('failed': 4xx response, or max_attempts
+    exhausted). Temporary failures (network, 5xx, 429, open circuit) are
+    retried with exponential backoff per message, so one broken chatroom
+    does not hold up the others.
+    When all messages of a batch are sent, on_batch_done(batch_id, tweet_ids)
+    is called: only then tweets count as posted. on_message_sent(batch_id, conversation)
+    is called after every delivered message.
+    Delivery is at-least-once: if the bot dies after Skype accepted
+    a message, but before it was marked sent, message is sent again after restart.
+    """
+
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+
+    PAGE_SIZE = 50
+
+    def __init__(self, filename: str, send_fn, max_attempts: int = 10, retry_delay: float = 10.0,
+                 max_retry_delay: float = 600.0, keep_days: float = 7.0):
+        """
+        :param send_fn: send_fn(conversation, message) -> HTTP status, or 0 if not sent
+        """
+        self.filename = filename
+        self._send_fn = send_fn
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.keep_days = keep_days
+        # callbacks, set by owner
+        self.on_batch_done = None
+        self.on_message_sent = None
+        self.is_active = None  # is_active() -> bool, worker delivers only if it returns True
+        self.is_recipient_valid = None  # is_recipient_valid(conversation) -> bool
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._busy = False
+        self._thread = None
+        self._db = None  # used only by worker thread
+        # statistics
+        self.num_sent = 0
+        self.num_retried = 0
+        self.num_failed = 0
+        self.num_batches_done = 0
+        # _cache/ is not in the repo: sqlite cannot create the file without its directory
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        db = self._connect()
+        try:
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS batches ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, tweet_ids TEXT NOT NULL, '
+                           'created_at REAL NOT NULL, done_at REAL)')
+                db.execute('CREATE TABLE IF NOT EXISTS messages ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, batch_id INTEGER NOT NULL, '
+                           'conversation TEXT NOT NULL, message TEXT NOT NULL, '
+                           'status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+                           'next_attempt_at REAL NOT NULL, last_error TEXT NOT NULL DEFAULT \'\')')
+                # worker only looks at due pending messages, this index keeps
+                # that query cheap however many sent messages are kept
+                db.execute('CREATE INDEX IF NOT EXISTS messages_due ON messages (status, next_attempt_at)')
+                db.execute('CREATE INDEX IF NOT EXISTS messages_batch ON messages (batch_id, status)')
+        finally:
+            db.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.filename, timeout=10.0, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        # in WAL mode a commit is not fsynced, but is still atomic: a crash
+        # can lose the last status updates (messages are resent), never corrupt the file
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def start(self):
+        self._thread = threading.Thread(target=self._worker_loop, name='OutboxWorker', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def wake_up(self):
+        """
+        Makes worker look for due messages right now (leadership acquired, chatrooms changed)
+        """
+        with self._cond:
+            self._cond.notify_all()
+
+    def enqueue_broadcast(self, tweet_ids: list, messages: dict) -> int:
+        """
+        Stores the batch durably, the worker will deliver it
+        :param tweet_ids: tweets, that count as posted when all messages are delivered
+        :param messages: chatroom => message text
+        :return: batch id
+        """
+        now = time.time()
+        db = self._connect()
+        try:
+            with db:
+                cur = db.execute('INSERT INTO batches (tweet_ids, created_at) VALUES (?, ?)',
+                                 (json.dumps(tweet_ids), now))
+                batch_id = cur.lastrowid
+                db.executemany('INSERT INTO messages (batch_id, conversation, message, status, next_attempt_at) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               [(batch_id, conv, message, self.STATUS_PENDING, now)
+                                for conv, message in messages.items()])
+        finally:
+            db.close()
+        logger.info('Broadcast queued', batch=batch_id, num_tweets=len(tweet_ids),
+                    num_chatrooms=len(messages))
+        with self._cond:
+            self._cond.notify_all()
+        return batch_id
+
+    def get_tweet_ids(self) -> set:
+        """
+        :return: ids of tweets in all kept batches (queued, being delivered or delivered)
+        """
+        ret = set()
+        db = self._connect()
+        try:
+            for row in db.execute('SELECT tweet_ids FROM batches'):
+                ret.update(json.loads(row[0]))
+        finally:
+            db.close()
+        return ret
+
+    def get_counts(self) -> dict:
+        """
+        :return: number of kept messages by status
+        """
+        ret = {self.STATUS_PENDING: 0, self.STATUS_SENT: 0, self.STATUS_FAILED: 0}
+        try:
+            db = self._connect()
+            try:
+                for status, count in db.execute('SELECT status, COUNT(*) FROM messages GROUP BY status'):
+                    ret[status] = count
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            logger.error('Outbox database error', error=e)
+        return ret
+
+    def wait_idle(self, timeout: float) -> bool:
+        """
+        Waits until there are no due pending messages (used when draining before exit)
+        :return: True if outbox became idle, False on timeout
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._cond:
+                if not self._busy and not self._has_due_messages():
+                    return True
+                self._cond.notify_all()
+            time.sleep(0.1)
+        return False
+
+    def _has_due_messages(self) -> bool:
+        db = self._connect()
+        try:
+            row = db.execute('SELECT 1 FROM messages WHERE status = ? AND next_attempt_at <= ? LIMIT 1',
+                             (self.STATUS_PENDING, time.time())).fetchone()
+        finally:
+            db.close()
+        return row is not None
+
+    def _worker_loop(self):
+        self._db = self._connect()
+        while True:
+            with self._cond:
+                if self._stopped:
+                    break
+                self._busy = False
+            delay = 1.0
+            try:
+                if (self.is_active is None) or self.is_active():
+                    delay = self._deliver_due()
+            except sqlite3.Error as e:
+                logger.error('Outbox database error', error=e)
+                delay = 5.0
+            except Exception as e:
+                # a failing callback must not kill the worker: nothing would be delivered anymore
+                logger.error('Outbox delivery failed', error=e)
+                delay = 5.0
+            if delay <= 0:
+                continue
+            with self._cond:
+                if not self._stopped:
+                    self._cond.wait(min(delay, 30.0))
+        self._db.close()
+        self._db = None
+
+    def _deliver_due(self) -> float:
+        """
+        Delivers one page of due messages
+        :return: seconds until next message is due, 0 if there may be more due right now
+        """
+        # batches without chatrooms, and batches whose completion was interrupted by a restart
+        self._complete_batches()
+        now = time.time()
+        rows = self._db.execute('SELECT id, batch_id, conversation, message, attempts FROM messages '
+                                'WHERE status = ? AND next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT ?',
+                                (self.STATUS_PENDING, now, self.PAGE_SIZE)).fetchall()
+        if len(rows) == 0:
+            row = self._db.execute('SELECT MIN(next_attempt_at) FROM messages WHERE status = ?',
+                                   (self.STATUS_PENDING,)).fetchone()
+            if row[0] is None:
+                return 30.0
+            return max(0.1, row[0] - now)
+        with self._cond:
+            self._busy = True
+        for msg_id, batch_id, conversation, message, attempts in rows:
+            if self._stopped or ((self.is_active is not None) and not self.is_active()):
+                break
+            self._deliver_one(msg_id, batch_id, conversation, message, attempts)
+        self._complete_batches()
+        return 0 if len(rows) == self.PAGE_SIZE else 0.1
+
+    def _deliver_one(self, msg_id: int, batch_id: int, conversation: str, message: str, attempts: int):
+        if (self.is_recipient_valid is not None) and not self.is_recipient_valid(conversation):
+            # bot was removed from chatroom after message was queued: nobody to deliver to
+            self._set_status(msg_id, self.STATUS_SENT, attempts, 0, 'chatroom left')
+            return
+        attempts += 1
+        status = self._send_fn(conversation, message)
+        if status == 201:
+            self.num_sent += 1
+            self._set_status(msg_id, self.STATUS_SENT, attempts, 0, '')
+            if self.on_message_sent is not None:
+                try:
+                    self.on_message_sent(batch_id, conversation)
+                except Exception as e:
+                    logger.error('Outbox message callback failed', batch=batch_id, error=e)
+        elif ((status == 0) or (status == 429) or (status >= 500)) and (attempts < self.max_attempts):
+            self.num_retried += 1
+            delay = min(self.max_retry_delay, self.retry_delay * (2 ** (attempts - 1)))
+            self._set_status(msg_id, self.STATUS_PENDING, attempts, time.time() + delay,
+                             'HTTP status {0}'.format(status) if status != 0 else 'not sent')
+        else:
+            self.num_failed += 1
+            logger.error('Message delivery failed permanently', to=conversation,
+                         status=status, attempts=attempts)
+            self._set_status(msg_id, self.STATUS_FAILED, attempts, 0,
+                             'HTTP status {0}'.format(status) if status != 0 else 'not sent')
+
+    def _set_status(self, msg_id: int, status: str, attempts: int, next_attempt_at: float, error: str):
+        with self._db:
+            self._db.execute('UPDATE messages SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? '
+                             'WHERE id = ?', (status, attempts, next_attempt_at, error, msg_id))
+
+    def _complete_batches(self):
+        rows = self._db.execute('SELECT id FROM batches WHERE done_at IS NULL AND NOT EXISTS '
+                                '(SELECT 1 FROM messages WHERE messages.batch_id = batches.id '
+                                'AND messages.status != ?)', (self.STATUS_SENT,)).fetchall()
+        for row in rows:
+            self._complete_batch(row[0])
+
+    def _complete_batch(self, batch_id: int):
+        now = time.time()
+        with self._db:
+            cur = self._db.execute('UPDATE batches SET done_at = ? WHERE id = ? AND done_at IS NULL',
+                                   (now, batch_id))
+        if cur.rowcount != 1:
+            return
+        row = self._db.execute('SELECT tweet_ids FROM batches WHERE id = ?', (batch_id,)).fetchone()
+        tweet_ids = json.loads(row[0])
+        self.num_batches_done += 1
+        logger.info('Broadcast delivered', batch=batch_id, num_tweets=len(tweet_ids))
+        if self.on_batch_done is not None:
+            try:
+                self.on_batch_done(batch_id, tweet_ids)
+            except Exception as e:
+                logger.error('Outbox batch callback failed', batch=batch_id, error=e)
+        self._purge(now)
+
+    def _purge(self, now: float):
+        # posted tweets list remembers delivered tweets, outbox does not need them forever;
+        # batches with failed messages are kept for keep_days too, to be seen on status page
+        before = now - self.keep_days * 86400
+        with self._db:
+            self._db.execute('DELETE FROM messages WHERE batch_id IN (SELECT id FROM batches '
+                             'WHERE created_at < ? AND NOT EXISTS (SELECT 1 FROM messages AS m '
+                             'WHERE m.batch_id = batches.id AND m.status = ?))', (before, self.STATUS_PENDING))
+            self._db.execute('DELETE FROM batches WHERE created_at < ? AND NOT EXISTS '
+                             '(SELECT 1 FROM messages WHERE messages.batch_id = batches.id)', (before,))
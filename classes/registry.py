@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from classes import log
+
+logger = log.get_logger('registry')
+
+
+class CopyOnWriteRegistry:
+    """
+    Dict-like collection for data that is read often and changed rarely
+    (bot's contacts, chatrooms the bot is in).
+    Contents are kept in a dict, that is never modified after it was published:
+    writers build a changed copy under a lock and replace the reference.
+    So readers need no locks at all, and a reader that took a snapshot
+    iterates it consistently, even if registry is changed meanwhile.
+    Lookups by key are O(1), iteration order is insertion order.
+    Subscribers are called after every change as callback(registry, action, key, value),
+    where action is one of ACTION_*.
+    """
+
+    ACTION_ADD = 'add'
+    ACTION_UPDATE = 'update'
+    ACTION_REMOVE = 'remove'
+    ACTION_RESET = 'reset'
+
+    def __init__(self, name: str):
+        self.name = name
+        self._items = {}
+        self._write_lock = threading.Lock()
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        with self._write_lock:
+            self._subscribers = self._subscribers + [callback]
+
+    def snapshot(self) -> dict:
+        """
+        :return: current contents, must not be modified by caller
+        """
+        return self._items
+
+    def get(self, key, default=None):
+        return self._items.get(key, default)
+
+    def keys(self) -> list:
+        return list(self._items.keys())
+
+    def values(self) -> list:
+        return list(self._items.values())
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def set(self, key, value) -> bool:
+        """
+        Adds or replaces item
+        :return: True if registry was changed
+        """
+        with self._write_lock:
+            old_items = self._items
+            if (key in old_items) and (old_items[key] == value):
+                return False
+            action = self.ACTION_UPDATE if key in old_items else self.ACTION_ADD
+            items = dict(old_items)
+            items[key] = value
+            self._items = items
+        self._notify(action, key, value)
+        return True
+
+    def add(self, key, value) -> bool:
+        """
+        Adds item only if key is not present yet
+        :return: True if item was added
+        """
+        with self._write_lock:
+            if key in self._items:
+                return False
+            items = dict(self._items)
+            items[key] = value
+            self._items = items
+        self._notify(self.ACTION_ADD, key, value)
+        return True
+
+    def remove(self, key) -> bool:
+        """
+        :return: True if item was present and is removed
+        """
+        with self._write_lock:
+            if key not in self._items:
+                return False
+            items = dict(self._items)
+            value = items.pop(key)
+            self._items = items
+        self._notify(self.ACTION_REMOVE, key, value)
+        return True
+
+    def reset(self, items: dict, notify: bool = True):
+        """
+        Replaces all contents, used when loading saved state
+        """
+        with self._write_lock:
+            self._items = dict(items)
+        if notify:
+            self._notify(self.ACTION_RESET, None, None)
+
+    def _notify(self, action: str, key, value):
+        for callback in self._subscribers:
+            try:
+                callback(self, action, key, value)
+            except Exception as e:
+                logger.error('Registry subscriber failed', registry=self.name, error=e)
@@ -1,9 +1,20 @@
-import sys
+import io
 import http.server
+import socket
 import ssl
 import json
+import hmac
+import time
+import urllib.parse
 
 from classes.template_engine import TemplateEngine
+from classes.jwt_validator import JwtError
+from classes import load_shedder
+from classes import webhook_archive
+from classes import log
+
+logger = log.get_logger('http')
+access_logger = log.get_logger('http.access')
 
 
 # HTTP Request handler. New object is created for each new request
@@ -21,6 +32,8 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
         self.content_type = ''
         self.request_method = ''
         self.routes = {}
+        self.query = {}  # query string parameters
+        self.num_requests = 0  # requests served on this connection
         # setup() is called in superclass's __init__()
         # so, we need variable decalrations to be placed before super.__init__() call
         super(MovieBotRequestHandler, self).__init__(request, client_address, server)
@@ -39,9 +52,143 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
             '/': self.handle_webroot,
             '/status': self.handle_status,
             '/request_shutdown': self.handle_shutdown,
-            '/webhook_chat': self.handle_webhook_chat
+            '/webhook_chat': self.handle_webhook_chat,
+            '/admin/memory': self.handle_admin_memory,
+            '/metrics': self.handle_metrics,
+            '/healthz': self.handle_healthz,
+            '/readyz': self.handle_readyz,
+            '/status.json': self.handle_status_json,
+            '/admin/webhooks': self.handle_admin_webhooks
+        }
+        # under overload routes are shed from the lowest priority;
+        # routes not listed here, static files and unknown paths are low
+        self.route_priorities = {
+            '/webhook_chat': load_shedder.PRIORITY_HIGH,
+            # shed probe would fail it and get a busy bot restarted or taken out of rotation
+            '/healthz': load_shedder.PRIORITY_HIGH,
+            '/readyz': load_shedder.PRIORITY_HIGH,
+            '/admin/memory': load_shedder.PRIORITY_NORMAL,
+            '/metrics': load_shedder.PRIORITY_NORMAL,
+            '/status.json': load_shedder.PRIORITY_NORMAL,
+            '/admin/webhooks': load_shedder.PRIORITY_NORMAL
         }
 
+    def finish(self):
+        try:
+            super(MovieBotRequestHandler, self).finish()
+        finally:
+            self.server.connections.forget(self)
+
+    # Overrides BaseHTTPRequestHandler.log_message(), which writes to stderr
+    # directly from request handler thread
+    def log_message(self, format, *args):
+        access_logger.info(format % args, client=self.address_string())
+
+    def handle_one_request(self):
+        """
+        Same as BaseHTTPRequestHandler.handle_one_request(), but every
+        connection phase has its own deadline: waiting for the next request
+        on a kept-alive connection, reading request headers. Body is read
+        by handlers with read_request_body(). Also limits number of
+        requests per connection.
+        """
+        conn = self.server.connections
+        if self.num_requests > 0:
+            conn.set_deadline(self, conn.RULE_IDLE_TIMEOUT)
+        else:
+            conn.set_deadline(self, conn.RULE_HEADER_TIMEOUT)
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+            if len(self.raw_requestline) > 65536:
+                self.requestline = ''
+                self.request_version = ''
+                self.command = ''
+                self.send_error(414)  # URI Too Long
+                return
+            if not self.raw_requestline:
+                self.close_connection = True
+                return
+            # first line is here, the rest of headers must arrive in time
+            conn.set_deadline(self, conn.RULE_HEADER_TIMEOUT)
+            if not self.parse_request():
+                return
+            conn.clear_deadline(self)
+            # writing response to a client, that does not read it, must not hang forever
+            self.connection.settimeout(conn.body_timeout)
+            self.num_requests += 1
+            if (conn.max_requests > 0) and (self.num_requests >= conn.max_requests) \
+                    and not self.close_connection:
+                conn.count_closed(conn.RULE_MAX_REQUESTS)
+                self.close_connection = True
+            mname = 'do_' + self.command
+            if not hasattr(self, mname):
+                self.send_error(501, 'Unsupported method ({0})'.format(self.command))
+                return
+            method = getattr(self, mname)
+            route, priority = self.classify_request()
+            shedder = self.server.load_shedder
+            if not shedder.try_begin(route, priority):
+                self._503_overloaded()
+                return
+            try:
+                method()
+            finally:
+                shedder.end()
+            if conn.is_expired(self):
+                self.close_connection = True
+                return
+            self.wfile.flush()  # actually send the response if not already done.
+        except (socket.timeout, OSError) as e:
+            # socket.timeout: no data in time; OSError: watchdog has shut down socket
+            rule = conn.get_current_rule(self)
+            if rule != '':
+                conn.expire(self, rule)
+            elif not conn.is_expired(self):
+                raise
+            self.close_connection = True
+
+    def read_request_body(self, content_length: int) -> bytes:
+        """
+        Reads request body, no longer than body timeout allows
+        :param content_length: number of bytes to read
+        :return: bytes read
+        """
+        conn = self.server.connections
+        conn.set_deadline(self, conn.RULE_BODY_TIMEOUT)
+        try:
+            data = self.rfile.read(content_length)
+        except OSError:
+            # do not reply to a partially received request
+            if conn.expire(self, conn.RULE_BODY_TIMEOUT):
+                try:
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            raise
+        conn.clear_deadline(self)
+        if conn.is_expired(self):
+            raise socket.timeout('request body was not received in time')
+        # restore write timeout
+        self.connection.settimeout(conn.body_timeout)
+        return data
+
+    def classify_request(self) -> tuple:
+        """
+        :return: (route name for statistics, priority); scanners' random paths
+                 are all counted as 'other', so that statistics do not grow
+        """
+        path = urllib.parse.urlsplit(self.path).path
+        if path in self.routes:
+            return path, self.route_priorities.get(path, load_shedder.PRIORITY_LOW)
+        if path == '/favicon.ico':
+            return path, load_shedder.PRIORITY_LOW
+        return 'other', load_shedder.PRIORITY_LOW
+
+    def should_close_connection(self) -> bool:
+        if self.server.user_shutdown_request or self.server.is_shutting_down():
+            return True
+        return self.close_connection
+
     # factory method to create template engine and assign default variables to it
     def create_template_engine(self) -> TemplateEngine:
         tmpl = TemplateEngine(self.server.get_template_engine_config())
@@ -69,12 +216,14 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
         self._404_not_found()
 
     def route_request(self):
-        if self.path in self.routes:
-            handler_function = self.routes[self.path]
+        url = urllib.parse.urlsplit(self.path)
+        self.query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path in self.routes:
+            handler_function = self.routes[url.path]
             # print('Found handler, calling', str(handler_function))
             ret = handler_function()
             return ret
-        print('Cannot find handler for url: ' + str(self.path))
+        logger.info('Cannot find handler for url', path=self.path)
         return False
 
     # return False if not static file was requested (guess by file name/ext)
@@ -97,7 +246,7 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
             self.send_response(200)
             self.send_header('Content-Type', self.content_type)
             self.send_header('Content-Length', len(contents))
-            if self.server.user_shutdown_request or self.server.is_shutting_down():
+            if self.should_close_connection():
                 self.send_header('Connection', 'close')
             self.end_headers()
             self.wfile.write(contents)
@@ -120,7 +269,7 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
         self.send_response(200)
         self.send_header('Content-Type', self.content_type)
         self.send_header('Content-Length', len(html_enc))
-        if self.server.user_shutdown_request or self.server.is_shutting_down():
+        if self.should_close_connection():
             self.send_header('Connection', 'close')
         self.end_headers()
         self.wfile.write(html_enc)
@@ -138,6 +287,28 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
         self.wfile.write(message_enc)
         self.wfile.flush()
 
+    def _503_overloaded(self):
+        # as cheap as possible: no body, no access log line, request body
+        # is not read, so connection is closed, which also frees the thread
+        self.close_connection = True
+        self.send_response_only(503)  # Service Unavailable
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', '0')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.flush()
+
+    def _precomputed_response(self, status: int, body: bytes, content_type: str):
+        # for frequent probes: no access log line, headers only from constants
+        self.send_response_only(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        if self.should_close_connection():
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
     def _301_redirect(self, location: str, content: str=None):
         message = content
         if message is None:
@@ -148,17 +319,47 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
         self.send_header('Location', str(location))
         self.send_header('Content-Type', self.content_type)
         self.send_header('Content-Length', len(message_enc))
-        if self.server.user_shutdown_request or self.server.is_shutting_down():
+        if self.should_close_connection():
             self.send_header('Connection', 'close')
         self.end_headers()
         self.wfile.write(message_enc)
 
+    def _json_response(self, status: int, obj):
+        body = json.dumps(obj, indent=4).encode(encoding='utf-8')
+        self.content_type = 'application/json; charset=utf-8'
+        self.send_response(status)
+        self.send_header('Content-Type', self.content_type)
+        self.send_header('Content-Length', len(body))
+        self.send_header('Cache-Control', 'no-store')
+        if self.should_close_connection():
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def check_admin_auth(self) -> bool:
+        """
+        Admin endpoints require header "Authorization: Bearer <token>",
+        token is set in [admin] section of config. No token - no admin endpoints.
+        Sends error response itself, if access is denied.
+        """
+        token = self.server.config['ADMIN_TOKEN']
+        if token == '':
+            self._json_response(404, {'error': 'admin endpoints are disabled'})
+            return False
+        auth = self.headers.get('Authorization', '')
+        if not auth.startswith('Bearer ') or \
+                not hmac.compare_digest(auth[7:].strip().encode('utf-8'), token.encode('utf-8')):
+            logger.warning('Admin access denied', client=self.client_address[0], path=self.path)
+            self._json_response(403, {'error': 'access denied'})
+            return False
+        return True
+
     def _201_created(self):
         self.content_type = 'application/json; charset=utf-8'
         self.send_response(201)  # created
         self.send_header('Content-Type', self.content_type)
         self.send_header('Content-Length', 0)
-        if self.server.user_shutdown_request or self.server.is_shutting_down():
+        if self.should_close_connection():
             self.send_header('Connection', 'close')
         self.end_headers()
 
@@ -174,6 +375,144 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
         self.serve_html('shutdown.html')
         return True
 
+    def handle_admin_memory(self):
+        """
+        /admin/memory?action=...
+          status (default)          tracing state, RSS, threads, snapshot names
+          sizes                     sizes of bot's own structures
+          types&limit=N             numbers of live objects by type
+          top&name=S&key=K&limit=N  top allocation sites (fresh snapshot if no name)
+          diff&name=S1&name2=S2     growth between snapshots (S2 is fresh if not given)
+        POST only:
+          start&nframes=N           start tracemalloc
+          stop                      stop tracemalloc
+          snapshot&name=S           take and keep snapshot
+        """
+        if not self.check_admin_auth():
+            return True
+        memory = self.server.memory
+        action = self.query.get('action', 'status')
+        key_type = self.query.get('key', 'lineno')
+        name = self.query.get('name', '')
+        try:
+            limit = int(self.query.get('limit', '20'))
+            if (action in ['start', 'stop', 'snapshot']) and (self.request_method != 'POST'):
+                self._json_response(405, {'error': 'use POST for action ' + action})
+                return True
+            if action == 'status':
+                result = memory.get_status()
+            elif action == 'sizes':
+                result = self.server.get_memory_sizes()
+            elif action == 'types':
+                result = memory.get_type_counts(limit)
+            elif action == 'top':
+                result = memory.top(name, key_type, limit)
+            elif action == 'diff':
+                result = memory.diff(name, self.query.get('name2', ''), key_type, limit)
+            elif action == 'start':
+                result = {'started': memory.start(int(self.query.get('nframes', '1')))}
+            elif action == 'stop':
+                result = {'stopped': memory.stop()}
+            elif action == 'snapshot':
+                result = {'name': memory.take_snapshot(name)}
+            else:
+                self._json_response(400, {'error': 'unknown action: ' + action})
+                return True
+        except ValueError as ve:
+            self._json_response(400, {'error': str(ve)})
+            return True
+        logger.info('Admin memory action', action=action, client=self.client_address[0])
+        self._json_response(200, result)
+        return True
+
+    def handle_admin_webhooks(self):
+        """
+        /admin/webhooks?since=T&until=T&conversation=C&sender=S&activity=A&limit=N
+        Archived webhook deliveries, oldest first, streamed as JSON lines
+        {"time": ..., "headers": {...}, "body": "..."}. Times are unix time,
+        ISO UTC, or relative: -15m, -2h, -1d. Only archive blocks, whose
+        index can match, are read; header X-Archive-Blocks: read/total.
+        """
+        if not self.check_admin_auth():
+            return True
+        archive = self.server.webhook_archive
+        if archive is None:
+            self._json_response(404, {'error': 'webhook archive is disabled'})
+            return True
+        try:
+            q = webhook_archive.ArchiveQuery(
+                since=webhook_archive.parse_time(self.query.get('since', '-1h')),
+                until=webhook_archive.parse_time(self.query.get('until', '')),
+                conversation=self.query.get('conversation'),
+                sender=self.query.get('sender'),
+                activity=self.query.get('activity'),
+                limit=int(self.query.get('limit', '1000')))
+        except ValueError as ve:
+            self._json_response(400, {'error': str(ve)})
+            return True
+        t0 = time.monotonic()
+        result = archive.query(q)
+        # results are not counted in advance: body ends when connection is closed
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('X-Archive-Segments', '{0}/{1}'.format(len(result.plan), result.num_segments))
+        self.send_header('X-Archive-Blocks', '{0}/{1}'.format(result.num_read_blocks, result.num_blocks))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for record in result:
+            self.wfile.write((record.to_json_line() + '\n').encode('utf-8'))
+        logger.info('Admin webhooks query', client=self.client_address[0], matched=result.num_matched,
+                    read_records=result.num_read_records, read_blocks=result.num_read_blocks,
+                    blocks=result.num_blocks, ms=int((time.monotonic() - t0) * 1000))
+        return True
+
+    def handle_healthz(self):
+        """
+        Liveness: 200 'ok', while the bot runs and its status is refreshed
+        """
+        status, body = self.server.health.get_healthz()
+        self._precomputed_response(status, body, 'text/plain; charset=utf-8')
+        return True
+
+    def handle_readyz(self):
+        """
+        Readiness: 200 'ready', or 503 'not ready: <failed checks>'
+        """
+        status, body = self.server.health.get_readyz()
+        self._precomputed_response(status, body, 'text/plain; charset=utf-8')
+        return True
+
+    def handle_status_json(self):
+        """
+        Status snapshot, refreshed in background every [health] refresh_interval;
+        503 if not ready
+        """
+        status, body = self.server.health.status_json
+        self._precomputed_response(status, body, 'application/json; charset=utf-8')
+        return True
+
+    def handle_metrics(self):
+        """
+        Freshness histograms and shed requests counters in Prometheus text format, for scraping.
+        Requires admin token, as chatroom ids are in labels.
+        """
+        if not self.check_admin_auth():
+            return True
+        body = (self.server.freshness.format_metrics() +
+                self.server.load_shedder.format_metrics()).encode(encoding='utf-8')
+        self.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        self.send_response(200)
+        self.send_header('Content-Type', self.content_type)
+        self.send_header('Content-Length', len(body))
+        self.send_header('Cache-Control', 'no-store')
+        if self.should_close_connection():
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+        return True
+
     def handle_webhook_chat(self):
         """
         Outgoing webhooks are how Bots get notifications about new messages
@@ -200,7 +539,7 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
         :return:
         """
         if self.request_method != 'POST':
-            sys.stderr.write('Webhook called not with POST method!\n')
+            logger.warning('Webhook called not with POST method', method=self.request_method)
             self.send_response(405)  # Method Not Allowed
             self.send_header('Content-Type', 'application/json; charset=utf-8')
             self.send_header('Content-Length', '0')
@@ -208,6 +547,20 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
             self.end_headers()
             return True
         #
+        # drop forged requests before reading and logging their body
+        if self.server.jwt_validator is not None:
+            try:
+                self.server.jwt_validator.validate_header(self.headers.get('Authorization', ''))
+            except JwtError as je:
+                logger.warning('Webhook token rejected', client=self.client_address[0], reason=je)
+                self.close_connection = True  # body is not read
+                self.send_response(403)  # 403 Forbidden
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', '0')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                return True
+        #
         # also we should check peer certificate here
         # it should be issued to skype.com :)
         if self.server.config['VALIDATE_PEER_CERT']:
@@ -215,7 +568,7 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
             if isinstance(self.request, ssl.SSLSocket):
                 cert = self.request.getpeercert()
                 if cert is None:  # no certificate was provided
-                    sys.stderr.write('Webhook access without a certificate! Deny!\n')
+                    logger.warning('Webhook access without a certificate, deny')
                     self.send_response(403)  # 403 Forbidden
                     self.send_header('Content-Type', 'application/json; charset=utf-8')
                     self.send_header('Content-Length', '0')
@@ -225,25 +578,28 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
                 if type(cert) == dict:
                     # If the certificate was not validated, the dict is empty
                     if len(cert) == 0:
-                        sys.stderr.write('Webhook access with an invalid certificate! Deny!\n')
+                        logger.warning('Webhook access with an invalid certificate, deny')
                         self.send_response(403)  # 403 Forbidden
                         self.send_header('Content-Type', 'application/json; charset=utf-8')
                         self.send_header('Content-Length', '0')
                         self.send_header('Connection', 'close')
                         self.end_headers()
                         return True
-                print(cert)  # lol
+                logger.debug('Webhook peer certificate', cert=cert)
             else:
-                sys.stderr.write('Something is strange, self.rwquest is not an SSL Socket?!\n')
+                logger.error('Something is strange, self.request is not an SSL Socket')
         #
         postdata_str = ''
         json_object = None
         #
-        # first of all I want to log all requests
-        with open('_cache/log_webhook.txt', mode='at', encoding='utf-8') as f:
+        # first of all I want to log all requests. Log entry is built in memory,
+        # and written to _cache/log_webhook.txt by log writer thread
+        with io.StringIO() as f:
             f.write('headers:\n')
             for hh1 in self.headers.keys():
-                f.write('{0}: {1}\n'.format(hh1, self.headers[hh1]))
+                # bearer tokens must not be kept on disk
+                value = '<redacted>' if hh1.lower() == 'authorization' else self.headers[hh1]
+                f.write('{0}: {1}\n'.format(hh1, value))
             f.write('\n')
             #
             content_length = -1
@@ -258,15 +614,14 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
             else:
                 bytes_object = b''  # empty bytes array
                 try:
-                    bytes_object = self.rfile.read(content_length)
+                    bytes_object = self.read_request_body(content_length)
                     if type(bytes_object) == bytes:
                         postdata_str = bytes_object.decode(encoding='utf-8', errors='strict')
                         # try to parse JSON here
                         try:
-                            json_object = json.loads(postdata_str, encoding='utf-8')
+                            json_object = json.loads(postdata_str)
                         except json.JSONDecodeError as jde:
-                            sys.stderr.write('Failed to decode JSON in POST data:\n')
-                            sys.stderr.write(str(jde) + '\n')
+                            logger.warning('Failed to decode JSON in POST data', error=jde)
                             json_object = None
                         # finally log what skype server has sent us
                         # if it is not JSON, log simple string
@@ -285,6 +640,9 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
                     f.write('POST data cannot be represented as string, showing raw bytes:\n')
                     f.write('<' + str(bytes_object) + '>\n')
             f.write('--------------------------------------------------\n')
+            log.write_traffic(f.getvalue())
+        if (postdata_str != '') and (self.server.webhook_archive is not None):
+            self.server.webhook_archive.append(dict(self.headers), postdata_str, time.time())
         #
         # after loggigng, process the request
         if (postdata_str != '') and (json_object is not None):
@@ -295,12 +653,18 @@ class MovieBotRequestHandler(http.server.BaseHTTPRequestHandler):
             if type(json_object) == dict:
                 json_object = [json_object]
             if type(json_object) == list:
-                for event_dict in json_object:
-                    self.server.skype.handle_webhook_event(event_dict)
+                # apply all events of delivery to memory, then save state once
+                with self.server.skype.savedata_flusher.batch():
+                    for event_dict in json_object:
+                        if type(event_dict) != dict:
+                            continue
+                        if not self.server.is_new_delivery(event_dict):
+                            logger.info('Dropping duplicate webhook delivery', id=event_dict.get('id', ''))
+                            continue
+                        self.server.skype.handle_webhook_event(event_dict)
             else:
                 # unexpected type for a json object received! it should be a list (JSON Array)
-                sys.stderr.write('Unexpected type on JSON object was received: ' +
-                                 str(type(json_object)))
+                logger.warning('Unexpected type of JSON object was received', type=type(json_object))
         #
         # default reply to skype API server - 201 Created.
         # This indicates that callback URL was successfully executed
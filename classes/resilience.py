@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Timeouts, circuit breakers and bulkheads for external services
+# (Skype API, Microsoft OAuth, Twitter, nicovideo, Yandex translate)
+import time
+import threading
+
+from classes import log
+
+logger = log.get_logger('resilience')
+
+
+class DependencyError(Exception):
+    pass
+
+
+class CircuitOpenError(DependencyError):
+    pass
+
+
+class BulkheadFullError(DependencyError):
+    pass
+
+
+class UpstreamError(DependencyError):
+    def __init__(self, message: str, status_code: int = 0):
+        super(UpstreamError, self).__init__(message)
+        self.status_code = status_code
+
+
+def check_http_status(r):
+    """
+    result_check for requests responses: 5xx and 429 mean that
+    upstream is in trouble, count them as failures
+    """
+    if (r.status_code >= 500) or (r.status_code == 429):
+        raise UpstreamError('HTTP status {0}'.format(r.status_code), r.status_code)
+    return r
+
+
+class CircuitBreaker:
+    """
+    closed: calls go through, failures in a row are counted;
+    open: after failure_threshold failures in a row, calls fail immediately;
+    half-open: after reset_timeout one trial call is let through,
+               its success closes the circuit, failure opens it again.
+    """
+
+    STATE_CLOSED = 'closed'
+    STATE_OPEN = 'open'
+    STATE_HALF_OPEN = 'half-open'
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = self.STATE_CLOSED
+        self.failures_in_row = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.STATE_CLOSED:
+                return True
+            if self.state == self.STATE_OPEN:
+                if time.monotonic() - self.opened_at < self._reset_timeout:
+                    return False
+                self.state = self.STATE_HALF_OPEN
+                self._trial_running = False
+            # half-open: only one trial call at a time
+            if self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def cancel_trial(self):
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.STATE_CLOSED
+            self.failures_in_row = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures_in_row += 1
+            self._trial_running = False
+            if (self.state == self.STATE_HALF_OPEN) or \
+                    (self.failures_in_row >= self._failure_threshold):
+                if self.state != self.STATE_OPEN:
+                    logger.warning('Circuit opened', dependency=self.name,
+                                   failures=self.failures_in_row)
+                self.state = self.STATE_OPEN
+                self.opened_at = time.monotonic()
+
+
+class Dependency:
+    """
+    External service: per-call timeout (callers pass dependency.timeout
+    to network calls), circuit breaker and a bulkhead - limit of concurrent
+    calls, so that one slow service cannot take all request handler threads.
+    """
+
+    def __init__(self, name: str, timeout: float, max_concurrent: int,
+                 failure_threshold: int, reset_timeout: float, queue_timeout: float):
+        self.name = name
+        self.timeout = timeout
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self._bulkhead = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        # statistics
+        self.num_calls = 0
+        self.num_failures = 0
+        self.num_rejected_open = 0
+        self.num_rejected_full = 0
+        self.num_active = 0
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Calls fn(*args, **kwargs) through circuit breaker and bulkhead.
+        Optional keyword argument result_check is a function, that receives
+        fn's result and raises (UpstreamError) if the result means failure.
+        :raises CircuitOpenError, BulkheadFullError: call was not made
+        :return: whatever fn returns
+        """
+        result_check = kwargs.pop('result_check', None)
+        if not self.breaker.allow():
+            with self._lock:
+                self.num_rejected_open += 1
+            raise CircuitOpenError('{0}: circuit is open'.format(self.name))
+        if not self._bulkhead.acquire(timeout=self.queue_timeout):
+            # we did not make a call, so let half-open breaker try again later
+            self.breaker.cancel_trial()
+            with self._lock:
+                self.num_rejected_full += 1
+            raise BulkheadFullError('{0}: too many concurrent calls'.format(self.name))
+        with self._lock:
+            self.num_calls += 1
+            self.num_active += 1
+        try:
+            result = fn(*args, **kwargs)
+            if result_check is not None:
+                result = result_check(result)
+        except Exception:
+            with self._lock:
+                self.num_failures += 1
+            self.breaker.record_failure()
+            raise
+        finally:
+            with self._lock:
+                self.num_active -= 1
+            self._bulkhead.release()
+        self.breaker.record_success()
+        return result
+
+    def get_stats(self) -> dict:
+        return {
+            'name': self.name,
+            'state': self.breaker.state,
+            'calls': self.num_calls,
+            'failures': self.num_failures,
+            'rejected_open': self.num_rejected_open,
+            'rejected_full': self.num_rejected_full,
+            'active': self.num_active,
+            'max_concurrent': self.max_concurrent
+        }
+
+
+# default settings, can be overridden in config section [resilience]
+# with keys like twitter_timeout, skype_max_concurrent
+_DEFAULTS = {
+    'timeout': 10.0,
+    'max_concurrent': 4,
+    'failure_threshold': 5,
+    'reset_timeout': 30.0,
+    'queue_timeout': 2.0
+}
+_DEPENDENCY_DEFAULTS = {
+    'twitter': {'timeout': 15.0, 'max_concurrent': 1, 'queue_timeout': 1.0},
+    'oauth': {'max_concurrent': 1},
+    'nicovideo': {'timeout': 5.0},
+    'openid': {'timeout': 5.0, 'max_concurrent': 1},
+    'members': {'timeout': 5.0, 'max_concurrent': 1}
+}
+
+_config = {}
+_dependencies = {}
+_lock = threading.Lock()
+
+
+def configure(config: dict):
+    global _config
+    _config = config
+
+
+def get_dependency(name: str) -> Dependency:
+    with _lock:
+        if name not in _dependencies:
+            params = dict(_DEFAULTS)
+            params.update(_DEPENDENCY_DEFAULTS.get(name, {}))
+            for param in params:
+                key = 'DEP_{0}_{1}'.format(name.upper(), param.upper())
+                if key in _config:
+                    params[param] = _config[key]
+            _dependencies[name] = Dependency(name, **params)
+        return _dependencies[name]
+
+
+def get_all_dependencies() -> list:
+    with _lock:
+        return [_dependencies[name] for name in sorted(_dependencies)]
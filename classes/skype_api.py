@@ -1,13 +1,25 @@
-import sys
+import os
 import json
+import time
 import datetime
 import re
 import threading
 
 import requests
+import requests.exceptions
 
 from classes.auth_service import AuthService
+from classes import resilience
+from classes.command_router import CommandRouter, CommandContext
+from classes.throttle import InboundThrottle
+from classes.registry import CopyOnWriteRegistry
+from classes.subscriptions import Subscriptions
+from classes.flusher import DebouncedFlusher
+from classes.display_names import DisplayNameResolver
 from classes import utils
+from classes import log
+
+logger = log.get_logger('skype')
 
 
 class SkypeApi:
@@ -21,13 +33,28 @@ class SkypeApi:
         self.config = config
         self.token = ''
         self.authservice = AuthService(config)
-        self.contact_list = {}
+        self.contact_list = CopyOnWriteRegistry('contacts')
         self.twitter = None
         # ^^ format: key: skype_id
-        #  self.contact_list['alexey.min'] = {'skypeid': 'alexey.min', 'displayname': 'Alexey Min'}
-        self.chatrooms = []
+        #  self.contact_list.set('alexey.min', {'skypeid': 'alexey.min', 'displayname': 'Alexey Min'})
+        self.chatrooms = CopyOnWriteRegistry('chatrooms')
+        # ^^ format: key: full skype ID of conversation, value: the same
+        self.left_chatrooms = CopyOnWriteRegistry('left_chatrooms')
+        # ^^ chatrooms the bot was removed from, key: full skype ID, value: unix time.
+        #    With several instances a chatroom missing from ours may be known to another one,
+        #    only these are surely gone
+        self.subscriptions = Subscriptions()
+        # ^^ which videos each chatroom wants, chatrooms without rules get all
         self._savedata_fn = '_cache/skype_savedata.json'
+        self._savedata_lock = threading.Lock()
         self.load_savedata()
+        # save state after changes of contacts or chatrooms, once per batch of events
+        self.savedata_flusher = DebouncedFlusher(self.save_data, config['SAVEDATA_FLUSH_DELAY'],
+                                                 config['SAVEDATA_MAX_FLUSH_DELAY'], 'SavedataFlusher')
+        self.contact_list.subscribe(self.on_registry_changed)
+        self.chatrooms.subscribe(self.on_registry_changed)
+        self.left_chatrooms.subscribe(self.on_registry_changed)
+        self.subscriptions.rules.subscribe(self.on_registry_changed)
         # internal vars to handle events
         self._evt_from = ''
         self._evt_to = ''
@@ -35,35 +62,114 @@ class SkypeApi:
         self._evt_activity = ''
         self._evt_dict = {}
         #
-        # lock to guard message sending
-        self._msg_lock = threading.Lock()
+        # concurrent sends are limited by the dependency's bulkhead ([resilience] skype_max_concurrent)
+        self._dependency = resilience.get_dependency('skype')
+        #
+        # chat commands
+        self.commands = CommandRouter()
+        self.register_commands()
+        self.throttle = InboundThrottle(config)
+        #
+        # names of users, who are not contacts
+        self._members_dependency = resilience.get_dependency('members')
+        self.display_names = DisplayNameResolver(
+            self.get_conversation_members, config['DISPLAY_NAMES_CACHE_SIZE'], config['DISPLAY_NAMES_TTL'],
+            config['DISPLAY_NAMES_BATCH_DELAY'], config['DISPLAY_NAMES_ROOM_INTERVAL'])
+
+    def register_commands(self):
+        self.commands.register('!help', self.cmd_help, CommandRouter.SCOPE_ANY,
+                               description='справка :)', exact=True, cache_ttl=3600)
+        self.commands.register('!get_videos', self.cmd_get_videos, CommandRouter.SCOPE_ANY,
+                               description='последние видео', cost=5, cache_ttl=60)
+        self.commands.register('!resend', self.cmd_resend, CommandRouter.SCOPE_DM,
+                               description='<текст> - переслать текст во все чаты',
+                               args_mode='rest', cost=10)
+        self.commands.register('!subscribe', self.cmd_subscribe, CommandRouter.SCOPE_GROUP,
+                               description='<слово> или source:<аккаунт> - присылать в чат только такие видео',
+                               args_mode='rest', cost=2)
+        self.commands.register('!unsubscribe', self.cmd_unsubscribe, CommandRouter.SCOPE_GROUP,
+                               description='<слово>, source:<аккаунт> или all - убрать фильтр',
+                               args_mode='rest', cost=2)
+        self.commands.register('!subscriptions', self.cmd_subscriptions, CommandRouter.SCOPE_GROUP,
+                               description='фильтры видео в этом чате', exact=True)
+
+    def on_registry_changed(self, registry: CopyOnWriteRegistry, action: str, key, value):
+        if (registry is self.chatrooms) and (action == CopyOnWriteRegistry.ACTION_REMOVE):
+            # forget subscriptions of chatroom the bot was removed from
+            self.subscriptions.clear(key)
+        self.savedata_flusher.mark_dirty()
 
     def save_data(self):
-        try:
-            with open(self._savedata_fn, mode='wt', encoding='utf-8') as f:
-                json_obj = {
-                    'contacts': self.contact_list,
-                    'chats': self.chatrooms
-                }
-                f.write(json.dumps(json_obj, sort_keys=True, indent=4))
-                print('SkypeAPI: saved savedata')
-        except OSError:
-            pass
+        # lock, so that two threads do not write the same temp file, and the
+        # snapshot is taken inside it, so that an older one is never written last
+        with self._savedata_lock:
+            json_obj = {
+                'contacts': self.contact_list.snapshot(),
+                'chats': self.chatrooms.keys(),
+                'left_chats': self.left_chatrooms.snapshot(),
+                'subscriptions': self.subscriptions.rules.snapshot()
+            }
+            try:
+                with open(self._savedata_fn + '.tmp', mode='wt', encoding='utf-8') as f:
+                    f.write(json.dumps(json_obj, sort_keys=True, indent=4))
+                os.replace(self._savedata_fn + '.tmp', self._savedata_fn)
+                logger.debug('Saved savedata', contacts=len(json_obj['contacts']),
+                             chats=len(json_obj['chats']))
+            except OSError:
+                pass
 
     def load_savedata(self):
         try:
             with open(self._savedata_fn, mode='rt', encoding='utf-8') as f:
                 s = f.read()
-                json_obj = json.loads(s, encoding='utf-8')
+                json_obj = json.loads(s)
                 if type(json_obj) == dict:
-                    self.contact_list = json_obj['contacts']
-                    self.chatrooms = json_obj['chats']
-                    print('SkypeAPI: loaded savedata OK')
+                    self.contact_list.reset(json_obj['contacts'], notify=False)
+                    self.chatrooms.reset({room: room for room in json_obj['chats']}, notify=False)
+                    self.left_chatrooms.reset(json_obj.get('left_chats', {}), notify=False)
+                    # notify, so that subscriptions index is built
+                    self.subscriptions.rules.reset(json_obj.get('subscriptions', {}))
+                    logger.info('Loaded savedata', contacts=len(self.contact_list),
+                                chats=len(self.chatrooms))
                 else:
-                    sys.stderr.write('SkypeAPI: error reading savedata!\n')
+                    logger.error('Error reading savedata')
         except OSError:
             pass
 
+    def merge_savedata(self):
+        """
+        Adds contacts, chatrooms and subscriptions, that other instances have
+        saved, to ours: each instance knows only what it has seen itself since
+        start, and saves that. Called when this instance becomes leader,
+        before it delivers broadcasts. What this instance knows wins.
+        """
+        try:
+            with open(self._savedata_fn, mode='rt', encoding='utf-8') as f:
+                json_obj = json.loads(f.read())
+        except (OSError, ValueError) as e:
+            logger.warning('Cannot merge savedata', error=e)
+            return
+        if type(json_obj) != dict:
+            return
+        num_chats = len(self.chatrooms)
+        with self.savedata_flusher.batch():
+            for room, left_at in json_obj.get('left_chats', {}).items():
+                if room not in self.chatrooms:
+                    self.left_chatrooms.add(room, left_at)
+            for skypeid, contact in json_obj.get('contacts', {}).items():
+                self.contact_list.add(skypeid, contact)
+            for room in json_obj.get('chats', []):
+                if room not in self.left_chatrooms:
+                    self.chatrooms.add(room, room)
+            for room, rules in json_obj.get('subscriptions', {}).items():
+                if room in self.chatrooms:
+                    self.subscriptions.rules.add(room, rules)
+        logger.info('Merged savedata', contacts=len(self.contact_list), chats=len(self.chatrooms),
+                    new_chats=len(self.chatrooms) - num_chats)
+
+    def is_chatroom_left(self, room: str) -> bool:
+        return room in self.left_chatrooms
+
     def refresh_token(self):
         self.token = self.authservice.get_token()
 
@@ -90,14 +196,55 @@ class SkypeApi:
             return m.group(1)
         return s
 
-    def get_user_display_name(self, skypeid: str) -> str:
+    def get_user_display_name(self, skypeid: str, conversation: str = None) -> str:
+        """
+        Never waits for API calls: name of a contact, or cached name,
+        or stripped skype ID, if name is not known (yet)
+        :param conversation: group chat, where user is; its members are looked up in background
+        """
         stripped_skypeid = self.strip_skypeid(skypeid)
-        if stripped_skypeid in self.contact_list:
-            contact = self.contact_list[stripped_skypeid]
+        contact = self.contact_list.get(stripped_skypeid)
+        if (contact is not None) and (contact['displayname'] != ''):
             return contact['displayname']
         # not in contacts
+        if (conversation is not None) and not self.is_skypeid_conversation(conversation):
+            conversation = None
+        name = self.display_names.resolve(stripped_skypeid, conversation)
+        if name is not None:
+            return name
         return stripped_skypeid
 
+    def get_conversation_members(self, conversation: str):
+        """
+        Called by display names resolver, in its thread.
+        GET /v3/conversations/<id>/members
+        [{"id": "8:alexey.min", "name": "Alexey Min"}, ...]
+        :return: dict of stripped skype ID => display name, or None on failure
+        """
+        token = self.authservice.get_token()
+        if token == '':
+            return None
+        url = '{0}/v3/conversations/{1}/members'.format(self.config['SKYPE_API_URL'], conversation)
+        try:
+            r = self._members_dependency.call(requests.get, url, headers={'Authorization': 'Bearer ' + token},
+                                              timeout=self._members_dependency.timeout,
+                                              result_check=resilience.check_http_status)
+            if r.status_code != 200:
+                logger.warning('Unexpected members API response status', conversation=conversation,
+                               status=r.status_code)
+                return None
+            members = r.json()
+        except (requests.exceptions.RequestException, resilience.DependencyError, ValueError) as e:
+            logger.warning('Failed to get conversation members', conversation=conversation, error=e)
+            return None
+        if type(members) != list:
+            return None
+        ret = {}
+        for member in members:
+            if (type(member) == dict) and self.is_skypeid_user(str(member.get('id', ''))) and member.get('name'):
+                ret[self.strip_skypeid(member['id'])] = member['name']
+        return ret
+
     def handle_webhook_event(self, event_dict: dict):
         """
         Main entry point that receives all skype even callbacks
@@ -114,9 +261,11 @@ class SkypeApi:
             self._evt_time = utils.parse_skype_datetime(event_dict['time'])
         if 'activity' in event_dict:
             self._evt_activity = event_dict['activity']
+        if event_dict.get('fromDisplayName') and self.is_skypeid_user(self._evt_from):
+            self.display_names.learn(self.strip_skypeid(self._evt_from), event_dict['fromDisplayName'])
         # output to console!
-        print('{0}: activity={1}, from:{2} => to:{3}'.format(
-            self._evt_time, self._evt_activity, self._evt_from, self._evt_to))
+        logger.debug('Webhook event', time=self._evt_time, activity=self._evt_activity,
+                     from_id=self._evt_from, to=self._evt_to)
         # run appropriate handler for each event type
         if self._evt_activity == self.ACTIVITY_MESSAGE:
             self.handle_message()
@@ -127,8 +276,7 @@ class SkypeApi:
         elif self._evt_activity == self.ACTIVITY_CONVERSATIONUPDATE:
             self.handle_conversationUpdate()
         else:
-            sys.stderr.write('SkypeAPI: unhandled activity event received: '
-                             '[{0}]\n'.format(self._evt_activity))
+            logger.warning('Unhandled activity event received', activity=self._evt_activity)
 
     def handle_message(self):
         """
@@ -146,32 +294,116 @@ class SkypeApi:
         if 'id' in self._evt_dict:
             message_id = self._evt_dict['id']
         #
-        # direct user-to-me conversation
-        if self.is_skypeid_user(self._evt_from) and self.is_skypeid_me(self._evt_to):
-            skypeid_from = self.strip_skypeid(self._evt_from)
-            display_name = self.get_user_display_name(skypeid_from)
-            #
-            if message.startswith('!resend '):
-                to_resend = message[8:]
-                if len(self.chatrooms) > 0:
-                    print('Resending message from {0} to {1} chatrooms'.format(
-                        skypeid_from, len(self.chatrooms)))
-                    self.broadcast_to_chatrooms(to_resend)
-            elif message.startswith('!get_videos'):
-                self.reply_bbvids(self._evt_from)
-            else:
+        if not self.is_skypeid_user(self._evt_from):
+            return
+        if self.is_skypeid_me(self._evt_to):
+            # direct user-to-me conversation
+            scope = CommandRouter.SCOPE_DM
+            reply_to = self._evt_from
+        elif self.is_skypeid_conversation(self._evt_to):
+            # user-to-groupchat conversation
+            scope = CommandRouter.SCOPE_GROUP
+            reply_to = self._evt_to
+        else:
+            return
+        #
+        cmd, args = self.commands.resolve(message, scope)
+        if (cmd is None) and (scope != CommandRouter.SCOPE_DM):
+            return  # not a command, nothing to do in group chats
+        if scope == CommandRouter.SCOPE_GROUP:
+            # if name is not known, have it looked up before it is needed in a reply
+            self.get_user_display_name(self._evt_from, reply_to)
+        #
+        # check rate limits before any work is done
+        cmd_name = ''
+        cmd_cost = 1
+        if cmd is not None:
+            cmd_name = cmd.name
+            cmd_cost = cmd.cost
+        allowed, rule, retry_after = self.throttle.check(self._evt_from, reply_to, cmd_name, cmd_cost)
+        if not allowed:
+            logger.info('Throttled', command=cmd_name, from_id=self._evt_from,
+                        conversation=reply_to, rule=rule)
+            if self.throttle.should_send_cooldown_reply(self._evt_from):
+                self.send_message(reply_to, 'Не так быстро, {0}! Попробуй через {1} сек.'.format(
+                    self.get_user_display_name(self._evt_from, reply_to), int(retry_after) + 1))
+            return
+        #
+        if cmd is None:
+            if scope == CommandRouter.SCOPE_DM:
+                display_name = self.get_user_display_name(self._evt_from)
                 self.send_message(self._evt_from,
                                   'Чего надо, {0}? Я пока не общаюсь '
                                   'в личке...'.format(display_name))
-        #
-        # user-to-groupchat conversation
-        if self.is_skypeid_user(self._evt_from) and self.is_skypeid_conversation(self._evt_to):
-            # I can handle some commands here
-            if message == '!help':
-                help_message = 'Я пока что умею только одну команду:\n !help - справка :)'
-                self.send_message(self._evt_to, help_message)
-            elif message == '!get_videos':
-                self.reply_bbvids(self._evt_to)
+            return
+        ctx = CommandContext(cmd, scope, self._evt_from, reply_to, reply_to, args)
+        reply = self.commands.invoke(ctx)
+        if reply is not None:
+            self.send_message(reply_to, reply)
+
+    def cmd_help(self, ctx: CommandContext):
+        help_message = 'Я умею такие команды:'
+        for cmd in self.commands.get_commands(ctx.scope):
+            help_message += '\n {0} - {1}'.format(cmd.name, cmd.description)
+        return help_message
+
+    def cmd_get_videos(self, ctx: CommandContext):
+        reply = ''
+        bbvids = self.twitter.get_bb_videos(10)
+        if len(bbvids) > 0:
+            reply += '{0} results:\n'.format(len(bbvids))
+            for vid in bbvids:
+                reply += '{0} - {1}\n'.format(vid['title'], vid['url'])
+        if reply == '':
+            return None
+        return reply
+
+    def cmd_resend(self, ctx: CommandContext):
+        if len(self.chatrooms) > 0:
+            logger.info('Resending message to chatrooms', from_id=self.strip_skypeid(ctx.from_id),
+                        chatrooms=len(self.chatrooms))
+            self.broadcast_to_chatrooms(ctx.args)
+        return None
+
+    @staticmethod
+    def parse_subscription_rule(arg: str):
+        """
+        'source:bb_video_' => ('sources', 'bb_video_'); 'BBCF' => ('keywords', 'bbcf')
+        """
+        if arg.lower().startswith('source:'):
+            return 'sources', arg[7:].strip().lower()
+        return 'keywords', arg.strip().lower()
+
+    def cmd_subscribe(self, ctx: CommandContext):
+        kind, value = self.parse_subscription_rule(ctx.args)
+        if value == '':
+            return None
+        if self.subscriptions.add_rule(ctx.conversation_id, kind, value):
+            logger.info('Subscription added', conversation=ctx.conversation_id, kind=kind, value=value)
+            return 'Ок, теперь сюда только видео с фильтром: {0}'.format(ctx.args)
+        return 'Такой фильтр уже есть'
+
+    def cmd_unsubscribe(self, ctx: CommandContext):
+        if ctx.args.lower() == 'all':
+            self.subscriptions.clear(ctx.conversation_id)
+            logger.info('Subscriptions cleared', conversation=ctx.conversation_id)
+            return 'Ок, теперь сюда все видео'
+        kind, value = self.parse_subscription_rule(ctx.args)
+        if self.subscriptions.remove_rule(ctx.conversation_id, kind, value):
+            logger.info('Subscription removed', conversation=ctx.conversation_id, kind=kind, value=value)
+            return 'Ок, фильтр убран'
+        return 'Нет такого фильтра'
+
+    def cmd_subscriptions(self, ctx: CommandContext):
+        rules = self.subscriptions.get_rules(ctx.conversation_id)
+        if (len(rules['sources']) == 0) and (len(rules['keywords']) == 0):
+            return 'Фильтров нет, сюда приходят все видео'
+        reply = 'Фильтры видео в этом чате:'
+        if len(rules['sources']) > 0:
+            reply += '\n источники: {0}'.format(', '.join(rules['sources']))
+        if len(rules['keywords']) > 0:
+            reply += '\n слова: {0}'.format(', '.join(rules['keywords']))
+        return reply
 
     def handle_contactRelationUpdate(self):
         """
@@ -192,16 +424,16 @@ class SkypeApi:
             # yay! we've been added as a contact!
             cskypeid = self.strip_skypeid(self._evt_from)
             contact = {'skypeid': cskypeid, 'displayname': from_display_name}
-            self.contact_list[cskypeid] = contact
-            self.save_data()
-            print('Yay! {0} ({1}) added me as contact!'.format(
-                from_display_name, cskypeid))
+            self.contact_list.set(cskypeid, contact)
+            logger.info('Added as contact', skypeid=cskypeid, display_name=from_display_name)
         elif action == 'remove':
             cskypeid = self.strip_skypeid(self._evt_from)
-            print('=( {0} removed me from contacts :('.format(cskypeid))
-            if cskypeid in self.contact_list:
-                del self.contact_list[cskypeid]
-                self.save_data()
+            logger.info('Removed from contacts', skypeid=cskypeid)
+            # user may still be in group chats with the bot
+            contact = self.contact_list.get(cskypeid)
+            if contact is not None:
+                self.display_names.learn(cskypeid, contact['displayname'])
+            self.contact_list.remove(cskypeid)
 
     def handle_conversationUpdate(self):
         """
@@ -223,20 +455,20 @@ class SkypeApi:
         #
         if 'topicName' in self._evt_dict:
             topic_name = self._evt_dict['topicName']
-            print('Room {0} topic name changed: {1}'.format(room_skypeid, topic_name))
+            logger.info('Room topic name changed', room=room_skypeid, topic=topic_name)
         if 'historyDisclosed' in self._evt_dict:
             history_disclosed = self._evt_dict['historyDisclosed']
-            print('Room {0} historyDisclosed changed: {1}'.format(room_skypeid, history_disclosed))
+            logger.info('Room historyDisclosed changed', room=room_skypeid,
+                        history_disclosed=history_disclosed)
         #
         if 'membersAdded' in self._evt_dict:
             members_added = self._evt_dict['membersAdded']
             if type(members_added) == list:
                 if my_bot_skypeid in members_added:
                     # bot was added to a skype conference
-                    if room_skypeid not in self.chatrooms:
-                        print('I was added to a conversation [{0}] :)'.format(room_skypeid))
-                        self.chatrooms.append(room_skypeid)
-                        self.save_data()
+                    self.left_chatrooms.remove(room_skypeid)
+                    if self.chatrooms.add(room_skypeid, room_skypeid):
+                        logger.info('Added to a conversation', room=room_skypeid)
         #
         if 'membersRemoved' in self._evt_dict:
             members_removed = self._evt_dict['membersRemoved']
@@ -246,22 +478,32 @@ class SkypeApi:
                     # for some reason, this is never received for now.
                     # so we can never know if we were removed from a chatroom
                     # but maybe in future...
-                    if room_skypeid in self.chatrooms:
-                        print('I was removed from conversation [{0}] :('.format(room_skypeid))
-                        self.chatrooms.remove(room_skypeid)
-                        self.save_data()
+                    # remembered even if this instance did not know the chatroom:
+                    # outbox must not deliver there, whoever queued the message
+                    self.left_chatrooms.set(room_skypeid, time.time())
+                    if self.chatrooms.remove(room_skypeid):
+                        logger.info('Removed from conversation', room=room_skypeid)
 
     def handle_attachment(self):
         # we do not handle an attachment in any way
         pass
 
-    def send_message(self, to: str, message: str, do_escape: bool = True):
+    def send_message(self, to: str, message: str, do_escape: bool = True) -> bool:
+        """
+        :return: True if Skype API accepted the message (201 Created)
+        """
+        return self.send_message_status(to, message, do_escape) == 201
+
+    def send_message_status(self, to: str, message: str, do_escape: bool = True) -> int:
+        """
+        :return: HTTP status of Skype API response, or 0 if message was not sent
+                 at all (no token, network error, circuit breaker is open)
+        """
         self.token = self.authservice.get_token()
         if self.token == '':
-            sys.stderr.write('MovieBotService: cannot send message without OAuth2 token!\n')
-            return False
-        api_host = 'apis.skype.com'
-        url = 'https://{0}/v2/conversations/{1}/activities'.format(api_host, to)
+            logger.error('Cannot send message without OAuth2 token', to=to)
+            return 0
+        url = '{0}/v2/conversations/{1}/activities'.format(self.config['SKYPE_API_URL'], to)
         #
         # Here we need to escape some special characters in a message
         # from skype Node.js SDK:
@@ -280,30 +522,45 @@ class SkypeApi:
         }
         postdata_e = json.dumps(postdata)
 
-        # enter the lock
-        self._msg_lock.acquire()
         try:
-            r = requests.post(url, data=postdata_e, headers={'Authorization': 'Bearer ' + self.token})
+            r = self._dependency.call(self._post_message, url, postdata_e,
+                                      result_check=resilience.check_http_status)
             if r.status_code != 201:
-                sys.stderr.write('ERROR: API response status code:\n'.format(r.status_code))
-        finally:
-            # release the lock
-            self._msg_lock.release()
+                logger.error('Unexpected API response status', to=to, status=r.status_code)
+            return r.status_code
+        except requests.exceptions.RequestException as rex:
+            logger.error('Failed to send message', to=to, error=rex)
+        except resilience.UpstreamError as ue:
+            logger.error('Failed to send message', to=to, error=ue)
+            return ue.status_code
+        except resilience.DependencyError as de:
+            logger.error('Failed to send message', to=to, error=de)
+        return 0
 
-        return True
+    def _post_message(self, url: str, postdata_e: str):
+        return requests.post(url, data=postdata_e, headers={'Authorization': 'Bearer ' + self.token},
+                             timeout=self._dependency.timeout)
 
-    def reply_bbvids(self, reply_to: str):
-        reply = ''
-        bbvids = self.twitter.get_bb_videos(10)
-        if len(bbvids) > 0:
-            reply += '{0} results:\n'.format(len(bbvids))
-            for vid in bbvids:
-                reply += '{0} - {1}\n'.format(vid['title'], vid['url'])
-        if reply != '':
-            self.send_message(reply_to, reply)
+    def get_broadcast_recipients(self, video: dict) -> list:
+        """
+        :param video: dict with 'title' and 'source'
+        :return: chatrooms, subscribed to this video
+        """
+        return self.subscriptions.get_recipients(video, self.chatrooms.keys())
 
-    def broadcast_to_chatrooms(self, message: str):
+    def broadcast_to_chatrooms(self, message: str, recipients: list = None) -> int:
+        """
+        Sends message right now, without retries (for chat commands)
+        :param recipients: chatrooms to send to, all chatrooms if None
+        :return: number of chatrooms, that accepted the message
+        """
         if message == '':
-            return
-        for conf_skypeid in self.chatrooms:
-            self.send_message(conf_skypeid, message)
+            return 0
+        if recipients is None:
+            # iterate a snapshot, chatrooms may change while we are sending
+            recipients = self.chatrooms.snapshot()
+        num_sent = 0
+        for conf_skypeid in recipients:
+            if self.send_message(conf_skypeid, message):
+                num_sent += 1
+        return num_sent
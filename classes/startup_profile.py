@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import contextlib
+
+
+class StartupProfiler:
+    """
+    Records how long each import and initialization phase took.
+    Recording is always on (it is just a couple of perf_counter() calls),
+    report is printed only in --startup-profile mode.
+    """
+
+    def __init__(self):
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self.phases = []  # list of tuples (name, start offset, duration, thread name)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.phases.append((name, start - self._t0, end - start,
+                                    threading.current_thread().name))
+
+    def mark(self, name: str):
+        """
+        Records a point in time, like 'listener accepting connections'
+        """
+        with self._lock:
+            self.phases.append((name, time.perf_counter() - self._t0, 0.0,
+                                threading.current_thread().name))
+
+    def report(self) -> str:
+        with self._lock:
+            phases = sorted(self.phases, key=lambda p: p[1])
+        lines = ['Startup profile (seconds since start of server.py):',
+                 '  {0:>8} {1:>8}  {2:<20} {3}'.format('at', 'took', 'thread', 'phase')]
+        for name, start, duration, thread_name in phases:
+            lines.append('  {0:8.3f} {1:8.3f}  {2:<20} {3}'.format(
+                start, duration, thread_name, name))
+        return '\n'.join(lines)
+
+
+# one global profiler for the whole process
+profiler = StartupProfiler()
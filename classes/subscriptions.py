@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Per-chatroom subscriptions: which videos a chatroom wants to receive
+import re
+import threading
+
+from classes.registry import CopyOnWriteRegistry
+from classes import log
+
+logger = log.get_logger('subscriptions')
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text: str) -> tuple:
+    """
+    'EVO 2016: BBCF Top 8' => ('evo', '2016', 'bbcf', 'top', '8')
+    """
+    return tuple(w.lower() for w in _WORD_RE.findall(text))
+
+
+class SubscriptionIndex:
+    """
+    Immutable inverted index built from all chatrooms' rules:
+    keyword phrase => chatrooms, by phrase's first word; source => chatrooms.
+    Finding recipients of a video costs a dict lookup per word of its title,
+    plus the number of matching rules, however many chatrooms and rules there are.
+    """
+
+    def __init__(self, rules: dict):
+        """
+        :param rules: chatroom => {'sources': [...], 'keywords': [...]}
+        """
+        self.keywords = {}  # first word => {phrase tuple => set of chatrooms}
+        self.sources = {}  # source => set of chatrooms
+        self.rooms_with_keywords = set()
+        self.rooms_with_sources = set()
+        for room, room_rules in rules.items():
+            for keyword in room_rules.get('keywords', []):
+                phrase = tokenize(keyword)
+                if len(phrase) == 0:
+                    continue
+                self.keywords.setdefault(phrase[0], {}).setdefault(phrase, set()).add(room)
+                self.rooms_with_keywords.add(room)
+            for source in room_rules.get('sources', []):
+                self.sources.setdefault(source.lower(), set()).add(room)
+                self.rooms_with_sources.add(room)
+        self.subscribed_rooms = self.rooms_with_keywords | self.rooms_with_sources
+
+    def match_keywords(self, title: str) -> set:
+        """
+        :return: chatrooms having a keyword, that occurs in title as whole words
+        """
+        ret = set()
+        words = tokenize(title)
+        for i, word in enumerate(words):
+            phrases = self.keywords.get(word)
+            if phrases is None:
+                continue
+            for phrase, rooms in phrases.items():
+                if words[i:i + len(phrase)] == phrase:
+                    ret |= rooms
+        return ret
+
+    def match(self, video: dict) -> set:
+        """
+        Chatrooms with rules, that want this video: a chatroom with both
+        keywords and sources needs a match of both, with one kind of rules - of that kind.
+        """
+        by_keyword = self.match_keywords(video.get('title', '')) if len(self.keywords) > 0 else set()
+        by_source = self.sources.get(video.get('source', '').lower(), set())
+        return (by_keyword - self.rooms_with_sources) | \
+               (by_source - self.rooms_with_keywords) | \
+               (by_keyword & by_source)
+
+
+class Subscriptions:
+    """
+    Chatroom subscriptions, stored in a copy-on-write registry
+    (chatroom => {'sources': [...], 'keywords': [...]}).
+    Chatrooms without rules receive all videos, as before subscriptions existed.
+    Index is rebuilt on every change of rules, which are rare,
+    so lookups never take locks. Changes of rules and index rebuilds are
+    done under one lock: concurrent commands in a chatroom do not lose
+    rules, and an index of older rules never replaces a newer one.
+    """
+
+    def __init__(self):
+        self.rules = CopyOnWriteRegistry('subscriptions')
+        self._index = SubscriptionIndex({})
+        # reentrant: registry calls on_rules_changed from add_rule's rules.set()
+        self._lock = threading.RLock()
+        self.rules.subscribe(self.on_rules_changed)
+
+    def on_rules_changed(self, registry: CopyOnWriteRegistry, action: str, key, value):
+        with self._lock:
+            self._index = SubscriptionIndex(self.rules.snapshot())
+
+    def get_rules(self, room: str) -> dict:
+        return self.rules.get(room, {'sources': [], 'keywords': []})
+
+    def add_rule(self, room: str, kind: str, value: str) -> bool:
+        """
+        :param kind: 'sources' or 'keywords'
+        :return: False if chatroom already has this rule
+        """
+        with self._lock:
+            room_rules = self.get_rules(room)
+            if value in room_rules[kind]:
+                return False
+            new_rules = dict(room_rules)
+            new_rules[kind] = room_rules[kind] + [value]
+            self.rules.set(room, new_rules)
+        return True
+
+    def remove_rule(self, room: str, kind: str, value: str) -> bool:
+        with self._lock:
+            room_rules = self.get_rules(room)
+            if value not in room_rules[kind]:
+                return False
+            new_rules = dict(room_rules)
+            new_rules[kind] = [v for v in room_rules[kind] if v != value]
+            if (len(new_rules['sources']) == 0) and (len(new_rules['keywords']) == 0):
+                self.rules.remove(room)
+            else:
+                self.rules.set(room, new_rules)
+        return True
+
+    def clear(self, room: str) -> bool:
+        with self._lock:
+            return self.rules.remove(room)
+
+    def get_recipients(self, video: dict, chatrooms: list) -> list:
+        """
+        :param video: dict with 'title' and 'source'
+        :param chatrooms: all chatrooms the bot is in
+        :return: chatrooms, that should receive the video, in chatrooms order
+        """
+        index = self._index
+        matched = index.match(video)
+        return [room for room in chatrooms if (room not in index.subscribed_rooms) or (room in matched)]
+
+    def get_stats(self) -> dict:
+        index = self._index
+        return {
+            'rooms': len(index.subscribed_rooms),
+            'keywords': sum(len(phrases) for phrases in index.keywords.values()),
+            'sources': len(index.sources)
+        }
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# Minimal support for systemd socket activation and service notifications,
+# without python-systemd library. See man sd_listen_fds(3), sd_notify(3)
+import os
+import socket
+
+from classes import log
+
+logger = log.get_logger('systemd')
+
+SD_LISTEN_FDS_START = 3
+
+
+def get_listen_fds() -> list:
+    """
+    Returns file descriptors of sockets, passed by systemd .socket unit
+    Environment variables are unset, so that child processes do not inherit them.
+    :return: list of fds, empty if not socket-activated
+    """
+    ret = []
+    listen_pid = os.environ.pop('LISTEN_PID', '')
+    listen_fds = os.environ.pop('LISTEN_FDS', '')
+    os.environ.pop('LISTEN_FDNAMES', None)
+    if (listen_pid == '') or (listen_fds == ''):
+        return ret
+    try:
+        if int(listen_pid) != os.getpid():
+            return ret
+        num_fds = int(listen_fds)
+    except ValueError:
+        logger.error('Invalid LISTEN_PID/LISTEN_FDS values')
+        return ret
+    for fd in range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + num_fds):
+        os.set_inheritable(fd, False)
+        ret.append(fd)
+    return ret
+
+
+def notify(state: str) -> bool:
+    """
+    Sends notification to systemd, like 'READY=1' or 'STOPPING=1'
+    Does nothing if not started by systemd with Type=notify.
+    :param state: notification string
+    :return: True if sent
+    """
+    addr = os.environ.get('NOTIFY_SOCKET', '')
+    if addr == '':
+        return False
+    if addr[0] == '@':
+        # abstract namespace socket
+        addr = '\0' + addr[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(addr)
+            sock.sendall(state.encode('utf-8'))
+    except OSError as e:
+        logger.error('Failed to notify', state=state, error=e)
+        return False
+    return True
@@ -10,8 +10,20 @@
 #               !y:/bin/python34/python3-utf8.exe (!)
 #  in template files: ## -*- coding: utf-8 -*-  (as a first line)
 
-from mako.lookup import TemplateLookup
-from mako import exceptions
+from classes.startup_profile import profiler
+
+# mako is imported on first use, not at server startup
+_TemplateLookup = None
+
+
+def _get_template_lookup_class():
+    global _TemplateLookup
+    if _TemplateLookup is None:
+        # recorded once: profiler phases must not grow with every page render
+        with profiler.phase('import mako'):
+            from mako.lookup import TemplateLookup
+        _TemplateLookup = TemplateLookup
+    return _TemplateLookup
 
 
 class TemplateEngine:
@@ -35,7 +47,7 @@ class TemplateEngine:
             # 'encoding_errors':  'replace',
             'strict_undefined': True
         }
-        self._lookup = TemplateLookup(**params)
+        self._lookup = _get_template_lookup_class()(**params)
         self._args = dict()
 
     def assign(self, vname, vvalue):
@@ -64,6 +76,7 @@ class TemplateEngine:
         :param expose_errors: - if true, any exception will be returned in result string
         :return: rendered template text
         """
+        from mako import exceptions
         ret = ''
         try:
             tmpl = self._lookup.get_template(tname)
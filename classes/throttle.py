@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import collections
+
+
+class SlidingWindowLimiter:
+    """
+    Sliding window log: for every key remembers timestamps (and weights)
+    of events in the last window seconds. Memory is bounded: each key keeps
+    at most limit entries, and only max_keys least recently used keys are kept.
+    Not thread-safe, InboundThrottle guards it with its lock.
+    """
+
+    def __init__(self, limit: int, window: float, max_keys: int):
+        self.limit = limit
+        self.window = window
+        self._max_keys = max_keys
+        self._events = collections.OrderedDict()  # key => deque of (timestamp, weight)
+
+    def _get_used(self, key, now: float):
+        events = self._events.get(key)
+        if events is None:
+            return 0, None
+        while (len(events) > 0) and (events[0][0] <= now - self.window):
+            events.popleft()
+        if len(events) == 0:
+            del self._events[key]
+            return 0, None
+        return sum(e[1] for e in events), events
+
+    def allows(self, key, weight: int, now: float) -> bool:
+        if self.limit <= 0:
+            return True  # disabled
+        used, events = self._get_used(key, now)
+        return used + weight <= self.limit
+
+    def record(self, key, weight: int, now: float):
+        if self.limit <= 0:
+            return
+        events = self._events.get(key)
+        if events is None:
+            events = collections.deque(maxlen=self.limit)
+            self._events[key] = events
+            if len(self._events) > self._max_keys:
+                # forget least recently active key
+                self._events.popitem(last=False)
+        else:
+            self._events.move_to_end(key)
+        events.append((now, weight))
+
+    def retry_after(self, key, now: float) -> float:
+        events = self._events.get(key)
+        if (events is None) or (len(events) == 0):
+            return 0.0
+        return max(0.0, events[0][0] + self.window - now)
+
+    def __len__(self):
+        return len(self._events)
+
+
+class InboundThrottle:
+    """
+    Limits rate of incoming chat commands per user, per conversation
+    and per command. Each command counts in user and conversation windows
+    with its declared cost, and as 1 call in its own command window.
+    """
+
+    RULE_USER = 'user'
+    RULE_CONVERSATION = 'conversation'
+    RULE_COMMAND = 'command'
+
+    def __init__(self, config: dict):
+        self.enabled = config['THROTTLE_ENABLED']
+        self.cooldown_reply = config['THROTTLE_COOLDOWN_REPLY']
+        max_keys = config['THROTTLE_MAX_KEYS']
+        self._lock = threading.Lock()
+        self._limiters = [
+            (self.RULE_USER, SlidingWindowLimiter(
+                config['THROTTLE_USER_LIMIT'], config['THROTTLE_USER_WINDOW'], max_keys)),
+            (self.RULE_CONVERSATION, SlidingWindowLimiter(
+                config['THROTTLE_CONVERSATION_LIMIT'], config['THROTTLE_CONVERSATION_WINDOW'], max_keys)),
+            (self.RULE_COMMAND, SlidingWindowLimiter(
+                config['THROTTLE_COMMAND_LIMIT'], config['THROTTLE_COMMAND_WINDOW'], max_keys))
+        ]
+        # only one cooldown reply per user per user window, not to become spam ourselves
+        self._cooldown_replies = SlidingWindowLimiter(1, config['THROTTLE_USER_WINDOW'], max_keys)
+        # statistics
+        self.num_allowed = 0
+        self.num_throttled = {
+            self.RULE_USER: 0,
+            self.RULE_CONVERSATION: 0,
+            self.RULE_COMMAND: 0
+        }
+        self.num_cooldown_replies = 0
+
+    def check(self, user_id: str, conversation_id: str, command_name: str, cost: int = 1):
+        """
+        Checks all limits, and if all of them allow, counts this command
+        :param user_id: full skype ID of sender
+        :param conversation_id: skype ID of conversation (or of sender for DM)
+        :param command_name: command, or '' for a plain message
+        :param cost: declared command cost
+        :return: tuple (allowed: bool, rule: str, retry_after: float)
+        """
+        if not self.enabled:
+            return True, '', 0.0
+        now = time.monotonic()
+        keys = {
+            self.RULE_USER: (user_id, cost),
+            self.RULE_CONVERSATION: (conversation_id, cost),
+            self.RULE_COMMAND: (command_name, 1)
+        }
+        with self._lock:
+            for rule, limiter in self._limiters:
+                key, weight = keys[rule]
+                if not limiter.allows(key, weight, now):
+                    self.num_throttled[rule] += 1
+                    return False, rule, limiter.retry_after(key, now)
+            for rule, limiter in self._limiters:
+                key, weight = keys[rule]
+                limiter.record(key, weight, now)
+            self.num_allowed += 1
+        return True, '', 0.0
+
+    def should_send_cooldown_reply(self, user_id: str) -> bool:
+        if not self.cooldown_reply:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if not self._cooldown_replies.allows(user_id, 1, now):
+                return False
+            self._cooldown_replies.record(user_id, 1, now)
+            self.num_cooldown_replies += 1
+        return True
+
+    def get_num_tracked_keys(self) -> int:
+        with self._lock:
+            return sum(len(limiter) for rule, limiter in self._limiters)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import ssl
+import socket
+import datetime
+import threading
+
+import certifi
+
+from classes import log
+
+logger = log.get_logger('tls')
+
+
+class TlsService:
+    """
+    Owns server-side ssl.SSLContext. Listening socket is never wrapped,
+    instead each accepted connection is wrapped in a worker thread,
+    so that slow or stalled TLS handshake cannot block accept() loop.
+    Context can be rebuilt at any time (on SIGHUP) to pick up renewed
+    certificate and key files, connections in progress keep the old one.
+    """
+
+    def __init__(self, config: dict):
+        self._config = config
+        self._lock = threading.Lock()
+        self._context = None
+        self.handshake_timeout = config['SSL_HANDSHAKE_TIMEOUT']
+        # statistics
+        self.num_handshakes = 0
+        self.num_handshake_failures = 0
+        self.num_reloads = 0
+        self.loaded_at = None
+        # first load must succeed, there is nothing to fall back to
+        self._context = self.create_context()
+        self.loaded_at = datetime.datetime.utcnow()
+
+    @staticmethod
+    def parse_tls_version(s: str):
+        """
+        Converts config value like 'TLSv1_2' (or 'TLSv1.2') to ssl.TLSVersion
+        :param s: version name
+        :return: ssl.TLSVersion member, or None for empty string
+        """
+        s = s.strip().replace('.', '_')
+        if s == '':
+            return None
+        if s not in ssl.TLSVersion.__members__:
+            raise ValueError('Unknown TLS version: {0}'.format(s))
+        return ssl.TLSVersion[s]
+
+    def create_context(self) -> ssl.SSLContext:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        min_version = self.parse_tls_version(self._config['SSL_MIN_VERSION'])
+        max_version = self.parse_tls_version(self._config['SSL_MAX_VERSION'])
+        if min_version is not None:
+            ctx.minimum_version = min_version
+        if max_version is not None:
+            ctx.maximum_version = max_version
+        if self._config['SSL_CIPHERS'] != '':
+            # affects TLS 1.2 and lower, TLS 1.3 suites are not configurable
+            ctx.set_ciphers(self._config['SSL_CIPHERS'])
+        # session resumption: server-side session cache is on by default
+        # in OpenSSL, also make sure session tickets are issued
+        num_tickets = self._config['SSL_SESSION_TICKETS']
+        if num_tickets > 0:
+            ctx.options &= ~ssl.OP_NO_TICKET
+            ctx.num_tickets = num_tickets
+        else:
+            ctx.options |= ssl.OP_NO_TICKET
+            ctx.num_tickets = 0
+        ctx.load_cert_chain(certfile=self._config['SSL_CERT'], keyfile=self._config['SSL_KEY'])
+        if self._config['VALIDATE_PEER_CERT']:
+            ctx.verify_mode = ssl.CERT_REQUIRED   # require cert from peer
+            ctx.load_verify_locations(cafile=certifi.where())  # look for CA certs here
+        else:
+            ctx.verify_mode = ssl.CERT_NONE  # do not require cert from peer
+        return ctx
+
+    def reload(self) -> bool:
+        """
+        Rebuilds SSL context from certificate and key files.
+        On any error keeps using the current context.
+        :return: True if reloaded successfully
+        """
+        try:
+            new_context = self.create_context()
+        except (OSError, ssl.SSLError, ValueError) as e:
+            logger.error('Failed to reload certificates, keeping old ones', error=e)
+            return False
+        with self._lock:
+            self._context = new_context
+            self.num_reloads += 1
+            self.loaded_at = datetime.datetime.utcnow()
+        logger.info('Reloaded certificate', cert=self._config['SSL_CERT'])
+        return True
+
+    def wrap(self, sock: socket.socket):
+        """
+        Performs server-side TLS handshake on accepted connection,
+        waiting for it no longer than handshake timeout.
+        :param sock: accepted plain socket
+        :return: ssl.SSLSocket, or None if handshake failed (socket is closed then)
+        """
+        with self._lock:
+            ctx = self._context
+        ssl_sock = None
+        try:
+            sock.settimeout(self.handshake_timeout)
+            ssl_sock = ctx.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+            ssl_sock.do_handshake()
+            ssl_sock.settimeout(None)
+        except (OSError, ssl.SSLError) as e:
+            # socket.timeout is also OSError
+            self.num_handshake_failures += 1
+            logger.info('TLS handshake failed', error=e)
+            if ssl_sock is not None:
+                ssl_sock.close()
+            return None
+        self.num_handshakes += 1
+        return ssl_sock
+
+    def get_session_stats(self) -> dict:
+        with self._lock:
+            ctx = self._context
+        return ctx.session_stats()
+
+    def get_num_resumed(self) -> int:
+        stats = self.get_session_stats()
+        return stats.get('hits', 0)
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 
-import sys
+import calendar
 import threading
 
-from tweepy import API
-from tweepy import OAuthHandler
-from tweepy import Status
-from tweepy.error import TweepError
+from classes.startup_profile import profiler
+from classes import video_extractors
+from classes import resilience
+from classes import log
+
+logger = log.get_logger('twitter')
 
 
 class TwitterService:
@@ -18,73 +20,84 @@ class TwitterService:
         self._access_token = config['TWITTER_ACCESS_TOKEN']
         self._access_token_secret = config['TWITTER_ACCESS_TOKEN_SECRET']
         self._user_timeline = config['TWITTER_USER_TIMELINE']
+        self._api_host = config['TWITTER_API_HOST']
+        # recognized video hosts
+        self.extractors = video_extractors.create_registry(config['TWITTER_VIDEO_HOSTS'])
         #
-        self._tweepy_oauth = OAuthHandler(self._consumer_key, self._consumer_secret)
-        self._tweepy_oauth.set_access_token(self._access_token, self._access_token_secret)
-        self._tweepy_api = API(auth_handler=self._tweepy_oauth)
-        self._api_lock = threading.Lock()
+        # tweepy is imported and API client is created on first use
+        self._tweepy_api = None
+        self._init_lock = threading.Lock()
+        # concurrency limit, timeout and circuit breaker for twitter API calls
+        self._dependency = resilience.get_dependency('twitter')
+
+    def get_api(self):
+        with self._init_lock:
+            if self._tweepy_api is None:
+                with profiler.phase('import tweepy'):
+                    from tweepy import API
+                    from tweepy import OAuthHandler
+                tweepy_oauth = OAuthHandler(self._consumer_key, self._consumer_secret)
+                tweepy_oauth.set_access_token(self._access_token, self._access_token_secret)
+                self._tweepy_api = API(auth_handler=tweepy_oauth, host=self._api_host,
+                                       timeout=self._dependency.timeout)
+        return self._tweepy_api
 
     def get_timeline(self, cnt=10):
+        from tweepy.error import TweepError
         timeline = []
-        self._api_lock.acquire()
         try:
-            timeline = self._tweepy_api.user_timeline(self._user_timeline, count=cnt)
+            timeline = self._dependency.call(self.get_api().user_timeline,
+                                             self._user_timeline, count=cnt)
         except TweepError as te:
-            sys.stderr.write('Twitter error: {0}\n'.format(str(te)))
-        finally:
-            self._api_lock.release()
+            logger.error('Twitter error', error=te)
+        except resilience.DependencyError as de:
+            logger.error('Twitter error', error=de)
         return timeline
 
     def get_bb_videos(self, cnt=10):
         """
         Return format: list of dicts, each with format:
-        {'tweet_id': ..., 'title': ..., 'url': ...}
+        {'tweet_id': ..., 'title': ..., 'url': ..., 'host': ..., 'video_id': ...,
+         'source': ..., 'created_at': ...}
+        url is canonical video URL, host is name of video extractor, video_id is
+        canonical within host, source is the twitter account, that posted the video,
+        created_at is unix time of the tweet, or None if unknown.
+        Several tweets with the same video (retweets, reposts with other URL forms)
+        give one video, from the oldest of them.
         :param cnt: number of tweets to receive from timeline
-        :return: list of bb videos
+        :return: list of bb videos, newest first
         """
+        from tweepy import Status
         timeline = self.get_timeline(cnt)
         ret = []
-        if len(timeline) > 0:
-            for tu in timeline:
-                if type(tu) == Status:
-                    tweet_id = tu.id_str
-                    nico_url = ''
-                    #
-                    if type(tu.entities) == dict:
-                        if 'urls' in tu.entities:
-                            for url_info in tu.entities['urls']:
-                                url = url_info['expanded_url']
-                                # be sure that we fetch only urls to nicovideo.jp videos!
-                                if url.startswith('http://www.nicovideo.jp/watch/sm'):
-                                    nico_url = url
-                    #
-                    if nico_url != '':
-                        nico_title = self.get_niconico_title_from_text(tu.text)
-                        # print('- bbvideo: {0} / {1} / {2}'.format(tweet_id, nico_title, nico_url))
-                        bbvideo = {
-                            'tweet_id': tweet_id,
-                            'title': nico_title,
-                            'url': nico_url
-                        }
-                        ret.append(bbvideo)
-        return ret
-
-    @classmethod
-    def get_niconico_title_from_text(cls, text: str) -> str:
-        """
-        Gets only video title from movie bot tweet, strip url ender
-        '"4月9日　セントラル八王子　BBCF　ランダム3on3大会　part3" - https://t.co/bYhEAC0J2x #sm28668357'
-        =>
-        '4月9日　セントラル八王子　BBCF　ランダム3on3大会　part3'
-        :param text:
-        :return:
-        """
-        pos = text.find(' - https://t.co/')
-        if pos == -1:
-            return text
-        ret = text[:pos]
-        if ret[0] == '"':
-            ret = ret[1:]
-        if ret[-1] == '"':
-            ret = ret[:-1]
+        seen = set()  # (host, video_id)
+        # timeline is newest first: walk it from the oldest tweet, so that
+        # a repost of already posted video is recognized as a duplicate
+        for tu in reversed(timeline):
+            if type(tu) != Status:
+                continue
+            urls = []
+            if (type(tu.entities) == dict) and ('urls' in tu.entities):
+                urls = [url_info['expanded_url'] for url_info in tu.entities['urls']
+                        if url_info.get('expanded_url')]
+            link = self.extractors.extract(urls)
+            if link is None:
+                continue
+            if (link['host'], link['video_id']) in seen:
+                continue
+            seen.add((link['host'], link['video_id']))
+            bbvideo = {
+                'tweet_id': tu.id_str,
+                'title': self.extractors.extract_title(link['host'], tu.text),
+                'url': link['url'],
+                'host': link['host'],
+                'video_id': link['video_id'],
+                'source': self._user_timeline.lower(),
+                'created_at': None
+            }
+            # tweepy gives naive datetime in UTC
+            if getattr(tu, 'created_at', None) is not None:
+                bbvideo['created_at'] = float(calendar.timegm(tu.created_at.timetuple()))
+            ret.append(bbvideo)
+        ret.reverse()
         return ret
@@ -1,7 +1,10 @@
-import sys
 import re
 import datetime
 
+from classes import log
+
+logger = log.get_logger('utils')
+
 
 # returns None on error
 def parse_skype_datetime(s: str) -> datetime.datetime:
@@ -9,8 +12,7 @@ def parse_skype_datetime(s: str) -> datetime.datetime:
     # format IS: "2016-04-12T12:18:47.321Z"
     m = re.match(r'(\d+)-(\d+)-(\d+)T(\d+):(\d+):(\d+)\.(\d+)Z', s)
     if m is None:
-        sys.stderr.write('parse_skype_datetime(): Failed to parse string '
-                         '[{0}], regex mismatch.\n'.format(s))
+        logger.warning('parse_skype_datetime(): failed to parse string, regex mismatch', s=s)
         return None
     try:
         year = int(m.group(1))
@@ -21,8 +23,7 @@ def parse_skype_datetime(s: str) -> datetime.datetime:
         second = int(m.group(6))
         ms = int(m.group(7))
     except ValueError:
-        sys.stderr.write('parse_skype_datetime(): Failed to parse string '
-                         '[{0}], failed to convert to int.\n'.format(s))
+        logger.warning('parse_skype_datetime(): failed to parse string, failed to convert to int', s=s)
         return None
 
     # class datetime.datetime(year, month, day, hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# Recognizing links to videos in tweets. Each video host is an extractor:
+# domains, URL patterns, canonical video ID and URL, title extraction from tweet text.
+# Patterns are compiled into one regex per domain, found by URL's host with
+# a dict lookup, so matching a URL costs the same however many hosts are known.
+import re
+import threading
+
+from classes import log
+
+logger = log.get_logger('extractors')
+
+_TCO_LINK_RE = re.compile(r'\s*https?://t\.co/\S+')
+_URL_HOST_RE = re.compile(r'https?://([^/?#:\s]+)', re.IGNORECASE)
+_TRAILING_TAGS_RE = re.compile(r'(\s+#\S+)+\s*$')
+
+
+class VideoExtractor:
+    """
+    Video host. domains are the domains its URLs are on (subdomains included);
+    url_patterns are regexes for the URL without scheme ('www.example.com/v/123'),
+    each with named group 'id'; canonical_url is format string for canonical URL,
+    with {0} for video ID.
+    Extractors are called from several threads, so they must not keep state.
+    """
+
+    def __init__(self, name: str, domains: tuple, url_patterns: tuple, canonical_url: str):
+        self.name = name
+        self.domains = domains
+        self.url_patterns = url_patterns
+        self.canonical_url_format = canonical_url
+
+    def canonical_id(self, raw_id: str) -> str:
+        return raw_id
+
+    def canonical_url(self, video_id: str) -> str:
+        return self.canonical_url_format.format(video_id)
+
+    def extract_title(self, text: str) -> str:
+        """
+        'Some title https://t.co/abc #tag' => 'Some title'
+        """
+        title = _TRAILING_TAGS_RE.sub('', _TCO_LINK_RE.sub('', text)).strip()
+        if title.endswith(' -'):
+            title = title[:-2].rstrip()
+        if (len(title) > 1) and (title[0] == '"') and (title[-1] == '"'):
+            title = title[1:-1]
+        return title if title != '' else text
+
+
+class NicovideoExtractor(VideoExtractor):
+
+    def __init__(self):
+        super(NicovideoExtractor, self).__init__('nicovideo', ('nicovideo.jp', 'nico.ms'), (
+            r'(?:www\.|sp\.|m\.)?nicovideo\.jp/watch/(?P<id>(?:sm|nm|so)\d+)',
+            r'nico\.ms/(?P<id>(?:sm|nm|so)\d+)'
+        ), 'https://www.nicovideo.jp/watch/{0}')
+
+    def canonical_id(self, raw_id: str) -> str:
+        return raw_id.lower()
+
+    def extract_title(self, text: str) -> str:
+        """
+        Gets only video title from movie bot tweet, strip url ender
+        '"4月9日　セントラル八王子　BBCF　ランダム3on3大会　part3" - https://t.co/bYhEAC0J2x #sm28668357'
+        =>
+        '4月9日　セントラル八王子　BBCF　ランダム3on3大会　part3'
+        """
+        pos = text.find(' - https://t.co/')
+        if pos == -1:
+            return super(NicovideoExtractor, self).extract_title(text)
+        ret = text[:pos]
+        if ret.startswith('"'):
+            ret = ret[1:]
+        if ret.endswith('"'):
+            ret = ret[:-1]
+        if ret == '':
+            # nothing before the link: one odd tweet must not abort the whole poll
+            return super(NicovideoExtractor, self).extract_title(text)
+        return ret
+
+
+def create_builtin_extractors() -> list:
+    return [
+        NicovideoExtractor(),
+        VideoExtractor('youtube', ('youtube.com', 'youtu.be'), (
+            r'(?:www\.|m\.)?youtube\.com/watch\?(?:[^#\s]*&)?v=(?P<id>[\w-]{11})',
+            r'(?:www\.|m\.)?youtube\.com/(?:shorts|live|embed)/(?P<id>[\w-]{11})',
+            r'youtu\.be/(?P<id>[\w-]{11})'
+        ), 'https://www.youtube.com/watch?v={0}'),
+        VideoExtractor('twitch', ('twitch.tv',), (
+            r'(?:www\.|m\.)?twitch\.tv/videos/(?P<id>\d+)',
+        ), 'https://www.twitch.tv/videos/{0}')
+    ]
+
+
+class ExtractorRegistry:
+    """
+    Registered extractors, and for each domain one regex of patterns
+    of all extractors on that domain:
+    https?://(?:(?P<p0>pattern0)|(?P<p1>pattern1)|...)
+    Name of the matched alternative tells which extractor it is.
+    A URL is tried only against regexes of its host and the host's parent
+    domains ('sp.nicovideo.jp', then 'nicovideo.jp'): a dict lookup for each,
+    while one regex of all hosts would try its alternatives one by one.
+    Table is rebuilt on every registration, which happens at startup;
+    matching reads current table without locks.
+    """
+
+    def __init__(self):
+        self._extractors = {}  # name => VideoExtractor
+        self._lock = threading.Lock()
+        self._by_domain = {}  # domain => (regex, {group name => VideoExtractor})
+
+    def register(self, extractor: VideoExtractor):
+        with self._lock:
+            self._extractors[extractor.name] = extractor
+            domains = {}  # domain => list of extractors
+            for ex in self._extractors.values():
+                for domain in ex.domains:
+                    domains.setdefault(domain.lower(), []).append(ex)
+            self._by_domain = {domain: self._compile(extractors) for domain, extractors in domains.items()}
+
+    @staticmethod
+    def _compile(extractors: list) -> tuple:
+        owners = {}
+        alternatives = []
+        for ex in extractors:
+            for pattern in ex.url_patterns:
+                group = 'p{0}'.format(len(owners))
+                owners[group] = ex
+                alternatives.append('(?P<{0}>{1})'.format(
+                    group, pattern.replace('(?P<id>', '(?P<{0}_id>'.format(group))))
+        # video ID must end the path segment: no 'sm123abc' or longer youtube IDs
+        regex = re.compile(r'https?://(?:' + '|'.join(alternatives) + r')(?=[/?#&]|$)', re.IGNORECASE)
+        return regex, owners
+
+    def get(self, name: str):
+        return self._extractors.get(name)
+
+    def get_names(self) -> list:
+        return list(self._extractors.keys())
+
+    def match_url(self, url: str):
+        """
+        'http://nico.ms/sm28668357' => {'host': 'nicovideo', 'video_id': 'sm28668357',
+                                        'url': 'https://www.nicovideo.jp/watch/sm28668357'}
+        :return: dict, or None if URL is not a link to a known video host
+        """
+        m = _URL_HOST_RE.match(url)
+        if m is None:
+            return None
+        by_domain = self._by_domain
+        domain = m.group(1).lower()
+        while True:
+            entry = by_domain.get(domain)
+            if entry is not None:
+                regex, owners = entry
+                m = regex.match(url)
+                if m is not None:
+                    group = m.lastgroup
+                    extractor = owners[group]
+                    video_id = extractor.canonical_id(m.group(group + '_id'))
+                    return {'host': extractor.name, 'video_id': video_id,
+                            'url': extractor.canonical_url(video_id)}
+            pos = domain.find('.')
+            if pos == -1:
+                return None
+            domain = domain[pos + 1:]
+
+    def extract(self, urls: list):
+        """
+        :return: first video link among urls (see match_url()), or None
+        """
+        for url in urls:
+            link = self.match_url(url)
+            if link is not None:
+                return link
+        return None
+
+    def extract_title(self, host: str, text: str) -> str:
+        return self._extractors[host].extract_title(text)
+
+
+def create_registry(hosts: list = None) -> ExtractorRegistry:
+    """
+    :param hosts: names of built-in extractors to register, None for all
+    """
+    registry = ExtractorRegistry()
+    for extractor in create_builtin_extractors():
+        if (hosts is None) or (extractor.name in hosts):
+            registry.register(extractor)
+    if hosts is not None:
+        for name in hosts:
+            if registry.get(name) is None:
+                logger.warning('Unknown video host', host=name)
+    return registry
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import json
+import time
+import threading
+import collections
+import concurrent.futures
+import xml.etree.ElementTree as ElementTree
+
+import requests
+import requests.exceptions
+
+from classes import resilience
+from classes import log
+
+logger = log.get_logger('metadata')
+
+
+def format_duration(seconds: int) -> str:
+    """
+    Formats video duration for chat messages
+    319 => '5:19', 3725 => '1:02:05'
+    :param seconds: duration in seconds
+    :return: formatted string
+    """
+    seconds = int(seconds)
+    hours = seconds // 3600
+    minutes = (seconds % 3600) // 60
+    seconds %= 60
+    if hours > 0:
+        return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+    return '{0}:{1:02d}'.format(minutes, seconds)
+
+
+def parse_duration(s: str) -> int:
+    """
+    Parses duration string as returned by nicovideo API: '5:19' or '1:02:05'
+    :param s: duration string
+    :return: duration in seconds, or 0 on error
+    """
+    ret = 0
+    try:
+        for part in s.strip().split(':'):
+            ret = ret * 60 + int(part)
+    except ValueError:
+        return 0
+    return ret
+
+
+class VideoMetadataProvider:
+    """
+    Base class for metadata providers. Provider receives video ID (like 'sm28668357')
+    and returns dict {'video_id': ..., 'title': ..., 'duration': ..., 'thumbnail_url': ...}
+    or None, if nothing is known about this video.
+    Providers are called from worker threads, so they must be thread-safe.
+    host is the video host (see video_extractors) provider knows, None for any.
+    """
+
+    name = 'none'
+    host = None
+
+    def get_metadata(self, video_id: str, timeout: float):
+        return None
+
+
+class NicovideoMetadataProvider(VideoMetadataProvider):
+
+    name = 'nicovideo'
+    host = 'nicovideo'
+
+    def __init__(self, api_url: str = 'https://ext.nicovideo.jp/api/getthumbinfo/'):
+        self._api_url = api_url
+
+    def get_metadata(self, video_id: str, timeout: float):
+        """
+        <nicovideo_thumb_response status="ok">
+          <thumb>
+            <video_id>sm28668357</video_id>
+            <title>...</title>
+            <thumbnail_url>http://tn-skr4.smilevideo.jp/smile?i=28668357</thumbnail_url>
+            <length>5:19</length>
+            ...
+        """
+        dependency = resilience.get_dependency('nicovideo')
+        try:
+            r = dependency.call(requests.get, self._api_url + video_id,
+                                timeout=min(timeout, dependency.timeout),
+                                result_check=resilience.check_http_status)
+            if r.status_code != 200:
+                return None
+            root = ElementTree.fromstring(r.content)
+        except requests.exceptions.RequestException as rex:
+            logger.warning('Network error', provider=self.name, video_id=video_id, error=rex)
+            return None
+        except resilience.DependencyError as de:
+            logger.warning('Lookup failed', provider=self.name, video_id=video_id, error=de)
+            return None
+        except ElementTree.ParseError:
+            logger.warning('Cannot parse response', provider=self.name, video_id=video_id)
+            return None
+        if root.get('status') != 'ok':
+            return None
+        thumb = root.find('thumb')
+        if thumb is None:
+            return None
+        ret = {
+            'video_id': video_id,
+            'title': thumb.findtext('title', default=''),
+            'duration': parse_duration(thumb.findtext('length', default='')),
+            'thumbnail_url': thumb.findtext('thumbnail_url', default='')
+        }
+        return ret
+
+
+class LocalMetadataProvider(VideoMetadataProvider):
+    """
+    Local stand-in provider: reads metadata from JSON file with format
+    {"sm28668357": {"title": "...", "duration": 319, "thumbnail_url": "..."}, ...}
+    Optional delay makes it possible to emulate slow metadata source.
+    """
+
+    name = 'local'
+
+    def __init__(self, json_fn: str, delay: float = 0.0):
+        self._delay = delay
+        self._data = {}
+        try:
+            with open(json_fn, mode='rt', encoding='utf-8') as f:
+                json_obj = json.loads(f.read())
+                if type(json_obj) == dict:
+                    self._data = json_obj
+        except (OSError, ValueError):
+            logger.error('Failed to load local metadata', file=json_fn)
+
+    def get_metadata(self, video_id: str, timeout: float):
+        if self._delay > 0:
+            time.sleep(self._delay)
+        if video_id not in self._data:
+            return None
+        ret = dict(self._data[video_id])
+        ret['video_id'] = video_id
+        return ret
+
+
+class VideoMetadataCache:
+    """
+    On-disk metadata cache, one small JSON file per video ID.
+    At most max_entries of them are mirrored in memory: OrderedDict,
+    most recently used at the end, least recently used are forgotten
+    first (and read from their files again when needed).
+    """
+
+    def __init__(self, cache_dir: str, max_entries: int = 1000):
+        self._cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._mem = collections.OrderedDict()
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+        except OSError:
+            logger.error('Cannot create cache dir', dir=cache_dir)
+
+    def _fn(self, video_id: str) -> str:
+        safe_id = re.sub(r'[^A-Za-z0-9_.-]', '_', video_id)
+        return os.path.join(self._cache_dir, safe_id + '.json')
+
+    def get(self, video_id: str):
+        with self._lock:
+            if video_id in self._mem:
+                self._mem.move_to_end(video_id)
+                return self._mem[video_id]
+        try:
+            with open(self._fn(video_id), mode='rt', encoding='utf-8') as f:
+                meta = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        self._remember(video_id, meta)
+        return meta
+
+    def _remember(self, video_id: str, meta: dict):
+        with self._lock:
+            self._mem[video_id] = meta
+            self._mem.move_to_end(video_id)
+            while len(self._mem) > self.max_entries:
+                self._mem.popitem(last=False)
+
+    def put(self, video_id: str, meta: dict):
+        self._remember(video_id, meta)
+        fn = self._fn(video_id)
+        try:
+            # write to temp file and rename, so readers never see half-written file
+            with open(fn + '.tmp', mode='wt', encoding='utf-8') as f:
+                f.write(json.dumps(meta, sort_keys=True, indent=4))
+            os.replace(fn + '.tmp', fn)
+        except OSError:
+            logger.error('Failed to save cached metadata', file=fn)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._mem)
+
+
+class VideoMetadataEnricher:
+    """
+    Looks up video metadata concurrently on a bounded thread pool.
+    Lookups that did not finish before the deadline keep running in background
+    and their results land in cache, to be used next time.
+    """
+
+    def __init__(self, provider: VideoMetadataProvider, cache: VideoMetadataCache,
+                 max_workers: int = 4, lookup_timeout: float = 5.0,
+                 retry_after: float = 600.0):
+        self._provider = provider
+        self._cache = cache
+        self._lookup_timeout = lookup_timeout
+        self._retry_after = retry_after
+        self._max_pending = max_workers * 4
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._inflight = {}   # video_id => Future
+        self._failed = {}     # video_id => time of last failed lookup
+
+    def _lookup(self, video_id: str):
+        meta = None
+        try:
+            meta = self._provider.get_metadata(video_id, self._lookup_timeout)
+        except Exception as e:
+            logger.error('Provider failed', provider=self._provider.name, video_id=video_id, error=e)
+        with self._lock:
+            del self._inflight[video_id]
+            if meta is None:
+                if len(self._failed) >= 1000:
+                    # forget the oldest half, do not grow forever
+                    oldest = sorted(self._failed, key=self._failed.get)
+                    for old_id in oldest[:len(oldest) // 2]:
+                        del self._failed[old_id]
+                self._failed[video_id] = time.time()
+        if meta is not None:
+            self._cache.put(video_id, meta)
+        return meta
+
+    def _submit(self, video_id: str):
+        # must be called with self._lock held
+        if video_id in self._inflight:
+            return self._inflight[video_id]
+        if video_id in self._failed:
+            if time.time() - self._failed[video_id] < self._retry_after:
+                return None
+            del self._failed[video_id]
+        if len(self._inflight) >= self._max_pending:
+            return None
+        future = self._pool.submit(self._lookup, video_id)
+        self._inflight[video_id] = future
+        return future
+
+    def enrich(self, videos: list, deadline: float):
+        """
+        Adds 'duration' and 'thumbnail_url' keys to videos, that have 'video_id' key
+        and are from the provider's host.
+        Never blocks for longer than deadline.
+        :param videos: list of bb video dicts, modified in place
+        :param deadline: max seconds to wait for lookups
+        :return: number of enriched videos
+        """
+        waiting = {}  # Future => list of videos
+        num_enriched = 0
+        for bbv in videos:
+            video_id = bbv.get('video_id', '')
+            if video_id == '':
+                continue
+            if (self._provider.host is not None) and (bbv.get('host', self._provider.host) != self._provider.host):
+                continue
+            meta = self._cache.get(video_id)
+            if meta is not None:
+                self._apply(bbv, meta)
+                num_enriched += 1
+                continue
+            with self._lock:
+                future = self._submit(video_id)
+            if future is not None:
+                waiting.setdefault(future, []).append(bbv)
+        if len(waiting) > 0:
+            done, not_done = concurrent.futures.wait(list(waiting.keys()), timeout=deadline)
+            for future in done:
+                meta = future.result()
+                if meta is None:
+                    continue
+                for bbv in waiting[future]:
+                    self._apply(bbv, meta)
+                    num_enriched += 1
+            if len(not_done) > 0:
+                logger.warning('Lookups did not finish in time', num_lookups=len(not_done),
+                               deadline=deadline)
+        return num_enriched
+
+    @staticmethod
+    def _apply(bbv: dict, meta: dict):
+        if 'duration' in meta:
+            bbv['duration'] = meta['duration']
+        if 'thumbnail_url' in meta:
+            bbv['thumbnail_url'] = meta['thumbnail_url']
+
+    def get_sizes(self) -> dict:
+        with self._lock:
+            return {
+                'metadata_cache': len(self._cache),
+                'metadata_inflight': len(self._inflight),
+                'metadata_failed': len(self._failed)
+            }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+def create_metadata_provider(config: dict):
+    provider_name = config['METADATA_PROVIDER']
+    if provider_name == 'nicovideo':
+        return NicovideoMetadataProvider(config['METADATA_NICOVIDEO_URL'])
+    if provider_name == 'local':
+        return LocalMetadataProvider(config['METADATA_LOCAL_FILE'])
+    return None
@@ -0,0 +1,630 @@
+# -*- coding: utf-8 -*-
+# Archive of received webhook deliveries: rotated compressed segments of
+# compact JSON lines (the format of classes/webhook_log.py), each with a
+# small side index, so that a query reads only blocks that can match.
+import os
+import re
+import gzip
+import json
+import time
+import zlib
+import queue
+import socket
+import datetime
+import threading
+
+from classes.webhook_log import WebhookRecord
+from classes import log
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # zstd compression is not available, gzip is
+
+logger = log.get_logger('archive')
+
+SEGMENT_EXTENSIONS = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+INDEX_EXTENSION = '.idx'
+KEY_NAMES = ('conversations', 'senders', 'activities')
+
+_READ_ERRORS = (OSError, EOFError, zlib.error)
+if zstandard is not None:
+    _READ_ERRORS = _READ_ERRORS + (zstandard.ZstdError,)
+
+
+def get_event_keys(event_dict: dict) -> tuple:
+    """
+    :return: (conversation, sender, activity) of webhook event; conversation
+             of a direct message is the user, who wrote it
+    """
+    sender = event_dict.get('from')
+    sender = sender if type(sender) == str else ''
+    to = event_dict.get('to')
+    to = to if type(to) == str else ''
+    conversation = to if to.startswith('19:') else sender
+    activity = event_dict.get('activity')
+    return conversation, sender, activity if type(activity) == str else ''
+
+
+class BlockIndex:
+    """
+    One compressed block of a segment (gzip member or zstd frame): where it
+    is, time range of its deliveries, and sets of conversations, senders and
+    activities of their events. A set that grew over max_keys is dropped
+    (None): any value may be in the block.
+    In index file keys are numbers in segment's key tables: each key is
+    written once per segment, in "new_keys" of the first block having it.
+    """
+
+    def __init__(self, offset: int = 0, max_keys: int = 64):
+        self.offset = offset
+        self.size = 0  # compressed bytes
+        self.max_keys = max_keys
+        self.first_time = None
+        self.last_time = None
+        self.num_records = 0
+        self.keys = {name: set() for name in KEY_NAMES}
+
+    def add(self, record: WebhookRecord):
+        if (self.first_time is None) or (record.time < self.first_time):
+            self.first_time = record.time
+        if (self.last_time is None) or (record.time > self.last_time):
+            self.last_time = record.time
+        self.num_records += 1
+        for event_dict in record.events:
+            for name, value in zip(KEY_NAMES, get_event_keys(event_dict)):
+                keys = self.keys[name]
+                if keys is not None:
+                    keys.add(value)
+                    if len(keys) > self.max_keys:
+                        self.keys[name] = None
+
+    def to_json_line(self, key_ids: dict) -> str:
+        """
+        :param key_ids: segment's name => {key => number}, keys new in this block are added to it
+        """
+        obj = {'offset': self.offset, 'size': self.size, 'first_time': self.first_time,
+               'last_time': self.last_time, 'records': self.num_records}
+        new_keys = {}
+        for name, keys in self.keys.items():
+            if keys is None:
+                obj[name] = None
+                continue
+            ids = key_ids[name]
+            for key in sorted(keys - ids.keys()):
+                ids[key] = len(ids)
+                new_keys.setdefault(name, []).append(key)
+            obj[name] = sorted(ids[key] for key in keys)
+        if len(new_keys) > 0:
+            obj['new_keys'] = new_keys
+        return json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def from_dict(cls, obj: dict, key_tables: dict):
+        """
+        :param key_tables: segment's name => list of keys, new keys of this block are appended to it
+        """
+        block = cls(obj['offset'])
+        block.size = obj['size']
+        block.first_time = obj['first_time']
+        block.last_time = obj['last_time']
+        block.num_records = obj['records']
+        for name, keys in obj.get('new_keys', {}).items():
+            key_tables[name].extend(keys)
+        for name in KEY_NAMES:
+            ids = obj.get(name)
+            block.keys[name] = set(key_tables[name][i] for i in ids) if ids is not None else None
+        return block
+
+
+class SegmentIndex:
+    """
+    Index of a segment, kept next to it in a file of JSON lines:
+    one line per block, appended after the block is written,
+    and {"complete": true} when segment is closed.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.blocks = []
+        self.complete = False
+
+    @property
+    def first_time(self):
+        return self.blocks[0].first_time if len(self.blocks) > 0 else None
+
+    @property
+    def last_time(self):
+        return max(block.last_time for block in self.blocks) if len(self.blocks) > 0 else None
+
+    @property
+    def size(self) -> int:
+        return sum(block.size for block in self.blocks)
+
+    @property
+    def num_records(self) -> int:
+        return sum(block.num_records for block in self.blocks)
+
+    def to_dict(self) -> dict:
+        return {'file': os.path.basename(self.filename), 'first_time': self.first_time,
+                'last_time': self.last_time, 'blocks': len(self.blocks), 'records': self.num_records,
+                'size': self.size, 'complete': self.complete}
+
+    @classmethod
+    def load(cls, index_fn: str):
+        """
+        :raises OSError:
+        """
+        index = cls(index_fn[:-len(INDEX_EXTENSION)])
+        key_tables = {name: [] for name in KEY_NAMES}
+        with open(index_fn, mode='rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    obj = json.loads(line)
+                    if obj.get('complete'):
+                        index.complete = True
+                    else:
+                        index.blocks.append(BlockIndex.from_dict(obj, key_tables))
+                except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                    # partial line of a crashed writer: key numbers after it cannot be trusted,
+                    # blocks that are not indexed are not read by queries
+                    break
+        return index
+
+
+class ArchiveQuery:
+    """
+    Deliveries received in [since, until], with at least one event that
+    matches all given filters. None means any.
+    """
+
+    def __init__(self, since: float = None, until: float = None, conversation: str = None,
+                 sender: str = None, activity: str = None, limit: int = 1000):
+        self.since = since
+        self.until = until
+        self.conversation = conversation
+        self.sender = sender
+        self.activity = activity
+        self.limit = limit
+
+    def may_match_block(self, block: BlockIndex) -> bool:
+        if block.num_records == 0:
+            return False
+        if (self.since is not None) and (block.last_time < self.since):
+            return False
+        if (self.until is not None) and (block.first_time > self.until):
+            return False
+        for name, value in zip(KEY_NAMES, (self.conversation, self.sender, self.activity)):
+            if (value is not None) and (block.keys[name] is not None) and (value not in block.keys[name]):
+                return False
+        return True
+
+    def matches(self, record: WebhookRecord) -> bool:
+        if (self.since is not None) and (record.time < self.since):
+            return False
+        if (self.until is not None) and (record.time > self.until):
+            return False
+        if (self.conversation is None) and (self.sender is None) and (self.activity is None):
+            return True
+        for event_dict in record.events:
+            conversation, sender, activity = get_event_keys(event_dict)
+            if ((self.conversation is None) or (conversation == self.conversation)) and \
+                    ((self.sender is None) or (sender == self.sender)) and \
+                    ((self.activity is None) or (activity == self.activity)):
+                return True
+        return False
+
+
+def parse_time(s: str, now: float = None):
+    """
+    '1792418438' (unix time), '2026-10-19T12:00:00Z' (UTC), or relative to now: '-90s', '-15m', '-2h', '-1d'
+    :return: unix time, None for empty string
+    :raises ValueError:
+    """
+    s = s.strip()
+    if s == '':
+        return None
+    m = re.match(r'^-(\d+(?:\.\d+)?)([smhd])$', s)
+    if m is not None:
+        seconds = float(m.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[m.group(2)]
+        return (time.time() if now is None else now) - seconds
+    try:
+        return float(s)
+    except ValueError:
+        pass
+    m = re.match(r'^(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.\d+)?)?)?Z?$', s)
+    if m is None:
+        raise ValueError('bad time: ' + s)
+    parts = [int(p) if p is not None else 0 for p in m.groups()]
+    return datetime.datetime(*parts, tzinfo=datetime.timezone.utc).timestamp()
+
+
+def _new_decompressor(filename: str):
+    if filename.endswith(SEGMENT_EXTENSIONS['zstd']):
+        if zstandard is None:
+            raise OSError('zstandard library is not installed, cannot read ' + filename)
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(wbits=31)  # gzip header
+
+
+def iter_segment_data(filename: str, chunk_size: int = 64 * 1024):
+    """
+    Decompresses whole segment, block after block. Segment, that is being
+    written, can end with an incomplete block: data before it is returned.
+    :return: generator of decompressed chunks (bytes)
+    """
+    with open(filename, mode='rb') as f:
+        decompressor = _new_decompressor(filename)
+        while True:
+            data = f.read(chunk_size)
+            if len(data) == 0:
+                return
+            while len(data) > 0:
+                chunk = decompressor.decompress(data)
+                if len(chunk) > 0:
+                    yield chunk
+                if not decompressor.eof:
+                    break
+                # next block
+                data = decompressor.unused_data
+                decompressor = _new_decompressor(filename)
+
+
+def iter_block_data(filename: str, blocks: list, chunk_size: int = 64 * 1024):
+    """
+    Decompresses only given blocks of a segment
+    :param blocks: list of BlockIndex, in file order
+    :return: generator of decompressed chunks (bytes), each block ends with a line end
+    """
+    with open(filename, mode='rb') as f:
+        for block in blocks:
+            f.seek(block.offset)
+            decompressor = _new_decompressor(filename)
+            left = block.size
+            while (left > 0) and not decompressor.eof:
+                data = f.read(min(chunk_size, left))
+                if len(data) == 0:
+                    raise EOFError('segment is shorter than its index')
+                left -= len(data)
+                chunk = decompressor.decompress(data)
+                if len(chunk) > 0:
+                    yield chunk
+
+
+def _iter_records(chunks):
+    rest = b''
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()  # incomplete line
+        for line in lines:
+            try:
+                obj = json.loads(line.decode('utf-8', errors='replace'))
+            except ValueError:
+                continue
+            if (type(obj) == dict) and ('body' in obj):
+                yield WebhookRecord(obj.get('headers', {}), obj['body'], obj.get('time'))
+
+
+def read_segment(filename: str, blocks: list = None):
+    """
+    Streams records of a segment, block by block, without reading it into memory
+    :param blocks: list of BlockIndex to read, None for whole segment
+    :return: generator of WebhookRecord
+    """
+    try:
+        if blocks is None:
+            yield from _iter_records(iter_segment_data(filename))
+        else:
+            yield from _iter_records(iter_block_data(filename, blocks))
+    except _READ_ERRORS as e:
+        logger.warning('Cannot read archive segment', file=filename, error=e)
+
+
+def load_indexes(directory: str) -> list:
+    """
+    :return: list of SegmentIndex of all segments in directory, oldest first
+    """
+    ret = []
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return ret
+    for name in names:
+        if not name.endswith(INDEX_EXTENSION):
+            continue
+        try:
+            index = SegmentIndex.load(os.path.join(directory, name))
+        except OSError as e:
+            logger.warning('Cannot read segment index', file=name, error=e)
+            continue
+        if (len(index.blocks) > 0) and os.path.isfile(index.filename):
+            ret.append(index)
+    ret.sort(key=lambda index: (index.first_time, index.filename))
+    return ret
+
+
+class QueryResult:
+    """
+    Iterates matching records; counters tell how much of the archive was read
+    """
+
+    def __init__(self, directory: str, q: ArchiveQuery):
+        self.query = q
+        self.num_segments = 0
+        self.num_blocks = 0
+        self.plan = []  # (segment file, list of blocks to read)
+        for index in load_indexes(directory):
+            self.num_segments += 1
+            self.num_blocks += len(index.blocks)
+            blocks = [block for block in index.blocks if q.may_match_block(block)]
+            if len(blocks) > 0:
+                self.plan.append((index.filename, blocks))
+        self.num_read_blocks = sum(len(blocks) for fn, blocks in self.plan)
+        self.num_read_records = 0
+        self.num_matched = 0
+
+    def __iter__(self):
+        for filename, blocks in self.plan:
+            for record in read_segment(filename, blocks):
+                self.num_read_records += 1
+                if self.query.matches(record):
+                    self.num_matched += 1
+                    yield record
+                    if (self.query.limit > 0) and (self.num_matched >= self.query.limit):
+                        return
+
+
+def query_archive(directory: str, q: ArchiveQuery) -> QueryResult:
+    return QueryResult(directory, q)
+
+
+class WebhookArchive:
+    """
+    Request handlers only put deliveries into a bounded queue (dropped, if
+    it is full); a writer thread parses them, collects them into blocks and
+    appends each block to current segment as a separate gzip member or zstd
+    frame, then appends block's line to segment's index. Blocks are written
+    when they reach BLOCK_SIZE bytes, flush_interval seconds after their
+    first record, or when a query asks for it. Queries flush, so the
+    interval can be long: at a few deliveries per minute short intervals
+    give tiny blocks, that compress poorly and need an index line each
+    (deliveries collected in memory are lost if the process is killed).
+    Segments are rotated by size and age, removed after keep_days or when
+    all of them take more than max_total_bytes. Several bot processes can
+    share a directory: segment names include host and pid.
+    """
+
+    BLOCK_SIZE = 256 * 1024
+
+    def __init__(self, directory: str, compression: str = 'gzip', level: int = 0,
+                 max_segment_bytes: int = 16 * 1024 * 1024, max_segment_age: float = 3600.0,
+                 flush_interval: float = 300.0, keep_days: float = 30.0,
+                 max_total_bytes: int = 1024 * 1024 * 1024, queue_size: int = 1000):
+        if (compression == 'zstd') and (zstandard is None):
+            logger.error('zstandard library is not installed, using gzip for webhook archive')
+            compression = 'gzip'
+        if compression not in SEGMENT_EXTENSIONS:
+            logger.error('Unknown webhook archive compression, using gzip', compression=compression)
+            compression = 'gzip'
+        self.directory = directory
+        self.compression = compression
+        self.level = level
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_age = max_segment_age
+        self.flush_interval = flush_interval
+        self.keep_days = keep_days
+        self.max_total_bytes = max_total_bytes
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._instance = '{0}-{1}'.format(re.sub(r'[^A-Za-z0-9_.-]', '_', socket.gethostname()), os.getpid())
+        self._compressor = None
+        if compression == 'zstd':
+            self._compressor = zstandard.ZstdCompressor(level=level if level > 0 else 3)
+        # writer thread state
+        self._segment = None  # SegmentIndex of current segment
+        self._key_ids = None  # current segment's name => {key => number}
+        self._segment_size = 0
+        self._segment_opened_at = 0.0
+        self._block = None  # BlockIndex of block being collected
+        self._block_lines = []
+        self._block_bytes = 0
+        self._block_started_at = 0.0
+        self._last_cleanup = 0.0
+        # statistics
+        self.num_records = 0
+        self.num_dropped = 0
+        self.num_blocks = 0
+        self.num_segments = 0
+        self.num_removed_segments = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError:
+            logger.error('Cannot create webhook archive dir', dir=directory)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._write_loop, name='WebhookArchive', daemon=True)
+        self._thread.start()
+
+    def append(self, headers: dict, body: str, received_at: float):
+        """
+        Called from request handler thread, never blocks
+        """
+        try:
+            self._queue.put_nowait((headers, body, received_at))
+        except queue.Full:
+            self.num_dropped += 1
+
+    def flush(self, timeout: float = 2.0) -> bool:
+        """
+        Writes out queued and collected deliveries, so that a query sees them
+        :return: False if writer did not make it in time
+        """
+        if (self._thread is None) or not self._thread.is_alive():
+            return False
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Writes out what is queued and closes current segment
+        """
+        if (self._thread is None) or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def query(self, q: ArchiveQuery) -> QueryResult:
+        self.flush()
+        return query_archive(self.directory, q)
+
+    def _write_loop(self):
+        while True:
+            timeout = None
+            if self._block is not None:
+                timeout = max(0.0, self._block_started_at + self.flush_interval - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False  # flush interval has passed
+            try:
+                if item is None:
+                    self._write_block()
+                    self._close_segment()
+                    return
+                if type(item) == tuple:
+                    self._add(*item)
+                    if (self._block_bytes < self.BLOCK_SIZE) and \
+                            (time.monotonic() - self._block_started_at < self.flush_interval):
+                        continue
+                self._write_block()
+                self._maybe_rotate()
+            except Exception as e:
+                logger.error('Webhook archive write failed', error=e)
+            if isinstance(item, threading.Event):
+                item.set()
+
+    def _add(self, headers: dict, body: str, received_at: float):
+        # bearer tokens must not be kept on disk
+        headers = {name: ('<redacted>' if name.lower() == 'authorization' else value)
+                   for name, value in headers.items()}
+        record = WebhookRecord(headers, body, received_at)
+        if self._segment is None:
+            self._open_segment()
+        if self._block is None:
+            self._block = BlockIndex(self._segment_size)
+            self._block_started_at = time.monotonic()
+        line = (record.to_json_line() + '\n').encode('utf-8')
+        self._block_lines.append(line)
+        self._block_bytes += len(line)
+        self._block.add(record)
+        self.num_records += 1
+
+    def _open_segment(self):
+        name = 'webhooks-{0}-{1}-{2}{3}'.format(time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), self._instance,
+                                                self.num_segments, SEGMENT_EXTENSIONS[self.compression])
+        self._segment = SegmentIndex(os.path.join(self.directory, name))
+        self._segment_size = 0
+        self._segment_opened_at = time.monotonic()
+        self._key_ids = {name: {} for name in KEY_NAMES}
+        self.num_segments += 1
+
+    def _write_block(self):
+        if self._block is None:
+            return
+        block = self._block
+        data = b''.join(self._block_lines)
+        self._block = None
+        self._block_lines = []
+        self._block_bytes = 0
+        if self.compression == 'zstd':
+            compressed = self._compressor.compress(data)
+        else:
+            compressed = gzip.compress(data, compresslevel=self.level if self.level > 0 else 6, mtime=0)
+        # block first, then its index line: indexed blocks are always complete
+        with open(self._segment.filename, mode='ab') as f:
+            f.write(compressed)
+        block.size = len(compressed)
+        self._segment_size += block.size
+        with open(self._segment.filename + INDEX_EXTENSION, mode='at', encoding='utf-8') as f:
+            f.write(block.to_json_line(self._key_ids) + '\n')
+        self._segment.blocks.append(block)
+        self.num_blocks += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(compressed)
+
+    def _close_segment(self):
+        if self._segment is None:
+            return
+        if len(self._segment.blocks) > 0:
+            with open(self._segment.filename + INDEX_EXTENSION, mode='at', encoding='utf-8') as f:
+                f.write('{"complete": true}\n')
+        self._segment = None
+
+    def _maybe_rotate(self):
+        if self._segment is None:
+            return
+        if (self._segment_size >= self.max_segment_bytes) or \
+                (time.monotonic() - self._segment_opened_at >= self.max_segment_age):
+            self._close_segment()
+        now = time.monotonic()
+        if (self._segment is None) or (now - self._last_cleanup >= 3600.0):
+            self._last_cleanup = now
+            self._remove_old_segments()
+
+    def _remove_old_segments(self):
+        indexes = load_indexes(self.directory)
+        min_time = time.time() - self.keep_days * 86400.0
+        total = sum(index.size for index in indexes)
+        for index in indexes:
+            if (self._segment is not None) and (index.filename == self._segment.filename):
+                continue
+            expired = index.last_time < min_time
+            # incomplete segment of another running instance is not removed for size
+            if not expired and ((total <= self.max_total_bytes) or not index.complete):
+                continue
+            try:
+                os.remove(index.filename)
+                os.remove(index.filename + INDEX_EXTENSION)
+            except OSError as e:
+                logger.warning('Cannot remove archive segment', file=index.filename, error=e)
+                continue
+            total -= index.size
+            self.num_removed_segments += 1
+            logger.info('Removed archive segment', file=os.path.basename(index.filename),
+                        expired=expired, total_size=total)
+
+    def get_stats(self) -> dict:
+        return {
+            'compression': self.compression,
+            'records': self.num_records,
+            'dropped': self.num_dropped,
+            'queued': self._queue.qsize(),
+            'blocks': self.num_blocks,
+            'segments': self.num_segments,
+            'removed_segments': self.num_removed_segments,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out
+        }
+
+
+def create_webhook_archive(config: dict):
+    """
+    :return: WebhookArchive, or None if archive is disabled
+    """
+    if not config['WEBHOOK_ARCHIVE_ENABLED']:
+        return None
+    return WebhookArchive(config['WEBHOOK_ARCHIVE_DIR'], config['WEBHOOK_ARCHIVE_COMPRESSION'],
+                          config['WEBHOOK_ARCHIVE_LEVEL'],
+                          int(config['WEBHOOK_ARCHIVE_MAX_SEGMENT_MB'] * 1024 * 1024),
+                          config['WEBHOOK_ARCHIVE_MAX_SEGMENT_AGE'], config['WEBHOOK_ARCHIVE_FLUSH_INTERVAL'],
+                          config['WEBHOOK_ARCHIVE_KEEP_DAYS'],
+                          int(config['WEBHOOK_ARCHIVE_MAX_TOTAL_MB'] * 1024 * 1024))
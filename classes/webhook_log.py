@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Readers for captured webhook traffic:
+# - text log, written by MovieBotRequestHandler.handle_webhook_chat() to _cache/log_webhook.txt
+# - compact JSON lines log, one delivery per line:
+#   {"time": 1460608477.678, "headers": {...}, "body": "..."}
+import json
+
+from classes import utils
+
+
+LOG_SEPARATOR = '--------------------------------------------------'
+
+
+class WebhookRecord:
+    """
+    One captured webhook delivery
+    """
+
+    def __init__(self, headers: dict, body: str, time: float = None):
+        self.headers = headers
+        self.body = body
+        # unix timestamp of delivery; text log does not store it,
+        # so it is taken from the latest 'time' of events in body
+        self.time = time
+        self.events = []
+        try:
+            json_object = json.loads(body)
+            if type(json_object) == dict:
+                json_object = [json_object]
+            if type(json_object) == list:
+                self.events = [e for e in json_object if type(e) == dict]
+        except ValueError:
+            pass
+        if self.time is None:
+            self.time = self.get_events_time()
+
+    def get_events_time(self):
+        ret = None
+        for event_dict in self.events:
+            if type(event_dict.get('time')) != str:
+                continue
+            dt = utils.parse_skype_datetime(event_dict['time'])
+            if dt is None:
+                continue
+            ts = dt.timestamp()
+            if (ret is None) or (ts > ret):
+                ret = ts
+        return ret
+
+    def to_json_line(self) -> str:
+        return json.dumps({'time': self.time, 'headers': self.headers, 'body': self.body},
+                          ensure_ascii=False, sort_keys=True)
+
+
+def parse_text_log(f):
+    """
+    Parses log_webhook.txt format:
+        headers:
+        Name: value
+        ...
+        <empty line>
+        body (JSON, pretty printed)
+        <empty line>
+        --------------------------------------------------
+    :param f: file object opened in text mode
+    :return: generator of WebhookRecord
+    """
+    headers = {}
+    body_lines = []
+    state = ''
+    for line in f:
+        line = line.rstrip('\r\n')
+        if line == LOG_SEPARATOR:
+            body = '\n'.join(body_lines).strip()
+            if (state != '') and (body != ''):
+                yield WebhookRecord(headers, body)
+            headers = {}
+            body_lines = []
+            state = ''
+            continue
+        if state == '':
+            if line == 'headers:':
+                state = 'headers'
+            continue
+        if state == 'headers':
+            if line == '':
+                state = 'body'
+                continue
+            name, sep, value = line.partition(': ')
+            headers[name] = value
+            continue
+        body_lines.append(line)
+
+
+def parse_jsonl_log(f):
+    """
+    Parses compact log format, one JSON object per line
+    :param f: file object opened in text mode
+    :return: generator of WebhookRecord
+    """
+    for line in f:
+        line = line.strip()
+        if line == '':
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            continue
+        if (type(obj) != dict) or ('body' not in obj):
+            continue
+        yield WebhookRecord(obj.get('headers', {}), obj['body'], obj.get('time'))
+
+
+def read_webhook_log(filename: str):
+    """
+    Reads log file of any supported format, detected by its first line,
+    or a compressed segment of webhook archive (classes/webhook_archive.py)
+    :return: generator of WebhookRecord
+    """
+    # imported here: webhook_archive imports this module
+    from classes import webhook_archive
+    if filename.endswith(tuple(webhook_archive.SEGMENT_EXTENSIONS.values())):
+        yield from webhook_archive.read_segment(filename)
+        return
+    with open(filename, mode='rt', encoding='utf-8', errors='replace') as f:
+        first_line = f.readline()
+        f.seek(0)
+        if first_line.lstrip().startswith('{'):
+            yield from parse_jsonl_log(f)
+        else:
+            yield from parse_text_log(f)
@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
-import sys
 import collections
-# external libraries
-import requests
-import requests.exceptions
+
+from classes import resilience
+from classes import log
+
+logger = log.get_logger('translate')
 
 
 class YandexTranslate:
@@ -21,6 +22,10 @@ class YandexTranslate:
         :return:          translated string
         """
 
+        # external library, imported on first use
+        import requests
+        import requests.exceptions
+
         retval = ''
 
         if fmt not in ['plain', 'html']:
@@ -32,15 +37,19 @@ class YandexTranslate:
         params['lang'] = src_lang + '-' + dst_lang
         params['format'] = fmt
 
+        dependency = resilience.get_dependency('translate')
         try:
-            r = requests.get(self._yt_url, params=params)
+            r = dependency.call(requests.get, self._yt_url, params=params, timeout=dependency.timeout,
+                                result_check=resilience.check_http_status)
             r.raise_for_status()
             response = r.json()
             if type(response) == dict:
                 if 'text' in response:
                     retval = response['text']
         except requests.exceptions.RequestException as re:
-            sys.stderr.write('Network error: {0}'.format(str(re)))
+            logger.error('Network error', error=re)
+        except resilience.DependencyError as de:
+            logger.error('Translate error', error=de)
 
         return retval
 
@@ -1,80 +1,102 @@
 #!/usr/bin/python3-utf8
+import os
 import sys
 import time
-import ssl
 import http.server
 import threading
 import configparser
 import socketserver
 import signal
+import socket
+import struct
 import json
-import time
 
-# check if all 3rd party libraries are installed
-try:
-    import mako
-except ImportError:
-    sys.stderr.write('Error: python library "mako" template engine not found!\n')
-    sys.stderr.write('Try the foolowing: pip3 install mako, or equivalent\n')
-    sys.exit(1)
-
-try:
-    import requests
-except ImportError:
-    sys.stderr.write('Error: python library "requests" not found!\n')
-    sys.stderr.write('Try the foolowing: pip3 install requests, or equivalent\n')
-    sys.exit(1)
-
-try:
-    import certifi
-except ImportError:
-    sys.stderr.write('Error: python library "certifi" not found!\n')
-    sys.stderr.write('Try the foolowing: pip3 install certifi, or equivalent\n')
-    sys.exit(1)
-
-try:
-    import tweepy
-except ImportError:
-    sys.stderr.write('Error: python library "tweepy" not found!\n')
-    sys.stderr.write('Try the foolowing: pip3 install tweepy, or equivalent\n')
-    sys.exit(1)
-
-
-from classes.skype_api import SkypeApi
-from classes.request_handler import MovieBotRequestHandler
-from classes.twitter_service import TwitterService
+import argparse
+import importlib.util
+
+from classes.startup_profile import profiler
+from classes import log
+
+# check if all 3rd party libraries are installed. Only look them up,
+# do not import: heavy ones (tweepy, mako) are imported on first use
+with profiler.phase('check 3rd party libraries'):
+    for lib_name in ['mako', 'requests', 'certifi', 'tweepy']:
+        if importlib.util.find_spec(lib_name) is None:
+            sys.stderr.write('Error: python library "{0}" not found!\n'.format(lib_name))
+            sys.stderr.write('Try the foolowing: pip3 install {0}, or equivalent\n'.format(lib_name))
+            sys.exit(1)
+
+with profiler.phase('import bot modules'):
+    from classes.skype_api import SkypeApi
+    from classes.request_handler import MovieBotRequestHandler
+    from classes.twitter_service import TwitterService
+    from classes.tls_service import TlsService
+    from classes.connection_tracker import ConnectionTracker
+    from classes.load_shedder import LoadShedder
+    from classes import systemd
+    from classes import video_metadata
+    from classes import resilience
+    from classes import dedup_cache
+    from classes import leader_election
+    from classes import webhook_archive
+    from classes import jwt_validator
+    from classes.outbox import Outbox
+    from classes.freshness import FreshnessTracker
+    from classes.memory_inspector import MemoryInspector
+    from classes.health import HealthReporter
+
+logger = log.get_logger('server')
 
 
 # First, inherit from ThreadingMixIn, so that its threaded process_request()
 # method overrides default synchronous from HTTPServer (TCPServer)
 class MovieBotService(socketserver.ThreadingMixIn, http.server.HTTPServer, threading.Thread):
-    def __init__(self):
+    def __init__(self, startup_profile: bool = False):
         #
         # first of all, load config
         self._cfg = configparser.ConfigParser()
         self.config = dict()
-        self.load_config()
+        with profiler.phase('load config'):
+            self.load_config()
+        log.configure(self.config)
+        resilience.configure(self.config)
+        self.startup_profile = startup_profile
+        self.warmup_done = False
         self._server_address = (self.config['BIND_ADDRESS'], self.config['BIND_PORT'])
         self._is_shutting_down = False
+        # listen() backlog; socketserver's default of 5 drops SYNs of connection bursts
+        self.request_queue_size = self.config['LISTEN_BACKLOG']
         #
         # Now, explicitly initialize both parent classes
-        http.server.HTTPServer.__init__(self, self._server_address, MovieBotRequestHandler)
+        # If started by systemd .socket unit, inherit listening socket from it,
+        # so that connections queue in kernel while we are restarting
+        listen_fds = systemd.get_listen_fds()
+        if len(listen_fds) > 0:
+            http.server.HTTPServer.__init__(self, self._server_address, MovieBotRequestHandler,
+                                            bind_and_activate=False)
+            self.socket.close()
+            self.socket = socket.socket(fileno=listen_fds[0])
+            self.server_address = self.socket.getsockname()
+            self.server_name = socket.getfqdn(self.server_address[0])
+            self.server_port = self.server_address[1]
+        else:
+            http.server.HTTPServer.__init__(self, self._server_address, MovieBotRequestHandler)
+        self.socket_activated = len(listen_fds) > 0
+        profiler.mark('listening socket bound')
         threading.Thread.__init__(self, daemon=False)
         #
-        # wrap server socket to SSL, if HTTPS was enabled
+        # prepare SSL context, if HTTPS was enabled. Listening socket stays
+        # plain, every accepted connection is wrapped in finish_request()
+        self.tls = None
         if self.config['USE_HTTPS'] and (self.config['SSL_CERT'] != '') \
                 and (self.config['SSL_KEY'] != ''):
-            cert_requirement = ssl.CERT_NONE  # do not require cert from peer
-            ca_certificates = None            # no CA certs
-            if self.config['VALIDATE_PEER_CERT']:
-                cert_requirement = ssl.CERT_REQUIRED  # require cert from peer
-                ca_certificates = certifi.where()     # look for CA certs here
-            self.socket = ssl.wrap_socket(self.socket,
-                                          keyfile=self.config['SSL_KEY'],
-                                          certfile=self.config['SSL_CERT'],
-                                          cert_reqs=cert_requirement,  # require cert from peer or not
-                                          ca_certs=ca_certificates,    # where to look for CA certs
-                                          server_side=True)
+            with profiler.phase('create SSL context'):
+                self.tls = TlsService(self.config)
+        #
+        # connection lifecycle: timeouts, per-IP limits
+        self.connections = ConnectionTracker(self.config)
+        # under overload, refuse low priority requests before webhooks suffer
+        self.load_shedder = LoadShedder(self.config, self.get_accept_queue_length)
         #
         self.server_version = 'MovieBot/1.0'
         self.user_shutdown_request = False
@@ -89,20 +111,68 @@ class MovieBotService(socketserver.ThreadingMixIn, http.server.HTTPServer, threa
             proto = 'http'
             if self.config['USE_HTTPS']:
                 proto = 'https'
-            print('{0} listening at {1}://{2}:{3}'.format(
-                self.server_version, proto, self.config['BIND_ADDRESS'], self.config['BIND_PORT']))
-            print('  My Bot ID: {0}'.format(self.get_my_skype_full_bot_id()))
+            logger.info('{0} listening at {1}://{2}:{3}{4}'.format(
+                self.server_version, proto, self.server_address[0], self.server_address[1],
+                ' (socket from systemd)' if self.socket_activated else ''),
+                bot_id=self.get_my_skype_full_bot_id())
         #
-        self.skype = SkypeApi(self.config)
+        with profiler.phase('load skype state'):
+            self.skype = SkypeApi(self.config)
+        # bearer token check of webhook requests
+        self.jwt_validator = jwt_validator.create_jwt_validator(self.config)
+        # recently processed webhook deliveries, to drop redelivered ones
+        self.dedup = dedup_cache.create_dedup_cache(self.config)
+        # tracemalloc control for /admin/memory
+        self.memory = MemoryInspector()
+        # does not connect to twitter yet, client is created on first use
         self.twitter = TwitterService(self.config)
         self.skype.twitter = self.twitter
         #
         # twitter saved state
-        self._twitter_check_timeout_sec = 15 * 60  # 15 mins
+        self._twitter_check_timeout_sec = self.config['TWITTER_CHECK_INTERVAL']
         self._twitter_savedata_fn = '_cache/twitter_savedata.json'
         self._posted_tweets = []
+        self._posted_tweets_lock = threading.Lock()
         self._skype_send_queue = []
-        self.load_posted_tweets()
+        # times (unix) of twitter polls, for status
+        self.twitter_last_check = None
+        self.twitter_next_check = None
+        with profiler.phase('load posted tweets'):
+            self.load_posted_tweets()
+        # with several instances only the elected leader polls twitter and broadcasts
+        self.leader = leader_election.create_leader_elector(self.config)
+        # broadcasts are delivered from durable outbox, with retries
+        self.outbox = Outbox(self.config['OUTBOX_SQLITE_FILE'], self.skype.send_message_status,
+                             max_attempts=self.config['OUTBOX_MAX_ATTEMPTS'],
+                             retry_delay=self.config['OUTBOX_RETRY_DELAY'],
+                             max_retry_delay=self.config['OUTBOX_MAX_RETRY_DELAY'],
+                             keep_days=self.config['OUTBOX_KEEP_DAYS'])
+        self.outbox.on_batch_done = self.on_broadcast_delivered
+        self.outbox.on_message_sent = self.on_broadcast_message_sent
+        # lag from tweet to chatrooms, by stage
+        self.freshness = FreshnessTracker()
+        self.skype.chatrooms.subscribe(self.on_chatrooms_changed)
+        self.outbox.is_active = self.is_leader
+        # a chatroom missing from our registry may be known to another instance:
+        # only skip chatrooms the bot was removed from
+        self.outbox.is_recipient_valid = lambda room: not self.skype.is_chatroom_left(room)
+        #
+        # videos metadata lookups (duration, thumbnail)
+        self.metadata = None
+        metadata_provider = video_metadata.create_metadata_provider(self.config)
+        if metadata_provider is not None:
+            self.metadata = video_metadata.VideoMetadataEnricher(
+                metadata_provider,
+                video_metadata.VideoMetadataCache(self.config['METADATA_CACHE_DIR'],
+                                                  self.config['METADATA_CACHE_SIZE']),
+                max_workers=self.config['METADATA_WORKERS'],
+                lookup_timeout=self.config['METADATA_LOOKUP_TIMEOUT'])
+        #
+        # compressed, indexed copy of webhook deliveries, for /admin/webhooks queries
+        self.webhook_archive = webhook_archive.create_webhook_archive(self.config)
+        #
+        # /healthz, /readyz, /status.json, prepared in background
+        self.health = HealthReporter(self, self.config)
 
     def load_config(self):
         # fill in the defaults
@@ -112,21 +182,114 @@ class MovieBotService(socketserver.ThreadingMixIn, http.server.HTTPServer, threa
         self.config['SSL_CERT'] = ''
         self.config['SSL_KEY'] = ''
         self.config['VALIDATE_PEER_CERT'] = False
+        self.config['SSL_CIPHERS'] = ''
+        self.config['SSL_MIN_VERSION'] = 'TLSv1_2'
+        self.config['SSL_MAX_VERSION'] = ''
+        self.config['SSL_HANDSHAKE_TIMEOUT'] = 10.0
+        self.config['SSL_SESSION_TICKETS'] = 2
+        self.config['HEADER_TIMEOUT'] = 10.0
+        self.config['BODY_TIMEOUT'] = 10.0
+        self.config['KEEPALIVE_TIMEOUT'] = 15.0
+        self.config['MAX_REQUESTS_PER_CONNECTION'] = 100
+        self.config['MAX_CONNECTIONS_PER_IP'] = 20
+        self.config['LISTEN_BACKLOG'] = 128
+        self.config['DRAIN_TIMEOUT'] = 25.0
+        self.config['ADMIN_TOKEN'] = ''
+        self.config['SHED_ENABLED'] = True
+        self.config['SHED_MAX_ACTIVE_REQUESTS'] = 16
+        self.config['SHED_MAX_LAG'] = 0.2
+        self.config['SHED_MAX_ACCEPT_QUEUE'] = 32
+        self.config['SHED_LOW_PRIORITY_SHARE'] = 0.5
+        self.config['SAVEDATA_FLUSH_DELAY'] = 0.0
+        self.config['SAVEDATA_MAX_FLUSH_DELAY'] = 5.0
         self.config['TEMPLATE_DIR'] = 'html'
         self.config['TEMPLATE_CACHE_DIR'] = '_cache/html'
         self.config['APP_ID'] = ''
         self.config['APP_SECRET'] = ''
         self.config['BOT_ID'] = ''
+        self.config['OAUTH_URL'] = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
+        self.config['SKYPE_API_URL'] = 'https://apis.skype.com'
         self.config['TWITTER_CONSUMER_KEY'] = ''
         self.config['TWITTER_CONSUMER_SECRET'] = ''
         self.config['TWITTER_ACCESS_TOKEN'] = ''
         self.config['TWITTER_ACCESS_TOKEN_SECRET'] = ''
         self.config['TWITTER_USER_TIMELINE'] = ''
+        self.config['TWITTER_API_HOST'] = 'api.twitter.com'
+        self.config['TWITTER_CHECK_INTERVAL'] = 15 * 60.0
+        self.config['TWITTER_MAX_POSTED_TWEETS'] = 1000
+        self.config['TWITTER_VIDEO_HOSTS'] = None  # all known
+        self.config['THROTTLE_ENABLED'] = True
+        self.config['THROTTLE_USER_LIMIT'] = 20
+        self.config['THROTTLE_USER_WINDOW'] = 60.0
+        self.config['THROTTLE_CONVERSATION_LIMIT'] = 40
+        self.config['THROTTLE_CONVERSATION_WINDOW'] = 60.0
+        self.config['THROTTLE_COMMAND_LIMIT'] = 30
+        self.config['THROTTLE_COMMAND_WINDOW'] = 60.0
+        self.config['THROTTLE_MAX_KEYS'] = 10000
+        self.config['THROTTLE_COOLDOWN_REPLY'] = True
+        self.config['DISPLAY_NAMES_CACHE_SIZE'] = 5000
+        self.config['DISPLAY_NAMES_TTL'] = 86400.0
+        self.config['DISPLAY_NAMES_BATCH_DELAY'] = 1.0
+        self.config['DISPLAY_NAMES_ROOM_INTERVAL'] = 600.0
+        self.config['METADATA_PROVIDER'] = 'none'
+        self.config['METADATA_LOCAL_FILE'] = ''
+        self.config['METADATA_NICOVIDEO_URL'] = 'https://ext.nicovideo.jp/api/getthumbinfo/'
+        self.config['METADATA_CACHE_DIR'] = '_cache/video_metadata'
+        self.config['METADATA_CACHE_SIZE'] = 1000
+        self.config['METADATA_WORKERS'] = 4
+        self.config['METADATA_LOOKUP_TIMEOUT'] = 5.0
+        self.config['METADATA_DEADLINE'] = 10.0
+        self.config['DEDUP_BACKEND'] = 'memory'
+        self.config['DEDUP_TTL'] = 600.0
+        self.config['DEDUP_MAX_ENTRIES'] = 10000
+        self.config['DEDUP_SQLITE_FILE'] = '_cache/webhook_dedup.sqlite'
+        self.config['LEADER_BACKEND'] = 'flock'
+        self.config['LEADER_LOCK_FILE'] = '_cache/leader.lock'
+        self.config['LEADER_SQLITE_FILE'] = '_cache/leader.sqlite'
+        self.config['LEADER_LEASE_TTL'] = 30.0
+        self.config['LEADER_HEARTBEAT'] = 5.0
+        self.config['LEADER_INSTANCE_ID'] = ''
+        self.config['WEBHOOK_AUTH_ENABLED'] = True
+        self.config['WEBHOOK_AUTH_OPENID_METADATA_URL'] = \
+            'https://login.botframework.com/v1/.well-known/openidconfiguration'
+        self.config['WEBHOOK_AUTH_ISSUER'] = 'https://api.botframework.com'
+        self.config['WEBHOOK_AUTH_KEYS_REFRESH_INTERVAL'] = 86400.0
+        self.config['WEBHOOK_AUTH_MIN_KEYS_REFRESH_INTERVAL'] = 60.0
+        self.config['WEBHOOK_AUTH_CLOCK_LEEWAY'] = 300.0
+        self.config['OUTBOX_SQLITE_FILE'] = '_cache/outbox.sqlite'
+        self.config['OUTBOX_MAX_ATTEMPTS'] = 10
+        self.config['OUTBOX_RETRY_DELAY'] = 10.0
+        self.config['OUTBOX_MAX_RETRY_DELAY'] = 600.0
+        self.config['OUTBOX_KEEP_DAYS'] = 7.0
+        self.config['HEALTH_REFRESH_INTERVAL'] = 5.0
+        self.config['HEALTH_MAX_OUTBOX_PENDING'] = 1000
+        self.config['HEALTH_MAX_SEND_QUEUE'] = 200
+        self.config['WEBHOOK_ARCHIVE_ENABLED'] = True
+        self.config['WEBHOOK_ARCHIVE_DIR'] = '_cache/webhook_archive'
+        self.config['WEBHOOK_ARCHIVE_COMPRESSION'] = 'gzip'
+        self.config['WEBHOOK_ARCHIVE_LEVEL'] = 0
+        self.config['WEBHOOK_ARCHIVE_MAX_SEGMENT_MB'] = 16.0
+        self.config['WEBHOOK_ARCHIVE_MAX_SEGMENT_AGE'] = 3600.0
+        self.config['WEBHOOK_ARCHIVE_FLUSH_INTERVAL'] = 300.0
+        self.config['WEBHOOK_ARCHIVE_KEEP_DAYS'] = 30.0
+        self.config['WEBHOOK_ARCHIVE_MAX_TOTAL_MB'] = 1024.0
+        self.config['WEBHOOK_TEXT_LOG'] = True
         # read config
         success_list = self._cfg.read('conf/bot.conf', encoding='utf-8')
         if 'conf/bot.conf' not in success_list:
-            sys.stderr.write('Failed to read config file: conf/bot.conf!\n')
+            logger.error('Failed to read config file: conf/bot.conf')
         # get values from config
+        self.load_log_config(self._cfg)
+        if self._cfg.has_section('resilience'):
+            # keys like twitter_timeout, skype_max_concurrent, oauth_failure_threshold
+            for key in self._cfg['resilience']:
+                dep_name, sep, param = key.partition('_')
+                value = self._cfg['resilience'][key]
+                if param in ['max_concurrent', 'failure_threshold']:
+                    value = int(value)
+                else:
+                    value = float(value)
+                self.config['DEP_{0}_{1}'.format(dep_name.upper(), param.upper())] = value
         if self._cfg.has_section('server'):
             if 'bind_address' in self._cfg['server']:
                 self.config['BIND_ADDRESS'] = str(self._cfg['server']['bind_address'])
@@ -144,6 +307,49 @@ class MovieBotService(socketserver.ThreadingMixIn, http.server.HTTPServer, threa
                 ivalidate_peer_cert = int(self._cfg['server']['validate_peer_cert'])
                 if ivalidate_peer_cert != 0:
                     self.config['VALIDATE_PEER_CERT'] = True
+            if 'ssl_ciphers' in self._cfg['server']:
+                self.config['SSL_CIPHERS'] = str(self._cfg['server']['ssl_ciphers'])
+            if 'ssl_min_version' in self._cfg['server']:
+                self.config['SSL_MIN_VERSION'] = str(self._cfg['server']['ssl_min_version'])
+            if 'ssl_max_version' in self._cfg['server']:
+                self.config['SSL_MAX_VERSION'] = str(self._cfg['server']['ssl_max_version'])
+            if 'ssl_handshake_timeout' in self._cfg['server']:
+                self.config['SSL_HANDSHAKE_TIMEOUT'] = float(self._cfg['server']['ssl_handshake_timeout'])
+            if 'ssl_session_tickets' in self._cfg['server']:
+                self.config['SSL_SESSION_TICKETS'] = int(self._cfg['server']['ssl_session_tickets'])
+            if 'header_timeout' in self._cfg['server']:
+                self.config['HEADER_TIMEOUT'] = float(self._cfg['server']['header_timeout'])
+            if 'body_timeout' in self._cfg['server']:
+                self.config['BODY_TIMEOUT'] = float(self._cfg['server']['body_timeout'])
+            if 'keepalive_timeout' in self._cfg['server']:
+                self.config['KEEPALIVE_TIMEOUT'] = float(self._cfg['server']['keepalive_timeout'])
+            if 'max_requests_per_connection' in self._cfg['server']:
+                self.config['MAX_REQUESTS_PER_CONNECTION'] = int(
+                    self._cfg['server']['max_requests_per_connection'])
+            if 'max_connections_per_ip' in self._cfg['server']:
+                self.config['MAX_CONNECTIONS_PER_IP'] = int(self._cfg['server']['max_connections_per_ip'])
+            if 'listen_backlog' in self._cfg['server']:
+                self.config['LISTEN_BACKLOG'] = int(self._cfg['server']['listen_backlog'])
+            if 'drain_timeout' in self._cfg['server']:
+                self.config['DRAIN_TIMEOUT'] = float(self._cfg['server']['drain_timeout'])
+            if 'savedata_flush_delay' in self._cfg['server']:
+                self.config['SAVEDATA_FLUSH_DELAY'] = float(self._cfg['server']['savedata_flush_delay'])
+            if 'savedata_max_flush_delay' in self._cfg['server']:
+                self.config['SAVEDATA_MAX_FLUSH_DELAY'] = float(self._cfg['server']['savedata_max_flush_delay'])
+        if self._cfg.has_section('admin'):
+            if 'token' in self._cfg['admin']:
+                self.config['ADMIN_TOKEN'] = self._cfg['admin']['token']
+        if self._cfg.has_section('load_shedding'):
+            if 'enabled' in self._cfg['load_shedding']:
+                self.config['SHED_ENABLED'] = int(self._cfg['load_shedding']['enabled']) != 0
+            if 'max_active_requests' in self._cfg['load_shedding']:
+                self.config['SHED_MAX_ACTIVE_REQUESTS'] = int(self._cfg['load_shedding']['max_active_requests'])
+            if 'max_lag' in self._cfg['load_shedding']:
+                self.config['SHED_MAX_LAG'] = float(self._cfg['load_shedding']['max_lag'])
+            if 'max_accept_queue' in self._cfg['load_shedding']:
+                self.config['SHED_MAX_ACCEPT_QUEUE'] = int(self._cfg['load_shedding']['max_accept_queue'])
+            if 'low_priority_share' in self._cfg['load_shedding']:
+                self.config['SHED_LOW_PRIORITY_SHARE'] = float(self._cfg['load_shedding']['low_priority_share'])
         if self._cfg.has_section('html'):
             if 'templates_dir' in self._cfg['html']:
                 self.config['TEMPLATE_DIR'] = self._cfg['html']['templates_dir']
@@ -156,6 +362,10 @@ class MovieBotService(socketserver.ThreadingMixIn, http.server.HTTPServer, threa
                 self.config['APP_SECRET'] = self._cfg['app']['app_secret']
             if 'bot_id' in self._cfg['app']:
                 self.config['BOT_ID'] = self._cfg['app']['bot_id']
+            if 'oauth_url' in self._cfg['app']:
+                self.config['OAUTH_URL'] = self._cfg['app']['oauth_url']
+            if 'skype_api_url' in self._cfg['app']:
+                self.config['SKYPE_API_URL'] = self._cfg['app']['skype_api_url'].rstrip('/')
         if self._cfg.has_section('twitter'):
             if 'app_consumer_key' in self._cfg['twitter']:
                 self.config['TWITTER_CONSUMER_KEY'] = self._cfg['twitter']['app_consumer_key']
@@ -167,10 +377,221 @@ class MovieBotService(socketserver.ThreadingMixIn, http.server.HTTPServer, threa
                 self.config['TWITTER_ACCESS_TOKEN_SECRET'] = self._cfg['twitter']['app_access_token_secret']
             if 'user_timeline' in self._cfg['twitter']:
                 self.config['TWITTER_USER_TIMELINE'] = self._cfg['twitter']['user_timeline']
+            if 'api_host' in self._cfg['twitter']:
+                self.config['TWITTER_API_HOST'] = self._cfg['twitter']['api_host']
+            if 'check_interval' in self._cfg['twitter']:
+                self.config['TWITTER_CHECK_INTERVAL'] = float(self._cfg['twitter']['check_interval'])
+            if 'max_posted_tweets' in self._cfg['twitter']:
+                self.config['TWITTER_MAX_POSTED_TWEETS'] = int(self._cfg['twitter']['max_posted_tweets'])
+            if 'video_hosts' in self._cfg['twitter']:
+                hosts = [h.strip() for h in self._cfg['twitter']['video_hosts'].split(',') if h.strip() != '']
+                if len(hosts) > 0:
+                    self.config['TWITTER_VIDEO_HOSTS'] = hosts
+        if self._cfg.has_section('throttle'):
+            if 'enabled' in self._cfg['throttle']:
+                self.config['THROTTLE_ENABLED'] = int(self._cfg['throttle']['enabled']) != 0
+            if 'user_limit' in self._cfg['throttle']:
+                self.config['THROTTLE_USER_LIMIT'] = int(self._cfg['throttle']['user_limit'])
+            if 'user_window' in self._cfg['throttle']:
+                self.config['THROTTLE_USER_WINDOW'] = float(self._cfg['throttle']['user_window'])
+            if 'conversation_limit' in self._cfg['throttle']:
+                self.config['THROTTLE_CONVERSATION_LIMIT'] = int(self._cfg['throttle']['conversation_limit'])
+            if 'conversation_window' in self._cfg['throttle']:
+                self.config['THROTTLE_CONVERSATION_WINDOW'] = float(
+                    self._cfg['throttle']['conversation_window'])
+            if 'command_limit' in self._cfg['throttle']:
+                self.config['THROTTLE_COMMAND_LIMIT'] = int(self._cfg['throttle']['command_limit'])
+            if 'command_window' in self._cfg['throttle']:
+                self.config['THROTTLE_COMMAND_WINDOW'] = float(self._cfg['throttle']['command_window'])
+            if 'max_keys' in self._cfg['throttle']:
+                self.config['THROTTLE_MAX_KEYS'] = int(self._cfg['throttle']['max_keys'])
+            if 'cooldown_reply' in self._cfg['throttle']:
+                self.config['THROTTLE_COOLDOWN_REPLY'] = int(self._cfg['throttle']['cooldown_reply']) != 0
+        if self._cfg.has_section('display_names'):
+            if 'cache_size' in self._cfg['display_names']:
+                self.config['DISPLAY_NAMES_CACHE_SIZE'] = int(self._cfg['display_names']['cache_size'])
+            if 'ttl' in self._cfg['display_names']:
+                self.config['DISPLAY_NAMES_TTL'] = float(self._cfg['display_names']['ttl'])
+            if 'batch_delay' in self._cfg['display_names']:
+                self.config['DISPLAY_NAMES_BATCH_DELAY'] = float(self._cfg['display_names']['batch_delay'])
+            if 'room_interval' in self._cfg['display_names']:
+                self.config['DISPLAY_NAMES_ROOM_INTERVAL'] = float(self._cfg['display_names']['room_interval'])
+        if self._cfg.has_section('metadata'):
+            if 'provider' in self._cfg['metadata']:
+                self.config['METADATA_PROVIDER'] = self._cfg['metadata']['provider']
+            if 'local_file' in self._cfg['metadata']:
+                self.config['METADATA_LOCAL_FILE'] = self._cfg['metadata']['local_file']
+            if 'nicovideo_url' in self._cfg['metadata']:
+                self.config['METADATA_NICOVIDEO_URL'] = self._cfg['metadata']['nicovideo_url']
+            if 'cache_dir' in self._cfg['metadata']:
+                self.config['METADATA_CACHE_DIR'] = self._cfg['metadata']['cache_dir']
+            if 'cache_size' in self._cfg['metadata']:
+                self.config['METADATA_CACHE_SIZE'] = int(self._cfg['metadata']['cache_size'])
+            if 'workers' in self._cfg['metadata']:
+                self.config['METADATA_WORKERS'] = int(self._cfg['metadata']['workers'])
+            if 'lookup_timeout' in self._cfg['metadata']:
+                self.config['METADATA_LOOKUP_TIMEOUT'] = float(self._cfg['metadata']['lookup_timeout'])
+            if 'deadline' in self._cfg['metadata']:
+                self.config['METADATA_DEADLINE'] = float(self._cfg['metadata']['deadline'])
+        if self._cfg.has_section('dedup'):
+            if 'backend' in self._cfg['dedup']:
+                self.config['DEDUP_BACKEND'] = self._cfg['dedup']['backend']
+            if 'ttl' in self._cfg['dedup']:
+                self.config['DEDUP_TTL'] = float(self._cfg['dedup']['ttl'])
+            if 'max_entries' in self._cfg['dedup']:
+                self.config['DEDUP_MAX_ENTRIES'] = int(self._cfg['dedup']['max_entries'])
+            if 'sqlite_file' in self._cfg['dedup']:
+                self.config['DEDUP_SQLITE_FILE'] = self._cfg['dedup']['sqlite_file']
+        if self._cfg.has_section('leader'):
+            if 'backend' in self._cfg['leader']:
+                self.config['LEADER_BACKEND'] = self._cfg['leader']['backend']
+            if 'lock_file' in self._cfg['leader']:
+                self.config['LEADER_LOCK_FILE'] = self._cfg['leader']['lock_file']
+            if 'sqlite_file' in self._cfg['leader']:
+                self.config['LEADER_SQLITE_FILE'] = self._cfg['leader']['sqlite_file']
+            if 'lease_ttl' in self._cfg['leader']:
+                self.config['LEADER_LEASE_TTL'] = float(self._cfg['leader']['lease_ttl'])
+            if 'heartbeat' in self._cfg['leader']:
+                self.config['LEADER_HEARTBEAT'] = float(self._cfg['leader']['heartbeat'])
+            if 'instance_id' in self._cfg['leader']:
+                self.config['LEADER_INSTANCE_ID'] = self._cfg['leader']['instance_id']
+        if self._cfg.has_section('webhook_auth'):
+            if 'enabled' in self._cfg['webhook_auth']:
+                self.config['WEBHOOK_AUTH_ENABLED'] = int(self._cfg['webhook_auth']['enabled']) != 0
+            if 'openid_metadata_url' in self._cfg['webhook_auth']:
+                self.config['WEBHOOK_AUTH_OPENID_METADATA_URL'] = self._cfg['webhook_auth']['openid_metadata_url']
+            if 'issuer' in self._cfg['webhook_auth']:
+                self.config['WEBHOOK_AUTH_ISSUER'] = self._cfg['webhook_auth']['issuer']
+            if 'keys_refresh_interval' in self._cfg['webhook_auth']:
+                self.config['WEBHOOK_AUTH_KEYS_REFRESH_INTERVAL'] = \
+                    float(self._cfg['webhook_auth']['keys_refresh_interval'])
+            if 'min_keys_refresh_interval' in self._cfg['webhook_auth']:
+                self.config['WEBHOOK_AUTH_MIN_KEYS_REFRESH_INTERVAL'] = \
+                    float(self._cfg['webhook_auth']['min_keys_refresh_interval'])
+            if 'clock_leeway' in self._cfg['webhook_auth']:
+                self.config['WEBHOOK_AUTH_CLOCK_LEEWAY'] = float(self._cfg['webhook_auth']['clock_leeway'])
+        if self._cfg.has_section('outbox'):
+            if 'sqlite_file' in self._cfg['outbox']:
+                self.config['OUTBOX_SQLITE_FILE'] = self._cfg['outbox']['sqlite_file']
+            if 'max_attempts' in self._cfg['outbox']:
+                self.config['OUTBOX_MAX_ATTEMPTS'] = int(self._cfg['outbox']['max_attempts'])
+            if 'retry_delay' in self._cfg['outbox']:
+                self.config['OUTBOX_RETRY_DELAY'] = float(self._cfg['outbox']['retry_delay'])
+            if 'max_retry_delay' in self._cfg['outbox']:
+                self.config['OUTBOX_MAX_RETRY_DELAY'] = float(self._cfg['outbox']['max_retry_delay'])
+            if 'keep_days' in self._cfg['outbox']:
+                self.config['OUTBOX_KEEP_DAYS'] = float(self._cfg['outbox']['keep_days'])
+        if self._cfg.has_section('health'):
+            if 'refresh_interval' in self._cfg['health']:
+                self.config['HEALTH_REFRESH_INTERVAL'] = float(self._cfg['health']['refresh_interval'])
+            if 'max_outbox_pending' in self._cfg['health']:
+                self.config['HEALTH_MAX_OUTBOX_PENDING'] = int(self._cfg['health']['max_outbox_pending'])
+            if 'max_send_queue' in self._cfg['health']:
+                self.config['HEALTH_MAX_SEND_QUEUE'] = int(self._cfg['health']['max_send_queue'])
+        if self._cfg.has_section('webhook_archive'):
+            if 'enabled' in self._cfg['webhook_archive']:
+                self.config['WEBHOOK_ARCHIVE_ENABLED'] = int(self._cfg['webhook_archive']['enabled']) != 0
+            if 'dir' in self._cfg['webhook_archive']:
+                self.config['WEBHOOK_ARCHIVE_DIR'] = self._cfg['webhook_archive']['dir']
+            if 'compression' in self._cfg['webhook_archive']:
+                self.config['WEBHOOK_ARCHIVE_COMPRESSION'] = self._cfg['webhook_archive']['compression'].strip()
+            if 'level' in self._cfg['webhook_archive']:
+                self.config['WEBHOOK_ARCHIVE_LEVEL'] = int(self._cfg['webhook_archive']['level'])
+            if 'max_segment_mb' in self._cfg['webhook_archive']:
+                self.config['WEBHOOK_ARCHIVE_MAX_SEGMENT_MB'] = float(self._cfg['webhook_archive']['max_segment_mb'])
+            if 'max_segment_age' in self._cfg['webhook_archive']:
+                self.config['WEBHOOK_ARCHIVE_MAX_SEGMENT_AGE'] = float(self._cfg['webhook_archive']['max_segment_age'])
+            if 'flush_interval' in self._cfg['webhook_archive']:
+                self.config['WEBHOOK_ARCHIVE_FLUSH_INTERVAL'] = float(self._cfg['webhook_archive']['flush_interval'])
+            if 'keep_days' in self._cfg['webhook_archive']:
+                self.config['WEBHOOK_ARCHIVE_KEEP_DAYS'] = float(self._cfg['webhook_archive']['keep_days'])
+            if 'max_total_mb' in self._cfg['webhook_archive']:
+                self.config['WEBHOOK_ARCHIVE_MAX_TOTAL_MB'] = float(self._cfg['webhook_archive']['max_total_mb'])
+            if 'text_log' in self._cfg['webhook_archive']:
+                self.config['WEBHOOK_TEXT_LOG'] = int(self._cfg['webhook_archive']['text_log']) != 0
+
+    def load_log_config(self, cfg: configparser.ConfigParser):
+        self.config['LOG_LEVEL'] = 'info'
+        self.config['LOG_LEVELS'] = {}
+        self.config['LOG_RATE_LIMIT_INTERVAL'] = 10.0
+        self.config['LOG_RATE_LIMIT_BURST'] = 5
+        if cfg.has_section('log'):
+            try:
+                if 'level' in cfg['log']:
+                    log.parse_level(cfg['log']['level'])
+                    self.config['LOG_LEVEL'] = cfg['log']['level']
+                if 'levels' in cfg['log']:
+                    self.config['LOG_LEVELS'] = log.parse_levels(cfg['log']['levels'])
+            except ValueError as ve:
+                logger.error('Invalid log level in config', error=ve)
+            if 'rate_limit_interval' in cfg['log']:
+                self.config['LOG_RATE_LIMIT_INTERVAL'] = float(cfg['log']['rate_limit_interval'])
+            if 'rate_limit_burst' in cfg['log']:
+                self.config['LOG_RATE_LIMIT_BURST'] = int(cfg['log']['rate_limit_burst'])
+
+    def reload_log_config(self):
+        """
+        Re-reads [log] section of config file, so log levels can be changed without restart
+        """
+        cfg = configparser.ConfigParser()
+        cfg.read('conf/bot.conf', encoding='utf-8')
+        self.load_log_config(cfg)
+        log.configure(self.config)
+        logger.info('Log levels reloaded', default_level=self.config['LOG_LEVEL'],
+                    levels=self.config['LOG_LEVELS'])
 
     def is_shutting_down(self):
         return self._is_shutting_down
 
+    # Overrides ThreadingMixIn.process_request(), called in serve_forever()
+    # thread right after accept(). Refuse connection if client IP has too many
+    def process_request(self, request, client_address):
+        if not self.connections.acquire(client_address[0]):
+            self.shutdown_request(request)
+            return
+        super(MovieBotService, self).process_request(request, client_address)
+
+    # Overrides ThreadingMixIn.process_request_thread(), runs in a new thread
+    def process_request_thread(self, request, client_address):
+        try:
+            super(MovieBotService, self).process_request_thread(request, client_address)
+        finally:
+            self.connections.release(client_address[0])
+
+    # Overrides BaseServer.finish_request(), called by ThreadingMixIn in a
+    # request handler thread. TLS handshake is done here, not in accept()
+    def finish_request(self, request, client_address):
+        # headers and body are separate writes: without TCP_NODELAY the body waits
+        # for delayed ACK (~40 ms) on kept-alive connections. systemd .socket sets it itself
+        try:
+            request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+        if self.tls is None:
+            super(MovieBotService, self).finish_request(request, client_address)
+            return
+        ssl_request = self.tls.wrap(request)
+        if ssl_request is None:
+            return
+        try:
+            self.RequestHandlerClass(ssl_request, client_address, self)
+        finally:
+            self.shutdown_request(ssl_request)
+
+    def get_accept_queue_length(self) -> int:
+        """
+        Connections completed by the kernel, but not yet accept()-ed: on Linux,
+        TCP_INFO of a listening socket has it in tcpi_unacked.
+        :return: queue length, or -1 if not known
+        """
+        if not hasattr(socket, 'TCP_INFO'):
+            return -1
+        try:
+            info = self.socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+            return struct.unpack_from('I', info, 24)[0]
+        except (OSError, struct.error):
+            return -1
+
     def get_template_engine_config(self) -> dict:
         ret = {
             'TEMPLATE_DIR': self.config['TEMPLATE_DIR'],
@@ -178,6 +599,73 @@ class MovieBotService(socketserver.ThreadingMixIn, http.server.HTTPServer, threa
         }
         return ret
 
+    def is_new_delivery(self, event_dict: dict) -> bool:
+        """
+        Checks webhook event against recently processed deliveries
+        :return: False if the same event was already processed
+        """
+        if self.dedup is None:
+            return True
+        key = dedup_cache.get_delivery_key(event_dict)
+        if key == '':
+            return True
+        return self.dedup.check_and_add(key)
+
+    def is_leader(self) -> bool:
+        """
+        :return: True if this instance should poll twitter and broadcast videos
+        """
+        if self.leader is None:
+            return True
+        return self.leader.is_leader()
+
+    def get_leader_stats(self):
+        """
+        :return: dict, or None if leader election is disabled
+        """
+        if self.leader is None:
+            return None
+        return self.leader.get_stats()
+
+    def get_outbox_stats(self) -> dict:
+        ret = self.outbox.get_counts()
+        ret['delivered'] = self.outbox.num_sent
+        ret['retried'] = self.outbox.num_retried
+        ret['failed_now'] = self.outbox.num_failed
+        ret['batches_done'] = self.outbox.num_batches_done
+        return ret
+
+    def get_memory_sizes(self) -> dict:
+        """
+        Sizes of bot's own long-lived structures, to see which of them grows
+        """
+        ret = {
+            'contacts': len(self.skype.contact_list),
+            'chatrooms': len(self.skype.chatrooms),
+            'posted_tweets': len(self._posted_tweets),
+            'skype_send_queue': len(self._skype_send_queue),
+            'command_reply_cache': self.skype.commands.get_cache_size(),
+            'throttle_keys': self.skype.throttle.get_num_tracked_keys(),
+            'display_names': len(self.skype.display_names.cache),
+            'dedup_entries': len(self.dedup) if self.dedup is not None else 0,
+            'freshness_pending_batches': self.freshness.get_pending_size(),
+            'active_connections': self.connections.num_active,
+            'threads': threading.active_count(),
+            'modules': len(sys.modules)
+        }
+        ret.update(self.connections.get_sizes())
+        if self.metadata is not None:
+            ret.update(self.metadata.get_sizes())
+        if self.webhook_archive is not None:
+            ret['webhook_archive_queue'] = self.webhook_archive.get_stats()['queued']
+        return ret
+
+    def get_log_stats(self) -> dict:
+        return log.get_stats()
+
+    def get_dependencies_stats(self) -> list:
+        return [dep.get_stats() for dep in resilience.get_all_dependencies()]
+
     def get_my_skype_full_bot_id(self):
         return '28:' + self.config['BOT_ID']
 
@@ -185,94 +673,267 @@ class MovieBotService(socketserver.ThreadingMixIn, http.server.HTTPServer, threa
         try:
             with open(self._twitter_savedata_fn, mode='rt', encoding='utf-8') as f:
                 s = f.read()
-                json_object = json.loads(s, encoding='utf-8')
-                self._posted_tweets = json_object['posted_tweets']
-                print('Loaded {0} posted tweets.'.format(len(self._posted_tweets)))
+                json_object = json.loads(s)
+                with self._posted_tweets_lock:
+                    self._posted_tweets = json_object['posted_tweets']
+                logger.info('Loaded posted tweets', num_tweets=len(self._posted_tweets))
         except OSError:
             pass
 
     def save_posted_tweets(self):
-        try:
-            with open(self._twitter_savedata_fn, mode='wt', encoding='utf-8') as f:
-                f.write(json.dumps({'posted_tweets': self._posted_tweets}, sort_keys=True, indent=4))
-        except OSError:
-            pass
+        # write to temporary file and rename, so that a standby instance,
+        # taking over leadership, never reads a half-written file
+        tmp_fn = self._twitter_savedata_fn + '.tmp'
+        with self._posted_tweets_lock:
+            try:
+                with open(tmp_fn, mode='wt', encoding='utf-8') as f:
+                    f.write(json.dumps({'posted_tweets': self._posted_tweets}, sort_keys=True, indent=4))
+                os.replace(tmp_fn, self._twitter_savedata_fn)
+            except OSError:
+                pass
+
+    def on_broadcast_delivered(self, batch_id: int, tweet_ids: list):
+        """
+        Called by outbox worker, when every chatroom has accepted the message with these tweets
+        """
+        with self._posted_tweets_lock:
+            self._posted_tweets.extend(tweet_ids)  # remember posted tweets
+            # each poll loads only the latest tweets, older ones need not be remembered
+            del self._posted_tweets[:-self.config['TWITTER_MAX_POSTED_TWEETS']]
+        self.save_posted_tweets()
+        self.freshness.batch_done(batch_id)
+
+    def on_broadcast_message_sent(self, batch_id: int, conversation: str):
+        self.freshness.message_delivered(batch_id, conversation, time.time())
+
+    def on_chatrooms_changed(self, registry, action: str, key, value):
+        if action == registry.ACTION_REMOVE:
+            self.freshness.forget_room(key)
 
     def get_bb_videos_from_twitter(self):
         bbvids = self.twitter.get_bb_videos(25)
         if len(bbvids) < 1:
             return
+        # tweets that are still being delivered are not posted yet, but are not new either
+        queued_tweets = self.outbox.get_tweet_ids()
+        detected_at = time.time()
         for bbv in bbvids:
-            if bbv['tweet_id'] not in self._posted_tweets:
+            if (bbv['tweet_id'] not in self._posted_tweets) and (bbv['tweet_id'] not in queued_tweets):
+                self.freshness.video_detected(bbv, detected_at)
                 self._skype_send_queue.append(bbv)
-        print('{0} new vids to be sent of {1} loaded tweets.'.format(
-            len(self._skype_send_queue), len(bbvids)))
+        logger.info('New videos to be sent', num_new=len(self._skype_send_queue),
+                    num_loaded=len(bbvids))
+        # lookup duration/thumbnail, but never wait longer than deadline
+        if (self.metadata is not None) and (len(self._skype_send_queue) > 0):
+            self.metadata.enrich(self._skype_send_queue, self.config['METADATA_DEADLINE'])
 
     def post_videos_to_skype(self):
         if len(self._skype_send_queue) < 1:
             return
-        # merge all new videos tweets into one skype message
-        # to avoid flooding
-        message = ''
+        # leadership could be lost while we were polling twitter and
+        # looking up metadata; the new leader will post these videos
+        if not self.is_leader():
+            logger.warning('Not a leader anymore, dropping queued videos',
+                           num_videos=len(self._skype_send_queue))
+            self._skype_send_queue = []
+            return
+        # merge all new videos tweets into one skype message per chatroom
+        # to avoid flooding; each chatroom gets only videos it is subscribed to
+        lines = {}  # chatroom => list of message lines
+        videos_per_room = {}  # chatroom => list of videos
         for bbv in self._skype_send_queue:
-            self._posted_tweets.append(bbv['tweet_id'])  # remember posted tweet
-            message += '{0} - {1}\n'.format(bbv['title'], bbv['url'])
-        if len(message) > 0:
-            # remove trailing newline
-            message = message[:-1]
-            self.skype.broadcast_to_chatrooms(message)
-        # clear send queue and save posted tweets
+            if 'duration' in bbv:
+                line = '{0} [{1}] - {2}'.format(
+                    bbv['title'], video_metadata.format_duration(bbv['duration']), bbv['url'])
+            else:
+                line = '{0} - {1}'.format(bbv['title'], bbv['url'])
+            for room in self.skype.get_broadcast_recipients(bbv):
+                lines.setdefault(room, []).append(line)
+                videos_per_room.setdefault(room, []).append(bbv)
+        messages = {room: '\n'.join(room_lines) for room, room_lines in lines.items()}
+        # tweets count as posted when outbox has delivered messages to every chatroom
+        batch_id = self.outbox.enqueue_broadcast([bbv['tweet_id'] for bbv in self._skype_send_queue], messages)
+        self.freshness.broadcast_queued(batch_id, self._skype_send_queue, videos_per_room, time.time())
         self._skype_send_queue = []
-        self.save_posted_tweets()
+
+    def SIGHUP_received(self):
+        if self.tls is not None:
+            self.tls.reload()
+        self.reload_log_config()
 
     def SIGTERM_received(self):
-        self.skype.save_data()
-        self.save_posted_tweets()
+        # do not exit right now, BG thread will stop accepting connections,
+        # finish what is in flight, and then save state
+        self.user_shutdown_request = True
+
+    def save_state(self):
+        # saves contacts/chatrooms only if they have unsaved changes
+        self.skype.savedata_flusher.stop()
+        # standby's list is stale, it must not overwrite leader's file
+        if self.is_leader():
+            self.save_posted_tweets()
+
+    def drain(self):
+        """
+        Called after HTTP server has stopped accepting connections.
+        Waits for in-flight requests, sends queued videos and saves state,
+        all within drain timeout.
+        """
+        deadline = time.monotonic() + self.config['DRAIN_TIMEOUT']
+        self.connections.close_idle()
+        while (self.connections.num_active > 0) and (time.monotonic() < deadline):
+            time.sleep(0.1)
+        if self.connections.num_active > 0:
+            logger.warning('Connections still active after drain timeout',
+                           num_active=self.connections.num_active)
+        if len(self._skype_send_queue) > 0:
+            logger.info('Queueing videos before exit', num_videos=len(self._skype_send_queue))
+            self.post_videos_to_skype()
+        # what is not delivered by deadline stays in outbox for the next start;
+        # in startup profile mode outbox worker was not started
+        if self.is_leader() and not self.startup_profile and not self.outbox.wait_idle(max(0.0, deadline - time.monotonic())):
+            logger.warning('Outbox not drained before exit', **self.outbox.get_counts())
+        self.outbox.stop()
+        self.save_state()
+        if self.leader is not None:
+            self.leader.stop()
+        if self.metadata is not None:
+            self.metadata.shutdown()
+        self.load_shedder.stop()
+        self.skype.display_names.stop()
+        self.health.stop()
+        if self.webhook_archive is not None:
+            self.webhook_archive.stop()
+
+    def warmup(self):
+        """
+        Slow initialization, that is done in a separate thread,
+        while HTTP server is already accepting connections.
+        """
+        logger.info('Warmup: authorize to Microsoft services')
+        with profiler.phase('refresh OAuth token'):
+            self.skype.refresh_token()
+        if self.jwt_validator is not None:
+            with profiler.phase('fetch token signing keys'):
+                self.jwt_validator.key_cache.prefetch()
+        if self.startup_profile:
+            # normally these are loaded on first use, here
+            # load them all to see how long it takes
+            with profiler.phase('init twitter client'):
+                self.twitter.get_api()
+            with profiler.phase('init template engine'):
+                from classes.template_engine import TemplateEngine
+                tmpl = TemplateEngine(self.get_template_engine_config())
+                tmpl.assign('server', self)
+                tmpl.render('status.html')
+            with profiler.phase('init translation'):
+                from classes import yandex_translate
+        self.warmup_done = True
+        profiler.mark('warmup done')
+        if self.startup_profile:
+            print(profiler.report())
+            self.user_shutdown_request = True
 
     # background thread function
     def run(self):
-        print('BG Thread started')
-        print('BG Thread: authorize to Microsoft services...')
-        self.skype.refresh_token()
+        logger.info('BG Thread started')
+        threading.Thread(target=self.warmup, name='Warmup', daemon=True).start()
+        if self.startup_profile:
+            # only startup is measured: no election, no broadcasts, no twitter polls;
+            # warmup sets user_shutdown_request when it is done
+            while not self.user_shutdown_request:
+                time.sleep(0.1)
+        else:
+            self.poll_loop()
+        #
+        # we've received shutdown request, so we must stop HTTP server now
+        logger.info('BG Thread: shutting down http server')
+        systemd.notify('STOPPING=1')
+        self._is_shutting_down = True
+        self.shutdown()
+        self.drain()
+        self.server_close()
+        logger.info('BG Thread: ending')
+        return
+
+    def poll_loop(self):
+        """
+        Starts background workers, then checks twitter every
+        _twitter_check_timeout_sec, while this instance is the leader,
+        until shutdown is requested
+        """
+        if self.leader is not None:
+            self.leader.start()
+        self.outbox.start()
+        self.health.start()
+        if self.webhook_archive is not None:
+            self.webhook_archive.start()
         #
         last_action_time = int(time.time())
         # wait 5 seconds before checking twitter and posting to skype
         last_action_time -= self._twitter_check_timeout_sec + 5
+        self.twitter_next_check = last_action_time + self._twitter_check_timeout_sec
+        was_leader = self.is_leader()
         #
         while not self.user_shutdown_request:
             time.sleep(1)
             # maybe do some work...?
             cur_time = int(time.time())
+            is_leader = self.is_leader()
+            if is_leader != was_leader:
+                was_leader = is_leader
+                if is_leader:
+                    # previous leader has saved what it posted; check twitter in 5 seconds
+                    logger.info('Became leader, taking over twitter polling')
+                    self.load_posted_tweets()
+                    # chatrooms, that only the previous leader has seen, get broadcasts too
+                    self.skype.merge_savedata()
+                    self.outbox.wake_up()
+                    last_action_time = cur_time - self._twitter_check_timeout_sec + 5
+                    self.twitter_next_check = last_action_time + self._twitter_check_timeout_sec
+                else:
+                    logger.info('Became standby, twitter polling stopped')
+            if not is_leader:
+                continue
             if (cur_time - last_action_time) >= self._twitter_check_timeout_sec:
-                print('...time to check twitter...')
+                logger.info('Time to check twitter')
                 last_action_time = cur_time
+                self.twitter_last_check = cur_time
+                self.twitter_next_check = cur_time + self._twitter_check_timeout_sec
                 self.get_bb_videos_from_twitter()
                 self.post_videos_to_skype()
-        #
-        # we've received shutdown request, so we must stop HTTP server now
-        print('BG Thread: shutting down http server')
-        self._is_shutting_down = True
-        self.shutdown()
-        print('BG Thread: ending')
-        return
 
 
 if __name__ == '__main__':
-    srv = MovieBotService()
+    ap = argparse.ArgumentParser(description='Skype MovieBot')
+    ap.add_argument('--startup-profile', action='store_true', default=False,
+                    help='print time spent in each import and initialization phase, then exit')
+    args = ap.parse_args()
+
+    log.setup()
+    srv = MovieBotService(startup_profile=args.startup_profile)
+    if srv.config['WEBHOOK_TEXT_LOG']:
+        log.setup_traffic_log('_cache/log_webhook.txt')
 
 
     def sighandler_SIGTERM(sig, frame_object):
-        print('Got termination signal, saving and stopping')
+        logger.info('Got termination signal, draining and stopping')
         srv.SIGTERM_received()
-        sys.exit(0)
+
+    def sighandler_SIGHUP(sig, frame_object):
+        logger.info('Got SIGHUP, reloading SSL certificates and log levels')
+        srv.SIGHUP_received()
 
     if sys.platform == 'linux':
         signal.signal(signal.SIGTERM, sighandler_SIGTERM)
+        signal.signal(signal.SIGHUP, sighandler_SIGHUP)
 
     # start BG thread
     srv.start()
 
     # start http server
+    systemd.notify('READY=1')
+    profiler.mark('listener accepting connections')
     try:
         srv.serve_forever()
     except KeyboardInterrupt:
@@ -280,4 +941,7 @@ if __name__ == '__main__':
         # stop also BG Thread then
         srv.user_shutdown_request = True
 
-    print('{0}: stopped.'.format(srv.name))
+    # wait for BG thread to drain and save state, then write out the last log records
+    srv.join()
+    logger.info('{0}: stopped.'.format(srv.name))
+    log.shutdown()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classes.command_router import CommandRouter, CommandContext
+
+
+class CommandRouterCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = CommandRouter()
+        # registered like in SkypeApi: !help lists commands of the scope it is called in
+        self.router.register('!help', self.cmd_help, CommandRouter.SCOPE_ANY, exact=True, cache_ttl=3600)
+        self.router.register('!resend', lambda ctx: None, CommandRouter.SCOPE_DM, args_mode='rest')
+        self.router.register('!subscribe', lambda ctx: None, CommandRouter.SCOPE_GROUP, args_mode='rest')
+
+    def cmd_help(self, ctx: CommandContext):
+        return ' '.join(cmd.name for cmd in self.router.get_commands(ctx.scope))
+
+    def run_command(self, message: str, scope: int) -> str:
+        cmd, args = self.router.resolve(message, scope)
+        ctx = CommandContext(cmd, scope, '8:user', '8:user', '8:user', args)
+        return self.router.invoke(ctx)
+
+    def test_cached_reply_is_per_scope(self):
+        dm_reply = self.run_command('!help', CommandRouter.SCOPE_DM)
+        group_reply = self.run_command('!help', CommandRouter.SCOPE_GROUP)
+        self.assertEqual(dm_reply, '!help !resend')
+        self.assertEqual(group_reply, '!help !subscribe')
+        # both are served from cache now, each for its own scope
+        self.assertEqual(self.run_command('!help', CommandRouter.SCOPE_DM), dm_reply)
+        self.assertEqual(self.run_command('!help', CommandRouter.SCOPE_GROUP), group_reply)
+        self.assertEqual(self.router._commands['!help'].num_cache_hits, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of video link extraction (classes/video_extractors.py) over
+large batches of synthetic tweets: the registry (host lookup, then one
+combined regex of that domain's patterns), against one regex of all hosts'
+patterns and against trying every pattern one at a time. Synthetic
+hosts are added to see how they scale with the number of known hosts.
+
+Examples:
+    python tools/bench_extractors.py
+    python tools/bench_extractors.py --tweets 100000 --extra-hosts 0,20,100
+"""
+import os
+import sys
+import re
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classes import video_extractors
+
+
+def make_extra_extractor(n: int) -> video_extractors.VideoExtractor:
+    return video_extractors.VideoExtractor(
+        'host{0}'.format(n), ('video{0}.example.com'.format(n),),
+        (r'(?:www\.)?video{0}\.example\.com/(?:watch|v)/(?P<id>\d+)'.format(n),),
+        'https://video{0}.example.com/v/{{0}}'.format(n))
+
+
+def make_url(rnd: random.Random, num_extra: int) -> str:
+    n = rnd.randint(1, 99999999)
+    kind = rnd.randint(0, 9)
+    if kind == 0:
+        return 'http://www.nicovideo.jp/watch/sm{0}'.format(n)
+    if kind == 1:
+        return 'https://sp.nicovideo.jp/watch/sm{0}?ref=twitter'.format(n)
+    if kind == 2:
+        return 'http://nico.ms/sm{0}'.format(n)
+    if kind == 3:
+        return 'https://www.youtube.com/watch?v={0:011d}&t=42'.format(n)
+    if kind == 4:
+        return 'https://youtu.be/{0:011d}'.format(n)
+    if kind == 5:
+        return 'https://www.twitch.tv/videos/{0}'.format(n)
+    if (kind == 6) and (num_extra > 0):
+        return 'https://video{0}.example.com/v/{1}'.format(rnd.randrange(num_extra), n)
+    # most links in tweets are not videos
+    return rnd.choice(['https://example.com/news/{0}', 'https://twitter.com/user/status/{0}',
+                       'https://www.nicovideo.jp/user/{0}', 'https://www.youtube.com/channel/{0}']).format(n)
+
+
+def make_tweets(num: int, num_extra: int, seed: int) -> list:
+    rnd = random.Random(seed)
+    tweets = []
+    for i in range(num):
+        urls = [make_url(rnd, num_extra) for j in range(rnd.randint(0, 3))]
+        text = '"Tournament video part{0}" - https://t.co/x{0} #sm{0}'.format(i)
+        tweets.append((urls, text))
+    return tweets
+
+
+class OneAtATime:
+    """
+    Baseline: each pattern of each host is compiled and tried separately
+    """
+
+    def __init__(self, extractors: list):
+        self.patterns = [(extractor, re.compile(r'https?://' + pattern + r'(?=[/?#&]|$)', re.IGNORECASE))
+                         for extractor in extractors for pattern in extractor.url_patterns]
+
+    def extract(self, urls: list):
+        for url in urls:
+            for extractor, regex in self.patterns:
+                m = regex.match(url)
+                if m is not None:
+                    video_id = extractor.canonical_id(m.group('id'))
+                    return {'host': extractor.name, 'video_id': video_id,
+                            'url': extractor.canonical_url(video_id)}
+        return None
+
+
+class SingleRegex:
+    """
+    One regex of all hosts' patterns, without lookup by host
+    """
+
+    def __init__(self, extractors: list):
+        self.regex, self.owners = video_extractors.ExtractorRegistry._compile(extractors)
+
+    def extract(self, urls: list):
+        for url in urls:
+            m = self.regex.match(url)
+            if m is not None:
+                group = m.lastgroup
+                extractor = self.owners[group]
+                video_id = extractor.canonical_id(m.group(group + '_id'))
+                return {'host': extractor.name, 'video_id': video_id,
+                        'url': extractor.canonical_url(video_id)}
+        return None
+
+
+def run(extract_fn, registry: video_extractors.ExtractorRegistry, tweets: list):
+    t0 = time.perf_counter()
+    videos = []
+    for urls, text in tweets:
+        link = extract_fn(urls)
+        if link is not None:
+            link['title'] = registry.extract_title(link['host'], text)
+            videos.append(link)
+    return time.perf_counter() - t0, videos
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark video link extraction over tweet batches')
+    ap.add_argument('--tweets', type=int, default=20000, help='tweets in a batch')
+    ap.add_argument('--extra-hosts', default='0,10,50', help='comma-separated numbers of synthetic hosts')
+    ap.add_argument('--repeat', type=int, default=3, help='best of that many runs')
+    ap.add_argument('--seed', type=int, default=1)
+    args = ap.parse_args()
+
+    print('{0:>6s} {1:>8s} {2:>8s} {3:>8s} {4:>12s} {5:>12s} {6:>12s}'.format(
+        'hosts', 'patterns', 'urls', 'videos', 'registry us', 'one regex us', 'one-by-one us'))
+    for num_extra in [int(n) for n in args.extra_hosts.split(',')]:
+        registry = video_extractors.create_registry()
+        for n in range(num_extra):
+            registry.register(make_extra_extractor(n))
+        extractors = [registry.get(name) for name in registry.get_names()]
+        one_by_one = OneAtATime(extractors)
+        strategies = [registry.extract, SingleRegex(extractors).extract, one_by_one.extract]
+        tweets = make_tweets(args.tweets, num_extra, args.seed)
+        num_urls = sum(len(urls) for urls, text in tweets)
+        times = [None] * len(strategies)
+        results = [None] * len(strategies)
+        for i in range(args.repeat):
+            for j, extract_fn in enumerate(strategies):
+                t, results[j] = run(extract_fn, registry, tweets)
+                times[j] = t if times[j] is None else min(times[j], t)
+        if any(videos != results[0] for videos in results):
+            sys.stderr.write('Results differ with {0} extra hosts\n'.format(num_extra))
+            return 1
+        print('{0:6d} {1:8d} {2:8d} {3:8d} {4:12.2f} {5:12.2f} {6:12.2f}'.format(
+            len(extractors), len(one_by_one.patterns), num_urls, len(results[0]),
+            *[t * 1e6 / num_urls for t in times]))
+    print('us: microseconds per URL, including title extraction of found videos')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Queries webhook archive (classes/webhook_archive.py) on disk, without a
+running bot: prints matching deliveries as compact JSON lines, that
+tools/replay_webhooks.py reads. Only blocks, whose index can match, are
+decompressed; numbers of read blocks and records go to stderr.
+
+Examples:
+    python tools/query_webhooks.py --list
+    python tools/query_webhooks.py --since -2h --conversation '19:abc@thread.skype'
+    python tools/query_webhooks.py --since 2026-10-19T08:00:00Z --until 2026-10-19T09:00:00Z \\
+        --activity message --limit 0 > incident.jsonl
+"""
+import os
+import sys
+import argparse
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classes import webhook_archive
+
+
+def format_time(ts) -> str:
+    if ts is None:
+        return '-'
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def list_segments(directory: str):
+    indexes = webhook_archive.load_indexes(directory)
+    print('{0:<60s} {1:>20s} {2:>20s} {3:>7s} {4:>8s} {5:>10s} {6}'.format(
+        'segment', 'first', 'last', 'blocks', 'records', 'bytes', 'complete'))
+    for index in indexes:
+        info = index.to_dict()
+        print('{0:<60s} {1:>20s} {2:>20s} {3:7d} {4:8d} {5:10d} {6}'.format(
+            info['file'], format_time(info['first_time']), format_time(info['last_time']),
+            info['blocks'], info['records'], info['size'], 'yes' if info['complete'] else 'no'))
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Query archived webhook deliveries')
+    ap.add_argument('--dir', default='_cache/webhook_archive', help='archive directory')
+    ap.add_argument('--list', action='store_true', default=False, help='list segments and exit')
+    ap.add_argument('--since', default='', help='unix time, ISO UTC time, or relative: -15m, -2h, -1d')
+    ap.add_argument('--until', default='', help='same formats as --since')
+    ap.add_argument('--conversation', default=None, help='group chat 19:..., or user of a direct chat')
+    ap.add_argument('--sender', default=None, help='skype ID of event sender, 8:...')
+    ap.add_argument('--activity', default=None, help='message, contactRelationUpdate, ...')
+    ap.add_argument('--limit', type=int, default=1000, help='max deliveries to print, 0 - all')
+    args = ap.parse_args()
+
+    if args.list:
+        list_segments(args.dir)
+        return 0
+    try:
+        q = webhook_archive.ArchiveQuery(since=webhook_archive.parse_time(args.since),
+                                         until=webhook_archive.parse_time(args.until),
+                                         conversation=args.conversation, sender=args.sender,
+                                         activity=args.activity, limit=args.limit)
+    except ValueError as ve:
+        sys.stderr.write('{0}\n'.format(ve))
+        return 2
+    result = webhook_archive.query_archive(args.dir, q)
+    try:
+        for record in result:
+            sys.stdout.write(record.to_json_line() + '\n')
+    except BrokenPipeError:
+        # output piped to head: do not fail again when stdout is flushed at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+    sys.stderr.write('matched {0}, read {1} records in {2}/{3} blocks of {4}/{5} segments\n'.format(
+        result.num_matched, result.num_read_records, result.num_read_blocks, result.num_blocks,
+        len(result.plan), result.num_segments))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
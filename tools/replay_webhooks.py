@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Replays captured webhook traffic (_cache/log_webhook.txt, compact JSON
+lines log, or segments of _cache/webhook_archive) against a running bot and reports latency distribution,
+error rates and outbound API calls (counted by tools/standin_apis.py).
+
+Examples:
+    python tools/replay_webhooks.py _cache/log_webhook.txt --mode realtime
+    python tools/replay_webhooks.py log1.txt log2.txt --mode accelerated --speed 60
+    python tools/replay_webhooks.py log.txt --mode max --concurrency 16 \\
+        --rewrite-conversations --stats-url http://127.0.0.1:9443/_stats
+    python tools/replay_webhooks.py log.txt --auth-token-url \
+        'https://127.0.0.1:9443/_token?aud=<bot app_id>&ttl=86400'
+    python tools/replay_webhooks.py log.txt --convert log.jsonl
+"""
+import os
+import sys
+import ssl
+import json
+import time
+import queue
+import argparse
+import threading
+import http.client
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classes import webhook_log
+
+
+# headers, that are set by http.client or make no sense to replay
+SKIP_HEADERS = ['host', 'content-length', 'connection', 'transfer-encoding', 'accept-encoding']
+
+
+class RecordRewriter:
+    """
+    Changes events before replay:
+    - appends run suffix to activity ids, so that bot's dedup cache
+      does not drop deliveries already seen in previous runs;
+    - optionally maps conversation IDs to synthetic ones, so that replayed
+      traffic does not mix with state of real conversations.
+    """
+
+    def __init__(self, run_id: str, rewrite_ids: bool, rewrite_conversations: bool):
+        self.run_id = run_id
+        self.rewrite_ids = rewrite_ids
+        self.rewrite_conversations = rewrite_conversations
+        self._conversations = {}
+
+    def map_conversation(self, skypeid: str) -> str:
+        if skypeid not in self._conversations:
+            self._conversations[skypeid] = '19:replay-{0}-{1}@thread.skype'.format(
+                self.run_id, len(self._conversations) + 1)
+        return self._conversations[skypeid]
+
+    def rewrite(self, record: webhook_log.WebhookRecord) -> bytes:
+        if (len(record.events) == 0) or not (self.rewrite_ids or self.rewrite_conversations):
+            return record.body.encode('utf-8')
+        events = []
+        for event_dict in record.events:
+            event_dict = dict(event_dict)
+            if self.rewrite_ids and ('id' in event_dict):
+                event_dict['id'] = '{0}-{1}'.format(event_dict['id'], self.run_id)
+            if self.rewrite_conversations:
+                for field in ['from', 'to']:
+                    value = event_dict.get(field)
+                    if (type(value) == str) and value.startswith('19:'):
+                        event_dict[field] = self.map_conversation(value)
+            events.append(event_dict)
+        return json.dumps(events).encode('utf-8')
+
+
+class ReplayStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.statuses = {}
+        self.num_errors = 0
+        self.max_lag = 0.0
+
+    def add(self, status, latency: float, lag: float):
+        with self._lock:
+            if status is None:
+                self.num_errors += 1
+            else:
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+                self.latencies.append(latency)
+            if lag > self.max_lag:
+                self.max_lag = lag
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    if len(sorted_values) == 0:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class ReplayWorker(threading.Thread):
+    def __init__(self, target: urllib.parse.SplitResult, ssl_context, timeout: float,
+                 jobs: queue.Queue, stats: ReplayStats):
+        super(ReplayWorker, self).__init__(daemon=True)
+        self._target = target
+        self._ssl_context = ssl_context
+        self._timeout = timeout
+        self._jobs = jobs
+        self._stats = stats
+        self._conn = None
+
+    def connect(self):
+        if self._target.scheme == 'https':
+            return http.client.HTTPSConnection(self._target.hostname, self._target.port or 443,
+                                               timeout=self._timeout, context=self._ssl_context)
+        return http.client.HTTPConnection(self._target.hostname, self._target.port or 80,
+                                          timeout=self._timeout)
+
+    def run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            scheduled_at, headers, body = job
+            lag = max(0.0, time.monotonic() - scheduled_at)
+            status = None
+            t0 = time.perf_counter()
+            # one retry on a fresh connection, server may have closed kept-alive one
+            for attempt in range(2):
+                try:
+                    if self._conn is None:
+                        self._conn = self.connect()
+                    self._conn.request('POST', self._target.path or '/', body=body, headers=headers)
+                    r = self._conn.getresponse()
+                    r.read()
+                    status = r.status
+                    if r.getheader('Connection', '').lower() == 'close':
+                        self._conn.close()
+                        self._conn = None
+                    break
+                except (OSError, http.client.HTTPException):
+                    if self._conn is not None:
+                        self._conn.close()
+                        self._conn = None
+                    t0 = time.perf_counter()
+            self._stats.add(status, time.perf_counter() - t0, lag)
+        if self._conn is not None:
+            self._conn.close()
+
+
+def fetch_json(url: str, method: str = 'GET', ssl_context=None):
+    try:
+        req = urllib.request.Request(url, method=method, data=b'' if method == 'POST' else None)
+        with urllib.request.urlopen(req, timeout=5, context=ssl_context) as r:
+            return json.loads(r.read().decode('utf-8'))
+    except (OSError, ValueError) as e:
+        sys.stderr.write('Cannot fetch {0}: {1}\n'.format(url, str(e)))
+        return None
+
+
+def load_records(filenames: list, limit: int) -> list:
+    records = []
+    for fn in filenames:
+        for record in webhook_log.read_webhook_log(fn):
+            records.append(record)
+            if (limit > 0) and (len(records) >= limit):
+                return records
+    return records
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Replay captured webhook traffic against a running bot')
+    ap.add_argument('logs', nargs='+', help='log_webhook.txt or compact JSON lines logs')
+    ap.add_argument('--url', default='https://127.0.0.1:8000/webhook_chat')
+    ap.add_argument('--mode', choices=['realtime', 'accelerated', 'max'], default='max')
+    ap.add_argument('--speed', type=float, default=10.0, help='time acceleration for accelerated mode')
+    ap.add_argument('--concurrency', type=int, default=4, help='number of parallel connections')
+    ap.add_argument('--limit', type=int, default=0, help='replay only first N deliveries')
+    ap.add_argument('--timeout', type=float, default=10.0)
+    ap.add_argument('--rewrite-conversations', action='store_true',
+                    help='replace conversation IDs with synthetic ones')
+    ap.add_argument('--keep-ids', action='store_true',
+                    help='do not make activity ids unique for this run (bot will drop repeated ones); '
+                         'events without id are unique per run only with --rewrite-conversations')
+    ap.add_argument('--verify', default='', help='CA file to verify bot certificate, default: no verification')
+    ap.add_argument('--stats-url', default='', help='stand-in APIs /_stats URL, to count outbound calls')
+    ap.add_argument('--convert', default='', help='only convert logs to compact JSON lines file')
+    ap.add_argument('--auth-token-url', default='',
+                    help='stand-in APIs /_token URL: send its token as "Authorization: Bearer", '
+                         'instead of captured (expired) ones')
+    args = ap.parse_args()
+
+    records = load_records(args.logs, args.limit)
+    if args.convert != '':
+        with open(args.convert, mode='wt', encoding='utf-8') as f:
+            for record in records:
+                f.write(record.to_json_line() + '\n')
+        print('Converted {0} deliveries to {1}'.format(len(records), args.convert))
+        return 0
+    if len(records) == 0:
+        sys.stderr.write('No webhook deliveries found in logs\n')
+        return 1
+
+    ssl_context = ssl.create_default_context(cafile=args.verify if args.verify != '' else None)
+    if args.verify == '':
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    auth_token = ''
+    if args.auth_token_url != '':
+        token_reply = fetch_json(args.auth_token_url, 'GET', ssl_context)
+        if token_reply is None:
+            return 1
+        auth_token = token_reply['token']
+    target = urllib.parse.urlsplit(args.url)
+    rewriter = RecordRewriter(str(int(time.time())), not args.keep_ids, args.rewrite_conversations)
+    stats = ReplayStats()
+    jobs = queue.Queue(maxsize=args.concurrency * 4)
+    workers = [ReplayWorker(target, ssl_context, args.timeout, jobs, stats)
+               for i in range(args.concurrency)]
+    for w in workers:
+        w.start()
+    if args.stats_url != '':
+        fetch_json(args.stats_url.replace('/_stats', '/_reset'), 'POST', ssl_context)
+
+    speed = {'realtime': 1.0, 'accelerated': args.speed, 'max': 0.0}[args.mode]
+    first_time = None
+    started = time.monotonic()
+    for record in records:
+        scheduled_at = time.monotonic()
+        if (speed > 0) and (record.time is not None):
+            if first_time is None:
+                first_time = record.time
+            scheduled_at = started + max(0.0, record.time - first_time) / speed
+            delay = scheduled_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        headers = {k: v for k, v in record.headers.items() if k.lower() not in SKIP_HEADERS}
+        headers['Content-Type'] = 'application/json'
+        if auth_token != '':
+            headers = {k: v for k, v in headers.items() if k.lower() != 'authorization'}
+            headers['Authorization'] = 'Bearer ' + auth_token
+        jobs.put((scheduled_at, headers, rewriter.rewrite(record)))
+    for w in workers:
+        jobs.put(None)
+    for w in workers:
+        w.join()
+    duration = time.monotonic() - started
+
+    latencies = sorted(stats.latencies)
+    num_sent = len(latencies) + stats.num_errors
+    num_ok = sum(n for status, n in stats.statuses.items() if 200 <= status < 300)
+    print('Replayed {0} deliveries in {1:.2f} s ({2:.1f} req/s), mode {3}'.format(
+        num_sent, duration, num_sent / duration if duration > 0 else 0.0, args.mode))
+    print('  HTTP statuses: {0}'.format(', '.join(
+        '{0}: {1}'.format(status, n) for status, n in sorted(stats.statuses.items()))))
+    print('  error rate: {0:.2%} (non-2xx: {1}, connection errors: {2})'.format(
+        (num_sent - num_ok) / num_sent, num_sent - num_ok - stats.num_errors, stats.num_errors))
+    if len(latencies) > 0:
+        print('  latency ms: mean {0:.1f}, p50 {1:.1f}, p90 {2:.1f}, p99 {3:.1f}, max {4:.1f}'.format(
+            sum(latencies) * 1000.0 / len(latencies), percentile(latencies, 50) * 1000.0,
+            percentile(latencies, 90) * 1000.0, percentile(latencies, 99) * 1000.0,
+            latencies[-1] * 1000.0))
+    if speed > 0:
+        print('  max schedule lag: {0:.1f} ms'.format(stats.max_lag * 1000.0))
+    if args.stats_url != '':
+        # bot sends replies asynchronously in some cases, give it a moment
+        time.sleep(1.0)
+        standin_stats = fetch_json(args.stats_url, ssl_context=ssl_context)
+        if standin_stats is not None:
+            print('  outbound calls: {0}'.format(', '.join(
+                '{0}: {1}'.format(k, v) for k, v in sorted(standin_stats['counts'].items()))))
+            print('  outbound failures injected: {0}'.format(standin_stats['errors']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
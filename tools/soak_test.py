@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+"""
+Soak test: runs the bot for a long time against tools/standin_apis.py
+and fails if its resource usage keeps growing. Slow degradations (threads
+piling up, RSS creeping, savedata files growing) do not show in a
+single request, only over hours of work.
+
+The bot runs in a scratch directory (its own conf/bot.conf and _cache/),
+with time accelerated by --speed: twitter check interval, OAuth token
+lifetime, signing keys refresh, expiry of remembered webhook deliveries
+and new tweets in the stand-in timeline all come that many times more often. Meanwhile the tool sends a mix of
+webhook traffic: chat messages and commands, subscription changes,
+contacts added/removed and the bot joining/leaving chatrooms, drawn from
+fixed pools of users and chatrooms, so that state is churned but bounded.
+
+Every --sample-interval seconds it samples the bot process (/proc: RSS,
+threads, open file descriptors), sizes of its structures (/admin/memory
+sizes) and disk usage of _cache/ (state files, savedata JSON files and
+traffic logs separately). The first sample after --warmup is the baseline;
+the test fails if any metric in the last sample has grown over the baseline
+more than its bound, if the bot dies, or if it does not stop cleanly.
+
+Examples:
+    python tools/soak_test.py --duration 3600 --speed 60
+    python tools/soak_test.py --duration 600 --rate 20 --bound rss_mb=20 \\
+        --bound posted_tweets=1000 --csv soak.csv
+Linux only. Certificate for the stand-ins is generated with openssl,
+unless --cert and --key are given.
+"""
+import os
+import sys
+import ssl
+import json
+import time
+import random
+import signal
+import uuid
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import configparser
+import http.client
+import urllib.request
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# allowed growth over baseline; None - only reported.
+# Sizes from /admin/memory not listed here are bounded by --max-state-growth
+DEFAULT_BOUNDS = {
+    'rss_mb': 40.0,
+    'threads': 10,
+    'fds': 20,
+    'cache_kb': 8192,  # sqlite WAL files grow to ~4 MB before checkpoints start reusing them
+    'savedata_kb': 256,
+    'logs_kb': None,
+    'modules': None,
+    'active_connections': 10
+}
+
+# kind of webhook event => weight
+EVENT_MIX = [('message', 50), ('command', 30), ('subscription', 6), ('contact', 7), ('chatroom', 7)]
+COMMANDS = ['!help', '!get_videos', '!subscriptions']
+SUBSCRIPTIONS = ['part1', 'part2', 'tournament', 'source:bb_video_', 'source:nobody']
+
+
+class TrafficGenerator(threading.Thread):
+    """
+    Sends webhook events at a steady rate over one kept-alive connection,
+    reconnecting now and then, like the bot platform does.
+    """
+
+    def __init__(self, port: int, bot_id: str, get_token, rate: float, num_users: int, num_rooms: int):
+        super(TrafficGenerator, self).__init__(name='Traffic', daemon=True)
+        self.port = port
+        self.bot_id = '28:' + bot_id
+        self.get_token = get_token
+        self.rate = rate
+        self.users = ['8:soak.user{0}'.format(i) for i in range(num_users)]
+        self.rooms = ['19:soak-room{0}@thread.skype'.format(i) for i in range(num_rooms)]
+        self.stopped = threading.Event()
+        self._conn = None
+        self._num_events = 0
+        self._kinds = [kind for kind, weight in EVENT_MIX for i in range(weight)]
+        # statistics
+        self.statuses = {}
+        self.num_errors = 0
+
+    def make_event(self) -> dict:
+        self._num_events += 1
+        kind = random.choice(self._kinds)
+        user = random.choice(self.users)
+        room = random.choice(self.rooms)
+        event = {'from': user, 'to': room, 'id': 'soak-{0}-{1}'.format(os.getpid(), self._num_events),
+                 'time': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())}
+        if kind == 'message':
+            event['activity'] = 'message'
+            event['content'] = 'soak message {0}'.format(self._num_events)
+            if random.random() < 0.2:
+                event['to'] = self.bot_id  # direct message
+        elif kind == 'command':
+            event['activity'] = 'message'
+            event['content'] = random.choice(COMMANDS)
+        elif kind == 'subscription':
+            event['activity'] = 'message'
+            event['content'] = '{0} {1}'.format(random.choice(['!subscribe', '!unsubscribe']),
+                                                random.choice(SUBSCRIPTIONS))
+        elif kind == 'contact':
+            event['activity'] = 'contactRelationUpdate'
+            event['action'] = random.choice(['add', 'remove'])
+            event['fromDisplayName'] = user[2:].replace('.', ' ').title()
+            event['to'] = self.bot_id
+        else:
+            event['activity'] = 'conversationUpdate'
+            # chatrooms are joined more often than left, so most of them are active
+            event['membersAdded' if random.random() < 0.7 else 'membersRemoved'] = [self.bot_id]
+        return event
+
+    def send(self, body: bytes):
+        headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + self.get_token()}
+        for attempt in range(2):
+            try:
+                if self._conn is None:
+                    self._conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+                self._conn.request('POST', '/webhook_chat', body=body, headers=headers)
+                r = self._conn.getresponse()
+                r.read()
+                self.statuses[r.status] = self.statuses.get(r.status, 0) + 1
+                if r.getheader('Connection', '').lower() == 'close':
+                    self.close()
+                return
+            except (OSError, http.client.HTTPException):
+                self.close()
+        self.num_errors += 1
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def run(self):
+        interval = 1.0 / self.rate
+        next_at = time.monotonic()
+        while not self.stopped.is_set():
+            self.send(json.dumps([self.make_event()]).encode('utf-8'))
+            if random.random() < 0.05:
+                self.close()
+            next_at += interval
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                self.stopped.wait(delay)
+            else:
+                next_at = time.monotonic()
+        self.close()
+
+
+class TokenSource:
+    """
+    Webhook bearer tokens from stand-in's /_token, renewed at half of their lifetime
+    """
+
+    def __init__(self, url: str, ssl_context, ttl: int = 3600):
+        self.url = '{0}&ttl={1}'.format(url, ttl)
+        self.ssl_context = ssl_context
+        self.ttl = ttl
+        self._token = ''
+        self._renew_at = 0.0
+
+    def get(self) -> str:
+        if time.monotonic() >= self._renew_at:
+            reply = fetch_json(self.url, ssl_context=self.ssl_context)
+            if reply is not None:
+                self._token = reply['token']
+                self._renew_at = time.monotonic() + self.ttl / 2
+        return self._token
+
+
+def fetch_json(url: str, headers: dict = None, ssl_context=None):
+    try:
+        req = urllib.request.Request(url, headers=headers or {})
+        with urllib.request.urlopen(req, timeout=5, context=ssl_context) as r:
+            return json.loads(r.read().decode('utf-8'))
+    except (OSError, ValueError) as e:
+        sys.stderr.write('Cannot fetch {0}: {1}\n'.format(url, str(e)))
+        return None
+
+
+def wait_for_port(port: int, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+        try:
+            conn.connect()
+            return True
+        except OSError:
+            time.sleep(0.2)
+        finally:
+            conn.close()
+    return False
+
+
+def read_proc_status(pid: int) -> dict:
+    ret = {}
+    with open('/proc/{0}/status'.format(pid), mode='rt') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                ret['rss_mb'] = int(line.split()[1]) / 1024.0
+            elif line.startswith('Threads:'):
+                ret['threads'] = int(line.split()[1])
+    ret['fds'] = len(os.listdir('/proc/{0}/fd'.format(pid)))
+    return ret
+
+
+def cache_usage(cache_dir: str) -> dict:
+    """
+    :return: KB used by state files, of them by savedata JSON files, and by traffic logs
+    """
+    state = savedata = logs = 0
+    for dirpath, dirnames, filenames in os.walk(cache_dir):
+        for fn in filenames:
+            try:
+                size = os.path.getsize(os.path.join(dirpath, fn))
+            except OSError:
+                continue  # temporary file was renamed meanwhile
+            if fn.endswith('.txt'):
+                logs += size
+                continue
+            state += size
+            if fn.endswith('.json') and (dirpath == cache_dir):
+                savedata += size
+    return {'cache_kb': state / 1024.0, 'savedata_kb': savedata / 1024.0, 'logs_kb': logs / 1024.0}
+
+
+def write_bot_config(workdir: str, args, standin: str, admin_token: str) -> configparser.ConfigParser:
+    cfg = configparser.ConfigParser()
+    cfg.read(os.path.join(REPO_DIR, 'conf', 'bot.conf'), encoding='utf-8')
+    for section in ['server', 'app', 'twitter', 'metadata', 'webhook_auth', 'dedup', 'admin', 'html', 'log']:
+        if not cfg.has_section(section):
+            cfg.add_section(section)
+    keys_refresh = max(10, int(86400 / args.speed))
+    cfg['server'].update({'bind_address': '127.0.0.1', 'bind_port': str(args.port), 'https': '0'})
+    # auth service refuses to get tokens for the sample app_id from conf/bot.conf
+    cfg['app'].update({'app_id': str(uuid.uuid4()), 'oauth_url': standin + '/common/oauth2/v2.0/token',
+                       'skype_api_url': standin})
+    cfg['twitter'].update({'api_host': standin.split('://', 1)[1],
+                           'check_interval': str(max(2.0, args.poll_interval / args.speed))})
+    cfg['metadata']['nicovideo_url'] = standin + '/api/getthumbinfo/'
+    cfg['webhook_auth'].update({'enabled': '1',
+                                'openid_metadata_url': standin + '/v1/.well-known/openidconfiguration',
+                                'keys_refresh_interval': str(keys_refresh),
+                                'min_keys_refresh_interval': str(min(60, keys_refresh))})
+    # remembered webhook deliveries should expire during the test too
+    cfg['dedup']['ttl'] = str(max(10, int(float(cfg['dedup'].get('ttl', '600')) / args.speed)))
+    cfg['admin']['token'] = admin_token
+    cfg['html']['templates_dir'] = os.path.join(REPO_DIR, 'html')
+    cfg['log']['level'] = 'warning'
+    os.makedirs(os.path.join(workdir, 'conf'), exist_ok=True)
+    os.makedirs(os.path.join(workdir, '_cache'), exist_ok=True)
+    with open(os.path.join(workdir, 'conf', 'bot.conf'), mode='wt', encoding='utf-8') as f:
+        cfg.write(f)
+    return cfg
+
+
+def make_certificate(workdir: str):
+    cert = os.path.join(workdir, 'standin.crt')
+    key = os.path.join(workdir, 'standin.key')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+                    '-days', '30', '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1'],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+def parse_bounds(values: list) -> dict:
+    bounds = dict(DEFAULT_BOUNDS)
+    for value in values:
+        name, sep, limit = value.partition('=')
+        if sep == '':
+            raise ValueError('bound should be name=value: ' + value)
+        bounds[name.strip()] = None if limit.strip() in ['', 'none'] else float(limit)
+    return bounds
+
+
+def check_bounds(baseline: dict, last: dict, samples: list, bounds: dict, max_state_growth: float) -> list:
+    """
+    :return: list of report rows (metric, baseline, last, max, growth, bound, ok)
+    """
+    rows = []
+    for name in sorted(baseline):
+        if name == 't':
+            continue
+        bound = bounds.get(name, max_state_growth)
+        growth = last.get(name, 0) - baseline[name]
+        peak = max(s.get(name, 0) for s in samples)
+        rows.append((name, baseline[name], last.get(name, 0), peak, growth, bound,
+                     (bound is None) or (growth <= bound)))
+    return rows
+
+
+def format_value(value) -> str:
+    if value is None:
+        return '-'
+    if type(value) == float:
+        return '{0:.1f}'.format(value)
+    return str(value)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Soak test: run the bot for hours against stand-in APIs, '
+                                             'fail if its resource usage grows')
+    ap.add_argument('--duration', type=float, default=3600.0, help='real seconds to run')
+    ap.add_argument('--speed', type=float, default=60.0, help='time acceleration of periodic work')
+    ap.add_argument('--warmup', type=float, default=120.0, help='seconds before the baseline sample')
+    ap.add_argument('--sample-interval', type=float, default=15.0)
+    ap.add_argument('--rate', type=float, default=5.0, help='webhook events per second')
+    ap.add_argument('--users', type=int, default=50, help='number of simulated users')
+    ap.add_argument('--rooms', type=int, default=20, help='number of simulated chatrooms')
+    ap.add_argument('--poll-interval', type=float, default=900.0,
+                    help='twitter check interval, simulated seconds')
+    ap.add_argument('--tweet-every', type=float, default=1800.0,
+                    help='a new tweet appears every that many simulated seconds')
+    ap.add_argument('--port', type=int, default=18000, help='bot port (plain HTTP)')
+    ap.add_argument('--standin-port', type=int, default=19443)
+    ap.add_argument('--cert', default='', help='stand-in certificate, default: generate with openssl')
+    ap.add_argument('--key', default='')
+    ap.add_argument('--workdir', default='', help='bot working directory, default: temporary, removed at exit')
+    ap.add_argument('--bound', action='append', default=[],
+                    help='allowed growth of a metric over baseline, like rss_mb=30 or posted_tweets=1000; '
+                         '"none" disables the check')
+    ap.add_argument('--max-state-growth', type=float, default=200,
+                    help='allowed growth of bot structures (/admin/memory sizes) without own --bound')
+    ap.add_argument('--csv', default='', help='write all samples to this CSV file')
+    args = ap.parse_args()
+    if not sys.platform.startswith('linux'):
+        sys.stderr.write('Soak test samples /proc, it runs on Linux only\n')
+        return 2
+    try:
+        bounds = parse_bounds(args.bound)
+    except ValueError as ve:
+        sys.stderr.write(str(ve) + '\n')
+        return 2
+
+    workdir = args.workdir if args.workdir != '' else tempfile.mkdtemp(prefix='moviebot-soak-')
+    os.makedirs(workdir, exist_ok=True)
+    cert, key = args.cert, args.key
+    if cert == '':
+        cert, key = make_certificate(workdir)
+    standin = 'https://127.0.0.1:{0}'.format(args.standin_port)
+    admin_token = 'soak-{0}'.format(random.getrandbits(64))
+    cfg = write_bot_config(workdir, args, standin, admin_token)
+    ssl_context = ssl.create_default_context(cafile=cert)
+
+    standin_proc = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_DIR, 'tools', 'standin_apis.py'), '--port', str(args.standin_port),
+         '--cert', cert, '--key', key, '--token-ttl', str(max(60, int(3600 / args.speed))),
+         '--new-tweet-every', str(args.tweet_every / args.speed)],
+        stdout=subprocess.DEVNULL, stderr=open(os.path.join(workdir, 'standin.log'), 'wb'))
+    bot_proc = None
+    traffic = None
+    samples = []
+    failures = []
+    try:
+        if not wait_for_port(args.standin_port, 10):
+            failures.append('stand-in APIs did not start')
+            return 1
+        env = dict(os.environ)
+        env['REQUESTS_CA_BUNDLE'] = cert
+        bot_proc = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'server.py')], cwd=workdir, env=env,
+                                    stdout=subprocess.DEVNULL, stderr=open(os.path.join(workdir, 'bot.log'), 'wb'))
+        if not wait_for_port(args.port, 30):
+            failures.append('bot did not start listening, see ' + os.path.join(workdir, 'bot.log'))
+            return 1
+        print('Soak test: {0:.0f} s ({1:.1f} simulated hours), bot pid {2}, workdir {3}'.format(
+            args.duration, args.duration * args.speed / 3600.0, bot_proc.pid, workdir))
+        tokens = TokenSource('{0}/_token?aud={1}'.format(standin, cfg['app']['app_id']), ssl_context)
+        traffic = TrafficGenerator(args.port, cfg['app']['bot_id'], tokens.get, args.rate, args.users, args.rooms)
+        traffic.start()
+
+        started = time.monotonic()
+        baseline = None
+        while True:
+            elapsed = time.monotonic() - started
+            if bot_proc.poll() is not None:
+                failures.append('bot exited with code {0} after {1:.0f} s'.format(bot_proc.returncode, elapsed))
+                break
+            sample = {'t': round(elapsed)}
+            sizes = fetch_json('http://127.0.0.1:{0}/admin/memory?action=sizes'.format(args.port),
+                               {'Authorization': 'Bearer ' + admin_token})
+            if sizes is not None:
+                sample.update(sizes)
+            try:
+                sample.update(read_proc_status(bot_proc.pid))
+            except OSError:
+                continue  # exited just now, poll() reports it
+            sample.update(cache_usage(os.path.join(workdir, '_cache')))
+            samples.append(sample)
+            if (baseline is None) and (elapsed >= args.warmup):
+                baseline = sample
+            print('{0:6d}s rss {1:.1f} MB, threads {2}, fds {3}, cache {4:.0f} KB, logs {5:.0f} KB, '
+                  'chatrooms {6}, contacts {7}'.format(sample['t'], sample['rss_mb'], sample['threads'],
+                                                      sample['fds'], sample['cache_kb'], sample['logs_kb'],
+                                                      sample.get('chatrooms', '?'), sample.get('contacts', '?')))
+            if elapsed >= args.duration:
+                break
+            time.sleep(min(args.sample_interval, max(0.0, args.duration - elapsed)))
+        traffic.stopped.set()
+        traffic.join(15)
+
+        if bot_proc.poll() is None:
+            drain_timeout = float(cfg['server'].get('drain_timeout', '25'))
+            bot_proc.send_signal(signal.SIGTERM)
+            try:
+                if bot_proc.wait(drain_timeout + 15) != 0:
+                    failures.append('bot exited with code {0} on SIGTERM'.format(bot_proc.returncode))
+            except subprocess.TimeoutExpired:
+                failures.append('bot did not stop in {0:.0f} s after SIGTERM'.format(drain_timeout + 15))
+
+        print('Webhook statuses: {0}; connection errors: {1}'.format(', '.join(
+            '{0}: {1}'.format(status, n) for status, n in sorted(traffic.statuses.items())), traffic.num_errors))
+        stats = fetch_json(standin + '/_stats', ssl_context=ssl_context)
+        if stats is not None:
+            print('Stand-in calls: {0}; tweets {1}'.format(', '.join(
+                '{0}: {1}'.format(k, v) for k, v in sorted(stats['counts'].items())), stats['tweets']))
+            if stats['counts'].get('skype', 0) == 0:
+                failures.append('bot sent no messages, see ' + os.path.join(workdir, 'bot.log'))
+        if baseline is None:
+            failures.append('no samples after warmup, --duration should be longer than --warmup')
+        else:
+            print('{0:28s} {1:>10s} {2:>10s} {3:>10s} {4:>10s} {5:>10s}'.format(
+                'metric', 'baseline', 'last', 'max', 'growth', 'bound'))
+            for name, base, last, peak, growth, bound, ok in check_bounds(
+                    baseline, samples[-1], samples, bounds, args.max_state_growth):
+                print('{0:28s} {1:>10s} {2:>10s} {3:>10s} {4:>10s} {5:>10s}{6}'.format(
+                    name, format_value(base), format_value(last), format_value(peak),
+                    format_value(growth), format_value(bound), '' if ok else '  FAIL'))
+                if not ok:
+                    failures.append('{0} grew by {1} over baseline, bound {2}'.format(
+                        name, format_value(growth), format_value(bound)))
+        if args.csv != '':
+            columns = sorted(set(name for s in samples for name in s), key=lambda name: (name != 't', name))
+            with open(args.csv, mode='wt', encoding='utf-8') as f:
+                f.write(','.join(columns) + '\n')
+                for s in samples:
+                    f.write(','.join(format_value(s.get(name)) for name in columns) + '\n')
+    finally:
+        if traffic is not None:
+            traffic.stopped.set()
+        if (bot_proc is not None) and (bot_proc.poll() is None):
+            bot_proc.kill()
+            bot_proc.wait()
+        standin_proc.terminate()
+        standin_proc.wait()
+        for failure in failures:
+            print('FAIL: ' + failure)
+        if args.workdir == '':
+            if len(failures) == 0:
+                shutil.rmtree(workdir, ignore_errors=True)
+            else:
+                print('Bot working directory kept: ' + workdir)
+    if len(failures) > 0:
+        return 1
+    print('PASS')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
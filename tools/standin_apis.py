@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-ins for the external APIs the bot calls, for load tests and
+traffic replays without touching real services:
+- Microsoft OAuth token endpoint:  POST .../oauth2/v2.0/token
+- Skype Bot API:                   POST /v2/conversations/<id>/activities
+  and members of group chats:      GET /v3/conversations/<id>/members
+- Twitter user timeline:           GET /1.1/statuses/user_timeline.json
+- nicovideo thumbnail info:        GET /api/getthumbinfo/<video_id>
+- bot platform OpenID metadata:    GET /v1/.well-known/openidconfiguration
+  and its signing keys:            GET /v1/.well-known/keys
+- webhook bearer token for tests:  GET /_token?aud=<bot app_id>[&ttl=3600][&kid=...]
+- counters of calls:               GET /_stats, POST /_reset
+
+Point the bot at it in conf/bot.conf:
+    [app]      oauth_url = https://127.0.0.1:9443/common/oauth2/v2.0/token
+               skype_api_url = https://127.0.0.1:9443
+    [twitter]  api_host = 127.0.0.1:9443
+    [metadata] nicovideo_url = https://127.0.0.1:9443/api/getthumbinfo/
+    [webhook_auth] openid_metadata_url = https://127.0.0.1:9443/v1/.well-known/openidconfiguration
+Webhook senders (tools/replay_webhooks.py --auth-token-url) get tokens,
+signed by a key generated at start, from /_token.
+Twitter client always uses HTTPS, so run with a certificate:
+    openssl req -x509 -newkey rsa:2048 -nodes -keyout standin.key -out standin.crt \\
+        -days 30 -subj /CN=127.0.0.1 -addext subjectAltName=IP:127.0.0.1
+    python tools/standin_apis.py --cert standin.crt --key standin.key
+and start the bot with REQUESTS_CA_BUNDLE=standin.crt, so that it trusts it.
+"""
+import sys
+import ssl
+import json
+import time
+import base64
+import random
+import hashlib
+import argparse
+import threading
+import http.server
+import urllib.parse
+
+
+class StandinState:
+    def __init__(self, args):
+        self.latency = args.latency / 1000.0
+        self.error_rate = args.error_rate
+        self.fail_endpoints = [e.strip() for e in args.fail_endpoints.split(',') if e.strip() != '']
+        self.new_tweet_every = args.new_tweet_every
+        self.token_ttl = args.token_ttl
+        self.members = args.members
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._num_initial_tweets = args.tweets
+        self.counts = {}  # endpoint => number of calls
+        self.num_errors = 0
+        self.messages_per_conversation = {}
+        self.last_messages = []
+
+    def count(self, endpoint: str):
+        with self._lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+    def should_fail(self, endpoint: str) -> bool:
+        if (len(self.fail_endpoints) > 0) and (endpoint not in self.fail_endpoints):
+            return False
+        if (self.error_rate > 0) and (random.random() < self.error_rate):
+            with self._lock:
+                self.num_errors += 1
+            return True
+        return False
+
+    def add_message(self, conversation: str, content: str):
+        with self._lock:
+            self.messages_per_conversation[conversation] = \
+                self.messages_per_conversation.get(conversation, 0) + 1
+            self.last_messages.append({'to': conversation, 'content': content})
+            self.last_messages = self.last_messages[-20:]
+
+    def get_num_tweets(self) -> int:
+        num = self._num_initial_tweets
+        if self.new_tweet_every > 0:
+            num += int((time.time() - self._started) / self.new_tweet_every)
+        return num
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'counts': dict(self.counts),
+                'errors': self.num_errors,
+                'messages_per_conversation': dict(self.messages_per_conversation),
+                'last_messages': list(self.last_messages),
+                'tweets': self.get_num_tweets()
+            }
+
+    def reset(self):
+        with self._lock:
+            self.counts = {}
+            self.num_errors = 0
+            self.messages_per_conversation = {}
+            self.last_messages = []
+
+
+def _is_probable_prime(n: int, rounds: int = 40) -> bool:
+    if n < 4:
+        return n in (2, 3)
+    for p in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37):
+        if n % p == 0:
+            return n == p
+    d, r = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        r += 1
+    for _ in range(rounds):
+        x = pow(random.randrange(2, n - 1), d, n)
+        if (x == 1) or (x == n - 1):
+            continue
+        for _ in range(r - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _b64url(b: bytes) -> str:
+    return base64.urlsafe_b64encode(b).decode('ascii').rstrip('=')
+
+
+class StandinSigningKey:
+    """
+    RSA key for signing test tokens (RS256), generated at start.
+    Only for stand-in use: random module is not a secure random source.
+    """
+
+    ISSUER = 'https://api.botframework.com'
+    SHA256_DIGEST_INFO = bytes.fromhex('3031300d060960864801650304020105000420')
+
+    def __init__(self, bits: int = 2048):
+        self.kid = 'standin-{0}'.format(int(time.time()))
+        self.e = 65537
+        while True:
+            p = self._gen_prime(bits // 2)
+            q = self._gen_prime(bits // 2)
+            phi = (p - 1) * (q - 1)
+            if (p != q) and (phi % self.e != 0):
+                break
+        self.n = p * q
+        self.d = pow(self.e, -1, phi)
+        self.size = (self.n.bit_length() + 7) // 8
+
+    @staticmethod
+    def _gen_prime(bits: int) -> int:
+        while True:
+            candidate = random.getrandbits(bits) | (1 << (bits - 1)) | (1 << (bits - 2)) | 1
+            if _is_probable_prime(candidate):
+                return candidate
+
+    def get_jwk(self) -> dict:
+        return {
+            'kty': 'RSA', 'use': 'sig', 'kid': self.kid,
+            'n': _b64url(self.n.to_bytes(self.size, 'big')),
+            'e': _b64url(self.e.to_bytes(3, 'big')),
+            'endorsements': ['skype']
+        }
+
+    def make_token(self, audience: str, ttl: int, kid: str = '') -> str:
+        now = int(time.time())
+        header = {'alg': 'RS256', 'typ': 'JWT', 'kid': kid if kid != '' else self.kid}
+        claims = {'iss': self.ISSUER, 'aud': audience, 'nbf': now - 5, 'exp': now + ttl}
+        signing_input = _b64url(json.dumps(header).encode('utf-8')) + '.' + \
+            _b64url(json.dumps(claims).encode('utf-8'))
+        t = self.SHA256_DIGEST_INFO + hashlib.sha256(signing_input.encode('ascii')).digest()
+        em = b'\x00\x01' + b'\xff' * (self.size - len(t) - 3) + b'\x00' + t
+        signature = pow(int.from_bytes(em, 'big'), self.d, self.n).to_bytes(self.size, 'big')
+        return signing_input + '.' + _b64url(signature)
+
+
+def make_tweet(n: int) -> dict:
+    video_id = 'sm{0}'.format(28000000 + n)
+    created = time.gmtime(1460000000 + n * 600)
+    return {
+        'id': 720000000000000000 + n,
+        'id_str': str(720000000000000000 + n),
+        'created_at': time.strftime('%a %b %d %H:%M:%S +0000 %Y', created),
+        'text': '"Stand-in tournament video part{0}" - https://t.co/x{0} #{1}'.format(n, video_id),
+        'entities': {
+            'urls': [{'expanded_url': 'http://www.nicovideo.jp/watch/' + video_id,
+                      'url': 'https://t.co/x{0}'.format(n)}]
+        },
+        'user': {'id': 1, 'id_str': '1', 'screen_name': 'standin'}
+    }
+
+
+class StandinRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes, content_type: str = 'application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length', '0'))
+        if length > 0:
+            return self.rfile.read(length)
+        return b''
+
+    def do_GET(self):
+        state = self.server.state
+        path = urllib.parse.urlsplit(self.path).path
+        if path == '/_stats':
+            self.send_body(200, json.dumps(state.get_stats(), indent=4).encode('utf-8'))
+            return
+        if path.startswith('/1.1/statuses/user_timeline'):
+            self.simulate('twitter', self.reply_timeline)
+            return
+        if path.startswith('/api/getthumbinfo/'):
+            self.simulate('nicovideo', self.reply_thumbinfo)
+            return
+        if path.startswith('/v3/conversations/') and path.endswith('/members'):
+            self.simulate('members', self.reply_members)
+            return
+        if path == '/v1/.well-known/openidconfiguration':
+            self.simulate('openid', self.reply_openid_metadata)
+            return
+        if path == '/v1/.well-known/keys':
+            self.simulate('openid', self.reply_jwks)
+            return
+        if path == '/_token':
+            query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+            token = self.server.signing_key.make_token(query.get('aud', ''), int(query.get('ttl', '3600')),
+                                                       query.get('kid', ''))
+            self.send_body(200, json.dumps({'token': token}).encode('utf-8'))
+            return
+        self.send_body(404, b'{}')
+
+    def reply_openid_metadata(self):
+        proto = 'https' if isinstance(self.connection, ssl.SSLSocket) else 'http'
+        base = '{0}://{1}'.format(proto, self.headers.get('Host', '127.0.0.1'))
+        metadata = {
+            'issuer': StandinSigningKey.ISSUER,
+            'jwks_uri': base + '/v1/.well-known/keys',
+            'id_token_signing_alg_values_supported': ['RS256']
+        }
+        self.send_body(200, json.dumps(metadata).encode('utf-8'))
+
+    def reply_jwks(self):
+        self.send_body(200, json.dumps({'keys': [self.server.signing_key.get_jwk()]}).encode('utf-8'))
+
+    def do_POST(self):
+        state = self.server.state
+        path = urllib.parse.urlsplit(self.path).path
+        body = self.read_body()
+        if path == '/_reset':
+            state.reset()
+            self.send_body(200, b'{}')
+            return
+        if path.endswith('/oauth2/v2.0/token'):
+            self.simulate('oauth', self.reply_token)
+            return
+        if path.startswith('/v2/conversations/') and path.endswith('/activities'):
+            conversation = urllib.parse.unquote(path.split('/')[3])
+            self.simulate('skype', self.reply_activity, conversation, body)
+            return
+        self.send_body(404, b'{}')
+
+    def simulate(self, endpoint: str, reply_fn, *args):
+        state = self.server.state
+        state.count(endpoint)
+        if state.latency > 0:
+            time.sleep(state.latency)
+        if state.should_fail(endpoint):
+            self.send_body(503, b'{"error": "stand-in failure"}')
+            return
+        reply_fn(*args)
+
+    def reply_token(self):
+        ttl = self.server.state.token_ttl
+        token = {'token_type': 'Bearer', 'expires_in': ttl, 'ext_expires_in': ttl,
+                 'access_token': 'standin-token-{0}'.format(int(time.time()))}
+        self.send_body(200, json.dumps(token).encode('utf-8'))
+
+    def reply_activity(self, conversation: str, body: bytes):
+        content = ''
+        try:
+            content = json.loads(body.decode('utf-8'))['message']['content']
+        except (ValueError, KeyError, TypeError):
+            pass
+        self.server.state.add_message(conversation, content)
+        self.send_body(201, b'')
+
+    def reply_members(self):
+        # every conversation has the same members
+        members = [{'id': '8:u{0}'.format(n), 'name': 'Stand-in user {0}'.format(n)}
+                   for n in range(self.server.state.members)]
+        self.send_body(200, json.dumps(members).encode('utf-8'))
+
+    def reply_timeline(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        count = int(query.get('count', ['20'])[0])
+        num = self.server.state.get_num_tweets()
+        tweets = [make_tweet(n) for n in range(num, max(0, num - count), -1)]
+        self.send_body(200, json.dumps(tweets).encode('utf-8'))
+
+    def reply_thumbinfo(self):
+        video_id = self.path.rsplit('/', 1)[-1]
+        n = int(''.join(c for c in video_id if c.isdigit()) or '0')
+        xml = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<nicovideo_thumb_response status="ok"><thumb>'
+               '<video_id>{0}</video_id><title>Stand-in video {0}</title>'
+               '<thumbnail_url>http://127.0.0.1/thumb/{0}</thumbnail_url>'
+               '<length>{1}:{2:02d}</length>'
+               '</thumb></nicovideo_thumb_response>').format(video_id, n % 60, n % 59)
+        self.send_body(200, xml.encode('utf-8'), 'application/xml')
+
+
+class StandinServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, state: StandinState, ssl_context=None):
+        super(StandinServer, self).__init__(address, StandinRequestHandler)
+        self.state = state
+        self.signing_key = StandinSigningKey()
+        if ssl_context is not None:
+            # handshake happens on first read, in request handler thread
+            self.socket = ssl_context.wrap_socket(self.socket, server_side=True,
+                                                  do_handshake_on_connect=False)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Local stand-ins for Skype, OAuth, Twitter and nicovideo APIs')
+    ap.add_argument('--bind', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=9443)
+    ap.add_argument('--cert', default='', help='certificate file, enables HTTPS')
+    ap.add_argument('--key', default='', help='private key file')
+    ap.add_argument('--latency', type=float, default=0.0, help='added latency of every call, ms')
+    ap.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls answered with 503')
+    ap.add_argument('--fail-endpoints', default='',
+                    help='comma-separated endpoints (oauth, skype, members, twitter, nicovideo, openid) '
+                         'that --error-rate applies to, default all')
+    ap.add_argument('--tweets', type=int, default=5, help='number of tweets in timeline at start')
+    ap.add_argument('--new-tweet-every', type=float, default=0.0,
+                    help='add a new tweet to timeline every that many seconds')
+    ap.add_argument('--members', type=int, default=100,
+                    help='members of every group chat: 8:u0, 8:u1, ... (named "Stand-in user <n>")')
+    ap.add_argument('--token-ttl', type=int, default=3600, help='expires_in of issued OAuth tokens, seconds')
+    args = ap.parse_args()
+    ssl_context = None
+    if args.cert != '':
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(args.cert, args.key if args.key != '' else None)
+    server = StandinServer((args.bind, args.port), StandinState(args), ssl_context)
+    print('Stand-in APIs listening at {0}://{1}:{2}'.format(
+        'https' if ssl_context is not None else 'http', args.bind, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())